@@ -20,7 +20,7 @@ VERSION = None  # get this from __version__.py
 REQUIRED = [line.rstrip('\n') for line in open('requirements.txt')]
 
 # What packages are optional?
-EXTRAS = {"prod": ["mod_wsgi"]}
+EXTRAS = {"prod": ["mod_wsgi"], "postgres": ["psycopg2-binary"]}
 
 # get the absolute path to this file
 here = os.path.abspath(os.path.dirname(__file__))
@@ -78,7 +78,9 @@ setup(
     scripts=["bin/run-fitly-prod"],
     entry_points={
         "console_scripts": [
-            "run-fitly-dev=fitly.dev_cli:main"
+            "run-fitly-dev=fitly.dev_cli:main",
+            "fitly=fitly.cli:main",
+            "fitly-worker=fitly.worker:main",
         ]
     },
 )
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+from ..api.sqlalchemy_declarative import db_connect, athlete, ouraSleepSummary, withings, stravaSummary
+
+# Resting hr, weight and ride ftp test history loaded once per refresh, so ingesting a batch of activities bisects in
+# memory instead of querying each table for every activity.
+
+
+def to_datetime64(timestamps):
+    '''
+    Timestamps as a naive datetime64 array, tz aware timestamps (stravalib start_date) are converted to UTC like the db
+    '''
+    timestamps = pd.to_datetime(pd.Series(list(timestamps), dtype=object), utc=True)
+    return timestamps.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]')
+
+
+class AsOfSeries(object):
+    '''
+    Timestamped values answering "latest value at or before t" by bisection
+    :param strict: only use values strictly before t
+    :param hold_first: timestamps before the first value get the first value instead of None
+    '''
+
+    def __init__(self, timestamps, values, strict=False, hold_first=False):
+        df = pd.DataFrame({'timestamp': to_datetime64(timestamps), 'value': pd.Series(list(values), dtype=object)})
+        df = df[df['timestamp'].notnull()].sort_values('timestamp', kind='stable')
+        self.timestamps = df['timestamp'].to_numpy(dtype='datetime64[ns]')
+        self.values = df['value'].to_numpy(dtype=object)
+        self.strict = strict
+        self.hold_first = hold_first
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def positions(self, timestamps):
+        '''
+        Position of the value in effect at each timestamp, -1 where there is none
+        '''
+        positions = np.searchsorted(self.timestamps, to_datetime64(timestamps),
+                                    side='left' if self.strict else 'right') - 1
+        if self.hold_first and len(self) > 0:
+            positions = np.maximum(positions, 0)
+        return positions
+
+    def asof(self, timestamps):
+        '''
+        :param timestamps: array of timestamps
+        :return: object np array of the value in effect at each timestamp, None where there is none
+        '''
+        positions = self.positions(timestamps)
+        values = np.full(len(positions), None, dtype=object)
+        values[positions >= 0] = self.values[positions[positions >= 0]]
+        return values
+
+    def asof_timestamps(self, timestamps):
+        '''
+        Timestamp of the value in effect at each timestamp, NaT where there is none
+        '''
+        positions = self.positions(timestamps)
+        values = np.full(len(positions), np.datetime64('NaT'), dtype='datetime64[ns]')
+        values[positions >= 0] = self.timestamps[positions[positions >= 0]]
+        return values
+
+
+class IngestionIndex(object):
+    '''
+    Everything fetch() looks up about the athlete at the time of an activity
+    :param stryd_df: stryd summary, loaded once by the caller when there are runs to look up
+    '''
+
+    def __init__(self, athlete_info, rest_hr, weight, ride_ftp_tests, stryd_df=None):
+        self.athlete_info = athlete_info
+        self.rest_hr = rest_hr
+        self.weight = weight
+        self.ride_ftp_tests = ride_ftp_tests
+        self.stryd_df = stryd_df
+
+    def activity_values(self, activities):
+        '''
+        Resting hr, weight and latest earlier ride ftp test for many activities, one vectorized lookup each
+        :return: df indexed on activity id with hr_lowest, weight, ftp_test_watts and ftp_test_date (null where the
+        history has no value)
+        '''
+        start_dates = [x.start_date for x in activities]
+        # Oura report dates are compared with the utc day of the workout
+        start_days = pd.Series(to_datetime64(start_dates)).dt.normalize()
+        start_dates_local = [x.start_date_local for x in activities]
+        return pd.DataFrame({
+            'hr_lowest': self.rest_hr.asof(start_days),
+            'weight': self.weight.asof(start_dates),
+            'ftp_test_watts': self.ride_ftp_tests.asof(start_dates_local),
+            'ftp_test_date': self.ride_ftp_tests.asof_timestamps(start_dates_local)
+        }, index=pd.Index([x.id for x in activities], name='activity_id'))
+
+
+def load_ingestion_index(athlete_id=1):
+    '''
+    Read the athlete, resting hr, weight and ride ftp test history once
+    '''
+    session, engine = db_connect()
+    athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+    df_hr = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.hr_lowest).statement,
+                        con=engine)
+    df_weight = pd.read_sql(sql=session.query(withings.date_utc, withings.weight).statement, con=engine)
+    df_ftp = pd.read_sql(
+        sql=session.query(stravaSummary.start_date_local, stravaSummary.average_watts).filter(
+            stravaSummary.type.ilike('%ride%'), stravaSummary.name.ilike('%ftp test%')).statement, con=engine)
+    session.close()
+    return IngestionIndex(
+        athlete_info,
+        # Activities before the first oura/withings record use the first record
+        rest_hr=AsOfSeries(df_hr['report_date'], df_hr['hr_lowest'], hold_first=True),
+        weight=AsOfSeries(df_weight['date_utc'], df_weight['weight'], hold_first=True),
+        ride_ftp_tests=AsOfSeries(df_ftp['start_date_local'], df_ftp['average_watts'], strict=True))
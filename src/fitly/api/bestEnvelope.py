@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, and_, delete
+from ..api.sqlalchemy_declarative import db_connect, db_upsert, stravaBestSamples, stravaBestEnvelope
+
+# Best mean max power per interval for each sport and period, so the power curve reads one row per interval instead
+# of grouping all of strava_best_samples on every render. Sliding periods are rolled forward on each refresh.
+sports = ['ride', 'run']
+periods = {'all': None, 'L90D': 90, 'L6W': 42}
+
+envelope_columns = ['interval', 'mmp', 'ftp', 'watts_per_kg', 'activity_id', 'act_name', 'timestamp_local',
+                    'time_interval', 'date']
+
+
+def activity_sport(activity_type):
+    '''
+    Sport an activity type is charted under, matching the power curve's type.ilike('%sport%') filter
+    '''
+    activity_type = (activity_type or '').lower()
+    return next((sport for sport in sports if sport in activity_type), None)
+
+
+def period_start(period):
+    return None if periods[period] is None else datetime.now() - timedelta(days=periods[period])
+
+
+def best_samples(session, sport, since=None):
+    '''
+    Rows of strava_best_samples holding the best mmp for each interval, with the best W/kg at the interval
+    :param since: only consider workouts on or after this timestamp
+    '''
+    filters = [stravaBestSamples.type.ilike('%' + sport + '%')]
+    if since is not None:
+        filters.append(stravaBestSamples.timestamp_local >= since)
+    best = session.query(stravaBestSamples.interval, func.max(stravaBestSamples.mmp).label('mmp')).filter(
+        *filters).group_by(stravaBestSamples.interval).subquery()
+    df = pd.read_sql(
+        sql=session.query(stravaBestSamples).join(best, and_(stravaBestSamples.interval == best.c.interval,
+                                                             stravaBestSamples.mmp == best.c.mmp)).filter(
+            *filters).statement,
+        con=session.connection())
+    max_watts_per_kg = pd.read_sql(
+        sql=session.query(stravaBestSamples.interval,
+                          func.max(stravaBestSamples.watts_per_kg).label('max_watts_per_kg')).filter(
+            *filters).group_by(stravaBestSamples.interval).statement,
+        con=session.connection(), index_col='interval')['max_watts_per_kg']
+    # Ties go to the first workout that set the value
+    df = df.sort_values('timestamp_local').drop_duplicates('interval')[envelope_columns]
+    df['max_watts_per_kg'] = max_watts_per_kg.reindex(df['interval']).to_numpy()
+    return df
+
+
+def rebuild_period(session, sport, period):
+    session.execute(delete(stravaBestEnvelope).where(stravaBestEnvelope.sport == sport,
+                                                     stravaBestEnvelope.period == period))
+    df = best_samples(session, sport, period_start(period))
+    df['sport'] = sport
+    df['period'] = period
+    return db_upsert(df.set_index(['sport', 'period', 'interval']), 'strava_best_envelope',
+                     con=session.connection())
+
+
+def merge_best_samples(session, df_best_samples):
+    '''
+    Raise the envelope wherever a new workout beat the current best mmp or W/kg
+    :param df_best_samples: strava_best_samples rows for one activity
+    '''
+    df = df_best_samples.reset_index()
+    df = df[df['mmp'].notnull()]
+    sport = activity_sport(df['type'].iloc[0]) if len(df) > 0 else None
+    if sport is None:
+        return 0
+    df_envelope = pd.read_sql(
+        sql=session.query(stravaBestEnvelope.period, stravaBestEnvelope.interval, stravaBestEnvelope.mmp,
+                          stravaBestEnvelope.max_watts_per_kg).filter(
+            stravaBestEnvelope.sport == sport).statement, con=session.connection())
+    rows, wkg_rows = [], []
+    for period in periods:
+        since = period_start(period)
+        candidates = df if since is None else df[df['timestamp_local'] >= since]
+        current = df_envelope[df_envelope['period'] == period].set_index('interval').reindex(candidates['interval'])
+        improved = ~(candidates['mmp'].to_numpy() <= current['mmp'].to_numpy())
+        max_watts_per_kg = np.fmax(current['max_watts_per_kg'].to_numpy(dtype=float),
+                                   candidates['watts_per_kg'].to_numpy(dtype=float))
+        wkg_improved = ~improved & ~(max_watts_per_kg <= current['max_watts_per_kg'].to_numpy(dtype=float))
+        candidates = candidates[envelope_columns].assign(sport=sport, period=period, max_watts_per_kg=max_watts_per_kg)
+        rows.append(candidates[improved])
+        # Only the best W/kg changes where the best mmp still belongs to an earlier workout
+        wkg_rows.append(candidates[wkg_improved][['sport', 'period', 'interval', 'max_watts_per_kg']])
+    rows = db_upsert(pd.concat(rows).set_index(['sport', 'period', 'interval']), 'strava_best_envelope',
+                     con=session.connection())
+    return rows + db_upsert(pd.concat(wkg_rows).set_index(['sport', 'period', 'interval']), 'strava_best_envelope',
+                            con=session.connection())
+
+
+def roll_best_envelope(session):
+    '''
+    Rebuild a sliding period once its best for any interval has aged out of the window, and any period that is empty
+    '''
+    rows = 0
+    for sport in sports:
+        for period in periods:
+            since = period_start(period)
+            query = session.query(stravaBestEnvelope.interval).filter(stravaBestEnvelope.sport == sport,
+                                                                      stravaBestEnvelope.period == period)
+            empty = query.first() is None
+            expired = since is not None and query.filter(
+                stravaBestEnvelope.timestamp_local < since).first() is not None
+            if empty or expired:
+                rows += rebuild_period(session, sport, period)
+    return rows
+
+
+def update_best_envelope(df_best_samples=None):
+    '''
+    Roll the sliding periods forward and merge a new activity's best samples into the envelope
+    :return: number of envelope rows written
+    '''
+    session, engine = db_connect()
+    try:
+        # Roll first so an empty envelope is built from every workout, not just the new one
+        rows = roll_best_envelope(session)
+        rows += merge_best_samples(session, df_best_samples) if df_best_samples is not None else 0
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return rows
+
+
+def truncate_best_envelope(session):
+    '''
+    Delete the envelope after strava_best_samples rows are removed, the next update rebuilds it
+    '''
+    session.execute(delete(stravaBestEnvelope))
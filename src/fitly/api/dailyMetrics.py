@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, delete
+from ..api.sqlalchemy_declarative import db_connect, db_upsert, get_engine, dailyMetrics, stravaSummary, \
+    ouraSleepSummary, ouraReadinessSummary, withings
+from ..utils import config, utc_to_local
+
+# Daily fact table behind the performance management chart. Ingestion recomputes it from the earliest changed day so
+# the chart and kpis read one indexed range instead of rebuilding every day of history on each page load.
+atl_days = 7
+ctl_days = 42
+atl_exp = np.exp(-1 / atl_days)
+ctl_exp = np.exp(-1 / ctl_days)
+
+# Days of daily_metrics read ahead of the recompute window to seed rolling windows (rmssd_30, ramp rate)
+history_days = 42
+
+load_columns = ['stress_score', 'tss', 'hrss', 'low_intensity_seconds', 'med_intensity_seconds',
+                'high_intensity_seconds', 'tss_flag']
+
+
+def stress_scores(df_summary, power_status=True, hr_status=True):
+    '''
+    Stress score of each workout
+    :param power_status: use tss (power)
+    :param hr_status: use hrss (heart rate). When both are selected tss is used when available, otherwise hrss
+    '''
+    if power_status and hr_status:
+        return df_summary['tss'].fillna(df_summary['hrss']).fillna(0)
+    elif power_status:
+        return df_summary['tss']
+    elif hr_status:
+        return df_summary['hrss']
+    else:
+        return pd.Series(0, index=df_summary.index)
+
+
+def ftp_change_flags(df_summary):
+    '''
+    Flag the workout which caused a new run/ride ftp to be set: 1 when ftp went up, -1 when it went down
+    :param df_summary: strava_summary rows sorted by start_date_local
+    :return: np array aligned with df_summary, nan where ftp did not change
+    '''
+    types = df_summary['type'].fillna('').str.lower()
+    ftp = df_summary['ftp'].to_numpy(dtype=float)
+    flags = np.full(len(df_summary), np.nan)
+    for sport in ['run', 'ride']:
+        positions = np.flatnonzero(types.str.contains(sport).to_numpy())
+        sport_ftp = ftp[positions]
+        previous_ftp = np.concatenate([[np.nan], sport_ftp[:-1]])
+        keep = ~np.isnan(previous_ftp)
+        positions, sport_ftp, previous_ftp = positions[keep], sport_ftp[keep], previous_ftp[keep]
+        change = np.where(previous_ftp > sport_ftp, -1., np.where(previous_ftp < sport_ftp, 1., 0.))
+        # Highlight the workout which caused the new FTP to be set
+        change = np.concatenate([change[1:], [np.nan]])
+        changed = (change == 1) | (change == -1)
+        flags[positions[changed]] = change[changed]
+    return flags
+
+
+def exponential_load(stress, days, initial=0.):
+    '''
+    Vectorized form of load[i] = stress[i] * (1 - exp(-1/days)) + load[i-1] * exp(-1/days)
+    :param stress: daily stress scores
+    :param initial: load on the day before the first day of stress
+    '''
+    decay = np.exp(-1 / days)
+    values = np.concatenate([[initial], stress.fillna(0).to_numpy(dtype=float)])
+    load = pd.Series(values).ewm(alpha=1 - decay, adjust=False).mean().to_numpy()[1:]
+    return pd.Series(load, index=stress.index)
+
+
+def daily_training_load(df_summary, end_date, workout_types=None, power_status=True, hr_status=True,
+                        start_date=None, initial_atl=0., initial_ctl=0.):
+    '''
+    Sum workouts to one row per day and calculate fitness (CTL) and fatigue (ATL)
+    :param df_summary: strava_summary rows indexed on start_date_local
+    :param end_date: last day to calculate, days without workouts decay
+    :param workout_types: workout types CTL is based on, defaults to every workout with a type. ATL is always
+    based on all sports
+    :param start_date: first day to calculate, defaults to the first workout
+    :return: df indexed on day with load_columns, CTL and ATL
+    '''
+    df_summary = df_summary.set_index(pd.to_datetime(df_summary.index)).sort_index()
+    df_summary['stress_score'] = stress_scores(df_summary, power_status, hr_status)
+    df_summary['tss_flag'] = ftp_change_flags(df_summary)
+    df_summary[load_columns] = df_summary[load_columns].astype(float)
+    start_date = df_summary.index.min() if start_date is None else start_date
+    days = pd.date_range(pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date).normalize(), freq='D')
+
+    atl_df = df_summary[['stress_score']].resample('D').sum().reindex(days, fill_value=0)
+
+    ctl_workouts = df_summary[df_summary['type'].notnull()] if workout_types is None else df_summary[
+        df_summary['type'].isin(workout_types)]
+    pmd = ctl_workouts[load_columns].resample('D').sum().reindex(days, fill_value=0)
+    pmd['CTL'] = exponential_load(pmd['stress_score'], ctl_days, initial_ctl)
+    pmd['ATL'] = exponential_load(atl_df['stress_score'], atl_days, initial_atl)
+    return pmd
+
+
+def extend_training_load(df, end_date):
+    '''
+    Extend a daily CTL/ATL df to end_date assuming no further workouts
+    '''
+    last_day = df.index.max()
+    df = df.reindex(pd.date_range(df.index.min(), pd.Timestamp(end_date).normalize(), freq='D'))
+    future = df.index > last_day
+    days_ahead = (df.index[future] - last_day).days.to_numpy()
+    df.loc[future, load_columns] = 0
+    df.loc[future, 'CTL'] = df.at[last_day, 'CTL'] * ctl_exp ** days_ahead
+    df.loc[future, 'ATL'] = df.at[last_day, 'ATL'] * atl_exp ** days_ahead
+    return df
+
+
+def hrv_baselines(rmssd):
+    '''
+    7 day rmssd baseline and 30 day smallest worthwhile change band, also the thresholds of the hrv workout plan
+    :param rmssd: daily rmssd series with one row per calendar day so rolling is always done at the correct # of days
+    '''
+    df = rmssd.to_frame('rmssd')
+    df['rmssd_7'] = df['rmssd'].rolling(7, min_periods=0).mean()
+    df['rmssd_30'] = df['rmssd'].rolling(30, min_periods=0).mean()
+    stdev_rmssd_30_threshold = df['rmssd'].rolling(30, min_periods=0).std() * .5
+    df['swc_upper'] = df['rmssd_30'] + stdev_rmssd_30_threshold
+    df['swc_lower'] = df['rmssd_30'] - stdev_rmssd_30_threshold
+    return df
+
+
+def daily_series(session, engine, date_column, value_column, start_date):
+    '''
+    Read one value per day from a table on or after start_date
+    '''
+    df = pd.read_sql(sql=session.query(date_column, value_column).filter(date_column >= start_date).statement,
+                     con=engine, index_col=date_column.name)
+    df.index = pd.to_datetime(df.index)
+    return df[value_column.name].astype(float).resample('D').mean()
+
+
+def update_daily_metrics(start_date=None, athlete_id=1):
+    '''
+    Recompute daily_metrics from start_date through today
+    :param start_date: earliest day whose inputs changed. Always reaches back over the oura days_back window, which
+    the oura pull may have revised, and rebuilds from the first workout when the table is empty
+    :return: number of days written
+    '''
+    session, engine = db_connect()
+    last_day = session.query(func.max(dailyMetrics.date)).filter(dailyMetrics.athlete_id == athlete_id).scalar()
+    first_day = session.query(func.min(stravaSummary.start_day_local)).scalar()
+    if first_day is None:
+        session.close()
+        return 0
+
+    if last_day is None:
+        start_date = first_day
+    else:
+        days_back = int(config.get('oura', 'days_back', fallback='7'))
+        start_date = min(pd.Timestamp(start_date or last_day).date(), last_day - timedelta(days=days_back))
+        # The workout before the window is flagged if the first workout in the window set a new ftp
+        previous_workout = session.query(func.max(stravaSummary.start_day_local)).filter(
+            stravaSummary.start_day_local < start_date).scalar()
+        start_date = min(start_date, previous_workout or start_date)
+    start_date = max(start_date, first_day)
+    end_date = utc_to_local(datetime.utcnow()).date()
+    history_start = start_date - timedelta(days=history_days)
+
+    history = pd.read_sql(
+        sql=session.query(dailyMetrics).filter(dailyMetrics.athlete_id == athlete_id,
+                                               dailyMetrics.date >= history_start,
+                                               dailyMetrics.date < start_date).statement,
+        con=engine, index_col='date')
+    history.index = pd.to_datetime(history.index)
+    seed = history.loc[history.index == pd.Timestamp(start_date - timedelta(days=1))]
+
+    # Read workouts back to history_start so the first workout of each sport in the window has a previous ftp
+    df_summary = pd.read_sql(
+        sql=session.query(stravaSummary).filter(stravaSummary.start_day_local >= history_start).statement,
+        con=engine, index_col='start_date_local')
+    df = daily_training_load(df_summary, end_date, start_date=start_date,
+                             initial_atl=seed['atl'].iloc[0] if len(seed) > 0 else 0.,
+                             initial_ctl=seed['ctl'].iloc[0] if len(seed) > 0 else 0.)
+    df = df.rename(columns={'CTL': 'ctl', 'ATL': 'atl'})
+
+    # TSB and ramp rate look back over previous days
+    load = pd.concat([history[['ctl', 'atl']], df[['ctl', 'atl']]])
+    df['tsb'] = (load['ctl'].shift(1) - load['atl'].shift(1)).loc[df.index]
+    df['ramp_rate'] = (load['ctl'] - load['ctl'].shift(7)).loc[df.index]
+
+    rmssd = daily_series(session, engine, ouraSleepSummary.report_date, ouraSleepSummary.rmssd, start_date)
+    rmssd = pd.concat([history['rmssd'], rmssd]).reindex(load.index)
+    df = df.join(hrv_baselines(rmssd).loc[df.index])
+
+    df['readiness_score'] = daily_series(session, engine, ouraReadinessSummary.report_date,
+                                         ouraReadinessSummary.score, start_date)
+    df['sleep_score'] = daily_series(session, engine, ouraSleepSummary.report_date, ouraSleepSummary.score,
+                                     start_date)
+
+    # Carry the latest weigh in forward, starting from the last one before the window
+    df_weight = pd.read_sql(sql=session.query(withings.date_utc, withings.weight).filter(
+        withings.date_utc >= (session.query(func.max(withings.date_utc)).filter(
+            withings.date_utc < start_date).scalar() or start_date)).statement, con=engine, index_col='date_utc')
+    session.close()
+    if len(df_weight) > 0:
+        df_weight.index = pd.to_datetime([utc_to_local(x) for x in df_weight.index]).normalize()
+        weight = df_weight['weight'].groupby(level=0).last()
+        df['weight'] = weight.reindex(weight.index.union(df.index)).ffill().loc[df.index]
+
+    df['athlete_id'] = athlete_id
+    df.index = df.index.date
+    df.index.name = 'date'
+    with get_engine().begin() as con:
+        db_upsert(df, 'daily_metrics', con=con)
+    return len(df)
+
+
+def truncate_daily_metrics(session, start_date=None):
+    '''
+    Delete daily_metrics rows on or after start_date (or all rows), so the next update rebuilds them
+    '''
+    if start_date is None:
+        session.execute(delete(dailyMetrics))
+    else:
+        session.execute(delete(dailyMetrics).where(dailyMetrics.date >= pd.to_datetime(start_date).date()))
@@ -1,9 +1,19 @@
-from ..api.stravaApi import get_strava_client, strava_connected
+from ..api.stravaApi import get_strava_client, strava_connected, strava_rate_limiter
+from ..api.stravaQueue import enqueue_activities, queued_activity_ids, dequeue_activities
+from ..api.jobQueue import report_progress
+from stravalib.exc import RateLimitExceeded, ObjectNotFound
 from ..api.ouraAPI import pull_oura_data
 from ..api.withingsAPI import pull_withings_data
 from ..api.fitbodAPI import pull_fitbod_data
+from ..api.sampleStore import delete_samples, delete_all_samples
+from ..api.dailyMetrics import update_daily_metrics, truncate_daily_metrics
+from ..api.bestEnvelope import update_best_envelope, truncate_best_envelope
+from ..api.samplePyramid import delete_pyramid
+from ..api.meanMaxPower import delete_pr_events
 from ..api.sqlalchemy_declarative import *
 from sqlalchemy import func, delete
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
 import datetime
 from ..api.fitlyAPI import *
 import pandas as pd
@@ -14,30 +24,161 @@ from ..utils import config, withings_credentials_supplied, oura_credentials_supp
 def latest_refresh():
     session, engine = db_connect()
     latest_date = session.query(func.max(dbRefreshStatus.timestamp_utc))[0][0]
-    engine.dispose()
     session.close()
     return latest_date
 
 
-def refresh_database(refresh_method='system', truncate=False, truncateDate=None):
+def source_timeout(source):
+    '''
+    Seconds a source pull may run before it is recorded as timed out, from [refresh] <source>_timeout in config.ini.
+    Strava has no timeout by default since a backfill can take hours, 0 disables the timeout
+    '''
+    timeout = float(config.get('refresh', source + '_timeout', fallback='0' if source == 'strava' else '600'))
+    return timeout if timeout > 0 else None
+
+
+def record_source_status(run_time, source, status):
+    session, engine = db_connect()
+    try:
+        session.query(dbRefreshStatus).filter(dbRefreshStatus.timestamp_utc == run_time).update(
+            {source + '_status': status[:255]}, synchronize_session=False)
+        session.commit()
+    except BaseException as e:
+        session.rollback()
+        app.server.logger.error(e)
+    session.close()
+
+
+def run_source_tasks(tasks, on_finish=None):
+    '''
+    Run source pulls concurrently, starting each one as soon as the sources it depends on have finished
+    :param tasks: {source: (function, [dependencies])}, function is called with {dependency: status} and returns a status
+    :param on_finish: called with (source, status) as each source finishes
+    :return: {source: status}
+    '''
+    statuses = {}
+    running = {}
+    waiting = dict(tasks)
+    # Pulls that time out can not be interrupted, so do not wait on them when shutting down
+    executor = ThreadPoolExecutor(max_workers=len(tasks))
+    try:
+        while len(waiting) > 0 or len(running) > 0:
+            for source, (function, dependencies) in list(waiting.items()):
+                if all(x in statuses for x in dependencies):
+                    timeout = source_timeout(source)
+                    running[executor.submit(function, {x: statuses[x] for x in dependencies})] = (
+                        source, None if timeout is None else time.monotonic() + timeout)
+                    del waiting[source]
+            if len(running) == 0:
+                raise ValueError('Unresolvable source dependencies: {}'.format(', '.join(waiting)))
+
+            deadlines = [deadline for source, deadline in running.values() if deadline is not None]
+            done, not_done = wait(list(running), return_when=FIRST_COMPLETED,
+                                  timeout=max(min(deadlines) - time.monotonic(), 0) if deadlines else None)
+            for future in list(running):
+                source, deadline = running[future]
+                if future in done:
+                    try:
+                        status = future.result()
+                    except BaseException as e:
+                        app.server.logger.error('Error pulling {} data: {}'.format(source, e))
+                        status = str(e)
+                elif deadline is not None and time.monotonic() >= deadline:
+                    app.server.logger.error('Timed out pulling {} data'.format(source))
+                    status = 'Timed out after {:.0f}s'.format(source_timeout(source))
+                else:
+                    continue
+                del running[future]
+                statuses[source] = status
+                if on_finish is not None:
+                    on_finish(source, status)
+    finally:
+        executor.shutdown(wait=False)
+    return statuses
+
+
+def discovery_start(athlete_id, full_sweep=False):
+    '''
+    Where to start listing strava activities: the latest ingested start date (or the oldest queued activity, whichever
+    is earlier) less [strava] discovery_window_days, so activities uploaded a few days after they were recorded are
+    still found. A full sweep lists everything since [strava] activities_after_date
+    :return: utc datetime or activities_after_date string
+    '''
+    after = config.get('strava', 'activities_after_date')
+    if full_sweep:
+        return after
+    session, engine = db_connect()
+    latest = session.query(func.max(stravaSummary.start_date_utc)).filter(
+        stravaSummary.athlete_id == athlete_id).scalar()
+    # Queue only keeps local start dates, which are within a day of utc and well inside the discovery window
+    earliest_queued = session.query(func.min(stravaActivityQueue.start_date_local)).filter(
+        stravaActivityQueue.athlete_id == athlete_id).scalar()
+    session.close()
+    if latest is None:
+        return after
+    cursor = min(latest, earliest_queued) if earliest_queued is not None else latest
+    cursor -= timedelta(days=float(config.get('strava', 'discovery_window_days', fallback='7')))
+    # Never list further back than a full sweep would
+    after_utc = pd.Timestamp(after)
+    after_utc = after_utc.tz_convert(None) if after_utc.tzinfo else after_utc
+    return max(cursor, after_utc.to_pydatetime())
+
+
+def pending_activities(client, listed, athlete_id):
+    '''
+    Queued activities to ingest, oldest first
+    :param listed: {activity id: activity} of new activities from this refresh's activity list
+    :return: FitlyActivity list
+    '''
+    pending = []
+    for activity_id in queued_activity_ids(athlete_id):
+        if activity_id in listed:
+            pending.append(FitlyActivity(listed[activity_id]))
+            continue
+        # Queued by an earlier refresh but not in this one's list (already ingested, or deleted on strava)
+        session, engine = db_connect()
+        ingested = session.query(stravaSummary.activity_id).filter(stravaSummary.activity_id == activity_id).first()
+        session.close()
+        if ingested:
+            dequeue_activities([activity_id])
+            continue
+        try:
+            pending.append(FitlyActivity(client.get_activity(activity_id)))
+        except ObjectNotFound:
+            app.server.logger.info('Queued activity id "{}" no longer on strava, removing from queue'.format(
+                activity_id))
+            dequeue_activities([activity_id])
+    return pending
+
+
+def refresh_database(refresh_method='system', truncate=False, truncateDate=None, full_sweep=False):
+    '''
+    :param full_sweep: list every strava activity since activities_after_date instead of only recent ones
+    '''
     session, engine = db_connect()
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
     # If athlete settings are defined
     if athlete_info.name and athlete_info.birthday and athlete_info.sex and athlete_info.weight_lbs and athlete_info.resting_hr and athlete_info.run_ftp and athlete_info.ride_ftp:
         # If either truncate parameter is passed
         if truncate or truncateDate:
+            report_progress('Truncating')
             session, engine = db_connect()
             # If only truncating past a certain date
             if truncateDate:
                 try:
+                    truncated_activity_ids = [x[0] for x in session.query(stravaSummary.activity_id).filter(
+                        stravaSummary.start_date_utc >= truncateDate).all()]
                     app.server.logger.debug('Truncating strava_summary')
                     session.execute(delete(stravaSummary).where(stravaSummary.start_date_utc >= truncateDate))
                     app.server.logger.debug('Truncating strava_samples')
                     session.execute(delete(stravaSamples).where(stravaSamples.timestamp_local >= truncateDate))
+                    app.server.logger.debug('Truncating strava_samples_pyramid')
+                    delete_pyramid(session, truncated_activity_ids)
                     app.server.logger.debug('Truncating strava_best_samples')
                     session.execute(delete(stravaBestSamples).where(stravaBestSamples.timestamp_local >= truncateDate))
+                    app.server.logger.debug('Truncating strava_pr_events')
+                    delete_pr_events(session, truncated_activity_ids)
                     app.server.logger.debug('Truncating oura_readiness_summary')
                     session.execute(
                         delete(ouraReadinessSummary).where(ouraReadinessSummary.report_date >= truncateDate))
@@ -50,11 +191,22 @@ def refresh_database(refresh_method='system', truncate=False, truncateDate=None)
                     app.server.logger.debug('Truncating oura_activity_samples')
                     session.execute(
                         delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= truncateDate))
+                    # Readiness and sleep report dates are summary_date + 1, so clear hashes from the day before
+                    app.server.logger.debug('Truncating oura_day_hash')
+                    session.execute(delete(ouraDayHash).where(
+                        ouraDayHash.day >= pd.to_datetime(truncateDate).date() - timedelta(days=1)))
                     app.server.logger.debug('Truncating hrv_workout_step_log')
                     session.execute(delete(hrvWorkoutStepLog).where(hrvWorkoutStepLog.date >= truncateDate))
                     app.server.logger.debug('Truncating withings')
                     session.execute(delete(withings).where(withings.date_utc >= truncateDate))
+                    app.server.logger.debug('Truncating daily_metrics')
+                    truncate_daily_metrics(session, truncateDate)
+                    app.server.logger.debug('Truncating strava_best_envelope')
+                    truncate_best_envelope(session)
                     session.commit()
+                    app.server.logger.debug('Truncating sample store')
+                    for activity_id in truncated_activity_ids:
+                        delete_samples(activity_id)
                 except BaseException as e:
                     session.rollback()
                     app.server.logger.error(e)
@@ -64,8 +216,12 @@ def refresh_database(refresh_method='system', truncate=False, truncateDate=None)
                     session.execute(delete(stravaSummary))
                     app.server.logger.debug('Truncating strava_samples')
                     session.execute(delete(stravaSamples))
+                    app.server.logger.debug('Truncating strava_samples_pyramid')
+                    delete_pyramid(session)
                     app.server.logger.debug('Truncating strava_best_samples')
                     session.execute(delete(stravaBestSamples))
+                    app.server.logger.debug('Truncating strava_pr_events')
+                    delete_pr_events(session)
                     app.server.logger.debug('Truncating oura_readiness_summary')
                     session.execute(delete(ouraReadinessSummary))
                     app.server.logger.debug('Truncating oura_sleep_summary')
@@ -76,126 +232,184 @@ def refresh_database(refresh_method='system', truncate=False, truncateDate=None)
                     session.execute(delete(ouraActivitySummary))
                     app.server.logger.debug('Truncating oura_activity_samples')
                     session.execute(delete(ouraActivitySamples))
+                    app.server.logger.debug('Truncating oura_day_hash')
+                    session.execute(delete(ouraDayHash))
                     app.server.logger.debug('Truncating hrv_workout_step_log')
                     session.execute(delete(hrvWorkoutStepLog))
                     app.server.logger.debug('Truncating withings')
                     session.execute(delete(withings))
                     app.server.logger.debug('Truncating fitbod')
                     session.execute(delete(fitbod))
+                    app.server.logger.debug('Truncating daily_metrics')
+                    truncate_daily_metrics(session)
+                    app.server.logger.debug('Truncating strava_best_envelope')
+                    truncate_best_envelope(session)
                     session.commit()
+                    app.server.logger.debug('Truncating sample store')
+                    delete_all_samples()
                 except BaseException as e:
                     session.rollback()
                     app.server.logger.error(e)
 
-            engine.dispose()
             session.close()
 
+        # Record the refresh up front and fill in each source's status as it finishes
+        run_time = datetime.utcnow()
+        session, engine = db_connect()
+        try:
+            session.add(dbRefreshStatus(timestamp_utc=run_time, oura_status='Running', fitbod_status='Running',
+                                        strava_status='Running', withings_status='Running', truncate=truncate,
+                                        refresh_method=refresh_method))
+            session.commit()
+        except BaseException as e:
+            session.rollback()
+            app.server.logger.error(e)
+        session.close()
+
         ### Pull Weight Data ###
 
-        # If withings credentials in config.ini, populate withings table
-        if withings_credentials_supplied:
-            try:
-                app.server.logger.info('Pulling withings data...')
-                pull_withings_data()
-                withings_status = 'Successful'
-            except BaseException as e:
-                app.server.logger.error('Error pulling withings data: {}'.format(e))
-                withings_status = str(e)
-        else:
-            withings_status = 'No Credentials'
+        def pull_withings(dependencies):
+            # If withings credentials in config.ini, populate withings table
+            if withings_credentials_supplied:
+                try:
+                    app.server.logger.info('Pulling withings data...')
+                    pull_withings_data()
+                    return 'Successful'
+                except BaseException as e:
+                    app.server.logger.error('Error pulling withings data: {}'.format(e))
+                    return str(e)
+            else:
+                return 'No Credentials'
 
         ### Pull Fitbod Data ###
 
-        # If nextcloud credentials in config.ini, pull fitbod data from nextcloud location
-        if nextcloud_credentials_supplied:
-            try:
-                app.server.logger.info('Pulling fitbod data...')
-                pull_fitbod_data()
-                fitbod_status = 'Successful'
-            except BaseException as e:
-                app.server.logger.error('Error pulling fitbod data: {}'.format(e))
-                fitbod_status = str(e)
-        else:
-            fitbod_status = 'No Credentials'
+        def pull_fitbod(dependencies):
+            # If nextcloud credentials in config.ini, pull fitbod data from nextcloud location
+            if nextcloud_credentials_supplied:
+                try:
+                    app.server.logger.info('Pulling fitbod data...')
+                    pull_fitbod_data()
+                    return 'Successful'
+                except BaseException as e:
+                    app.server.logger.error('Error pulling fitbod data: {}'.format(e))
+                    return str(e)
+            else:
+                return 'No Credentials'
 
         ### Pull Oura Data ###
 
-        if oura_credentials_supplied:
-            # Pull Oura Data before strava because resting heart rate used in strava sample heart rate zones
-            try:
-                app.server.logger.info('Pulling oura data...')
-                oura_status = pull_oura_data()
-                oura_status = 'Successful' if oura_status else 'Oura cloud not yet updated'
-            except BaseException as e:
-                app.server.logger.error('Error pulling oura data: {}'.format(e))
-                oura_status = str(e)
-        else:
-            oura_status = 'No Credentials'
+        def pull_oura(dependencies):
+            if oura_credentials_supplied:
+                try:
+                    app.server.logger.info('Pulling oura data...')
+                    oura_status = pull_oura_data()
+                    return 'Successful' if oura_status else 'Oura cloud not yet updated'
+                except BaseException as e:
+                    app.server.logger.error('Error pulling oura data: {}'.format(e))
+                    return str(e)
+            else:
+                return 'No Credentials'
 
         ### Pull Strava Data ###
 
-        # Only pull strava data if oura cloud has been updated with latest day, or no oura credentials so strava will use athlete static resting hr
-        if oura_status == 'Successful' or oura_status == 'No Credentials':
-            try:
-                app.server.logger.info('Pulling strava data...')
-
-                if strava_connected():
-                    athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
-                    client = get_strava_client()
-                    after = config.get('strava', 'activities_after_date')
-                    activities = client.get_activities(after=after, limit=0)  # Use after to sort from oldest to newest
-                    session, engine = db_connect()
-                    athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-                    min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
-                    # Loop through the activities, and create a dict of the dataframe stream data of each activity
-                    db_activities = pd.read_sql(
-                        sql=session.query(stravaSummary.activity_id).filter(
-                            stravaSummary.athlete_id == athlete_id).distinct(stravaSummary.activity_id).statement,
-                        con=engine)
-                    engine.dispose()
-                    session.close()
-                    new_activities = []
-                    for act in activities:
-                        # If not already in db, parse and insert
-                        if act.id not in db_activities['activity_id'].unique():
-                            new_activities.append(FitlyActivity(act))
-                            app.server.logger.info('New Workout found: "{}"'.format(act.name))
-                    # If new workouts found, analyze and insert
-                    if len(new_activities) > 0:
-                        for fitly_act in new_activities:
-                            fitly_act.stravaScrape(athlete_id=athlete_id)
-                    # Only run hrv training workflow if oura connection available to use hrv data
-                    if oura_status == 'Successful':
-                        hrv_training_workflow(min_non_warmup_workout_time=min_non_warmup_workout_time)
-
-                app.server.logger.debug('stravaScrape() complete...')
-                strava_status = 'Successful'
-            except BaseException as e:
-                app.server.logger.error('Error pulling strava data: {}'.format(e))
-                strava_status = str(e)
-        else:
-            app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
-            strava_status = 'Awaiting oura cloud update'
+        # Earliest day with new workouts, daily_metrics are recomputed from here
+        strava_results = {'metrics_start': None}
+
+        def pull_strava(dependencies):
+            oura_status = dependencies['oura']
+            # Only pull strava data if oura cloud has been updated with latest day, or no oura credentials so strava will use athlete static resting hr
+            if oura_status == 'Successful' or oura_status == 'No Credentials':
+                athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
+                try:
+                    app.server.logger.info('Pulling strava data...')
+                    report_progress('Listing strava activities')
+
+                    if strava_connected():
+                        client = get_strava_client()
+                        after = discovery_start(athlete_id, full_sweep)
+                        app.server.logger.debug('Listing strava activities after {}'.format(after))
+                        activities = client.get_activities(after=after,
+                                                           limit=0)  # Use after to sort from oldest to newest
+                        session, engine = db_connect()
+                        athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+                        min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
+                        # Loop through the activities, and create a dict of the dataframe stream data of each activity
+                        db_activities = pd.read_sql(
+                            sql=session.query(stravaSummary.activity_id).filter(
+                                stravaSummary.athlete_id == athlete_id).distinct(stravaSummary.activity_id).statement,
+                            con=engine)
+                        session.close()
+                        db_activity_ids = set(db_activities['activity_id'].unique())
+                        listed = {}
+                        seen = set()
+                        for act in activities:
+                            seen.add(act.id)
+                            # If not already in db, queue to parse and insert
+                            if act.id not in db_activity_ids:
+                                listed[act.id] = act
+                                app.server.logger.info('New Workout found: "{}"'.format(act.name))
+                        if full_sweep:
+                            missing = db_activity_ids - seen
+                            if len(missing) > 0:
+                                app.server.logger.warning(
+                                    '{} activities in strava_summary were not found on strava: {}'.format(
+                                        len(missing), sorted(missing)))
+                        enqueue_activities(listed.values(), athlete_id)
+                        # Work through everything queued, including activities left over from earlier refreshes
+                        new_activities = pending_activities(client, listed, athlete_id)
+                        # If new workouts found, analyze and insert
+                        if len(new_activities) > 0:
+                            strava_results['metrics_start'] = min(x.start_date_local for x in new_activities).date()
+                            scrape_activities(new_activities, athlete_id=athlete_id)
+                        # Only run hrv training workflow if oura connection available to use hrv data
+                        if oura_status == 'Successful':
+                            hrv_training_workflow(min_non_warmup_workout_time=min_non_warmup_workout_time)
+
+                    app.server.logger.debug('stravaScrape() complete...')
+                    return 'Successful'
+                except RateLimitExceeded as e:
+                    # Whatever is left stays queued for the next refresh
+                    app.server.logger.warning('Strava rate limit reached: {}'.format(e))
+                    resume_time = strava_rate_limiter.resume_time()
+                    return 'Rate limited, {} activities queued{}'.format(
+                        len(queued_activity_ids(athlete_id)),
+                        ' until {} UTC'.format(resume_time.strftime('%Y-%m-%d %H:%M')) if resume_time else '')
+                except BaseException as e:
+                    app.server.logger.error('Error pulling strava data: {}'.format(e))
+                    return str(e)
+            else:
+                app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
+                return 'Awaiting oura cloud update'
+
+        # Oura resting hr, withings weight and fitbod sets are all used when analyzing strava workouts
+        report_progress('Pulling oura, withings and fitbod')
+        statuses = run_source_tasks({
+            'withings': (pull_withings, []),
+            'fitbod': (pull_fitbod, []),
+            'oura': (pull_oura, []),
+            'strava': (pull_strava, ['oura', 'withings', 'fitbod']),
+        }, on_finish=lambda source, status: record_source_status(run_time, source, status))
+        metrics_start = strava_results['metrics_start']
+
+        ### Update Daily Metrics ###
 
-        session, engine = db_connect()
-        run_time = datetime.utcnow()
-        record = dbRefreshStatus(timestamp_utc=datetime.utcnow(), oura_status=oura_status, fitbod_status=fitbod_status,
-                                 strava_status=strava_status, withings_status=withings_status, truncate=truncate,
-                                 refresh_method=refresh_method)
-        # Insert and commit
         try:
-            session.add(record)
-            session.commit()
-            app.server.logger.info('Inserting records into db_refresh...')
+            app.server.logger.info('Updating daily metrics...')
+            report_progress('Updating daily metrics')
+            update_daily_metrics(metrics_start)
         except BaseException as e:
-            session.rollback()
-            print('Failed to insert db refresh status:', str(e))
-            app.server.logger.error(e)
+            app.server.logger.error('Error updating daily metrics: {}'.format(e))
 
-        app.server.logger.info('Refresh Complete')
+        # Roll the L90D/L6W power curve envelopes forward (and rebuild after a truncate)
+        try:
+            app.server.logger.info('Updating power curve envelope...')
+            report_progress('Updating power curve envelope')
+            update_best_envelope()
+        except BaseException as e:
+            app.server.logger.error('Error updating power curve envelope: {}'.format(e))
 
-        engine.dispose()
-        session.close()
+        app.server.logger.info('Refresh Complete: {}'.format(
+            ', '.join('{} {}'.format(source, status) for source, status in statuses.items())))
 
         return run_time
 
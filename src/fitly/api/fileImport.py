@@ -0,0 +1,530 @@
+import gzip
+import io
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+import fitparse
+import numpy as np
+import pandas as pd
+from ..api.sqlalchemy_declarative import db_connect, stravaSummary
+from ..api.fitlyAPI import FitlyActivity, ActivityAnalysis, analysis_pipeline, apply_batch_ftp_tests, \
+    build_samples_frame, strava_workers, mps_to_mph, meters_to_feet
+from ..api.asOfIndex import load_ingestion_index
+from ..api.stravaQueue import dequeue_activities
+from ..api.dailyMetrics import update_daily_metrics
+from ..api.strydAPI import get_stryd_df_summary
+from ..api.jobQueue import report_progress
+from ..app import app
+from ..utils import stryd_credentials_supplied
+
+# Load history from a Strava account export (the zip, or the folder it unzips to) or any folder of FIT/GPX/TCX files,
+# without the API. Files are parsed into the same streams Strava returns and analyzed like newly pulled activities.
+# Activity ids, names and types come from the export's activities.csv, then from file names like 1234567.fit.gz.
+
+activity_file_pattern = re.compile(r'\.(fit|gpx|tcx)(\.gz)?$', re.IGNORECASE)
+
+# Files parsed, analyzed and written per batch, so a multi-year export is never held in memory at once
+import_batch_size = 100
+
+# Gaps between samples longer than this (auto pause, smart recording while stopped) do not count as moving time
+pause_seconds = 30
+
+# Files without a strava id that start within this many seconds of a stored activity are the same activity
+duplicate_start_seconds = 60
+
+# First match in the file's sport (FIT sport and sub sport, TCX Sport, GPX type) sets the strava activity type
+sport_types = [('virtual', 'VirtualRide'), ('strength', 'WeightTraining'), ('weight', 'WeightTraining'),
+               ('e_bik', 'EBikeRide'), ('cycl', 'Ride'), ('bik', 'Ride'), ('ride', 'Ride'), ('run', 'Run'),
+               ('walk', 'Walk'), ('hik', 'Hike'), ('swim', 'Swim'), ('row', 'Rowing'), ('alpine', 'AlpineSki'),
+               ('ski', 'NordicSki')]
+trainer_sports = ['indoor', 'treadmill', 'virtual', 'trainer']
+
+# GPX and TCX trackpoint elements (namespaces stripped) read into points
+point_fields = {
+    # GPX, with garmin's TrackPointExtension
+    'time': 'timestamp', 'ele': 'altitude', 'hr': 'heartrate', 'cad': 'cadence', 'atemp': 'temp', 'power': 'watts',
+    'speed': 'speed',
+    # TCX, with the ActivityExtension TPX
+    'Time': 'timestamp', 'LatitudeDegrees': 'lat', 'LongitudeDegrees': 'lon', 'AltitudeMeters': 'altitude',
+    'DistanceMeters': 'distance', 'Value': 'heartrate', 'Cadence': 'cadence', 'RunCadence': 'cadence',
+    'Speed': 'speed', 'Watts': 'watts'
+}
+point_columns = ['lat', 'lon', 'distance', 'altitude', 'speed', 'heartrate', 'cadence', 'watts', 'temp']
+
+semicircles_to_degrees = 180 / 2 ** 31
+meters_to_miles = 1 / 1609.344
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def activity_format(name):
+    '''
+    :return: 'fit', 'gpx' or 'tcx', None if the file is not an activity file
+    '''
+    match = activity_file_pattern.search(name)
+    return match.group(1).lower() if match else None
+
+
+def file_activity_id(name):
+    # Strava export files are named after the activity id
+    match = re.match(r'(\d+)\.', os.path.basename(name))
+    return int(match.group(1)) if match else None
+
+
+def strava_type(sport):
+    '''
+    :param sport: sport as recorded in the file, i.e. 'cycling indoor_cycling' or 'Running'
+    :return: strava activity type, 'Workout' when the sport is not recognized
+    '''
+    sport = (sport or '').lower()
+    return next((strava for keyword, strava in sport_types if keyword in sport), 'Workout')
+
+
+def default_name(activity_type, start_date_local):
+    # Same names strava gives activities without a title, i.e. 'Morning Ride'
+    hour = start_date_local.hour
+    part = 'Night' if hour < 5 or hour >= 21 else 'Morning' if hour < 12 else 'Afternoon' if hour < 17 else 'Evening'
+    return '{} {}'.format(part, re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', activity_type))
+
+
+def read_export_csv(data, folder=''):
+    '''
+    :param data: contents of the export's activities.csv
+    :param folder: folder activities.csv is in, file names in it are relative to it
+    :return: {file path: activity metadata} for every activity with a file
+    '''
+    df = pd.read_csv(io.BytesIO(data), dtype=str).fillna('')
+    metadata = {}
+    for _, row in df[df['Filename'] != ''].iterrows():
+        metadata[os.path.normpath(os.path.join(folder, row['Filename']))] = {
+            'activity_id': int(row['Activity ID']),
+            'name': row.get('Activity Name') or None,
+            # 'Virtual Ride' and 'E-Bike Ride' are 'VirtualRide' and 'EBikeRide' in the API
+            'type': re.sub(r'[\s-]', '', row.get('Activity Type', '')) or None,
+            'description': row.get('Activity Description') or None,
+            'commute': row.get('Commute', '').lower() == 'true',
+            'start_date_utc': pd.to_datetime(row.get('Activity Date'), errors='coerce')
+        }
+    return metadata
+
+
+def list_activity_files(path):
+    '''
+    Activity files in a Strava export zip or a folder, with metadata from activities.csv where there is one
+    :return: list of (source, metadata) where source is (zip path or None, file path), oldest activity first
+    '''
+    files, metadata = [], {}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if os.path.basename(name) == 'activities.csv':
+                    metadata.update(read_export_csv(archive.read(name), os.path.dirname(name)))
+                elif activity_format(name):
+                    files.append((path, name))
+    else:
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                if name == 'activities.csv':
+                    with open(os.path.join(root, name), 'rb') as f:
+                        metadata.update(read_export_csv(f.read(), root))
+                elif activity_format(name):
+                    files.append((None, os.path.join(root, name)))
+
+    listed = []
+    for source in files:
+        meta = dict(metadata.get(os.path.normpath(source[1]), {}))
+        meta.setdefault('activity_id', file_activity_id(source[1]))
+        listed.append((source, meta))
+    # Personal bests and ftp tests are compared against earlier activities, so write them in order where it is known
+    return sorted(listed, key=file_order)
+
+
+def file_order(item):
+    source, meta = item
+    start = meta.get('start_date_utc', pd.NaT)
+    return pd.isnull(start), start if not pd.isnull(start) else pd.Timestamp.min, meta['activity_id'] or 0, source[1]
+
+
+def read_source(source):
+    archive, name = source
+    if archive is not None:
+        with zipfile.ZipFile(archive) as z:
+            data = z.read(name)
+    else:
+        with open(name, 'rb') as f:
+            data = f.read()
+    return gzip.decompress(data) if name.lower().endswith('.gz') else data
+
+
+def fit_points(data):
+    '''
+    :return: (df of points, file info) from a FIT file
+    '''
+    info = {'sport': '', 'calories': None, 'device_name': None, 'utc_offset': None}
+    records = []
+    for message in fitparse.FitFile(io.BytesIO(data), check_crc=False).get_messages(
+            ['record', 'session', 'activity', 'file_id']):
+        values = message.get_values()
+        if message.name == 'record':
+            records.append(values)
+        elif message.name == 'session':
+            info['sport'] += ' {} {}'.format(values.get('sport') or '', values.get('sub_sport') or '')
+            if values.get('total_calories') is not None:
+                info['calories'] = (info['calories'] or 0) + values['total_calories']
+        elif message.name == 'activity':
+            if values.get('local_timestamp') is not None and values.get('timestamp') is not None:
+                info['utc_offset'] = values['local_timestamp'] - values['timestamp']
+        elif message.name == 'file_id':
+            product = values.get('garmin_product') or values.get('product')
+            info['device_name'] = ' '.join(str(x) for x in [values.get('manufacturer'), product] if x is not None) or None
+
+    df = pd.DataFrame.from_records(records)
+    for preferred, field in [('enhanced_altitude', 'altitude'), ('enhanced_speed', 'speed')]:
+        if preferred in df.columns:
+            df[field] = df[preferred].fillna(df[field]) if field in df.columns else df[preferred]
+    df = df.rename(columns={'position_lat': 'lat', 'position_long': 'lon', 'heart_rate': 'heartrate',
+                            'power': 'watts', 'temperature': 'temp'})
+    for col in ['lat', 'lon']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce') * semicircles_to_degrees
+    return df, info
+
+
+def xml_points(data, fmt):
+    '''
+    :return: (df of points, file info) from a GPX or TCX file
+    '''
+    info = {'sport': '', 'calories': None, 'device_name': None, 'utc_offset': None, 'name': None}
+    point_tag = 'trkpt' if fmt == 'gpx' else 'Trackpoint'
+    points = []
+    # Strava's TCX files start with whitespace, which is not valid before the xml declaration
+    for event, element in ET.iterparse(io.BytesIO(data.lstrip()), events=('end',)):
+        tag = local_name(element.tag)
+        if tag == point_tag:
+            point = {k: v for k, v in element.attrib.items() if k in ['lat', 'lon']}
+            for child in element.iter():
+                field = point_fields.get(local_name(child.tag))
+                if field is not None and child.text is not None and child.text.strip():
+                    point[field] = child.text.strip()
+            points.append(point)
+            element.clear()
+        elif tag == 'trk':
+            for child in element:
+                if local_name(child.tag) == 'name' and child.text:
+                    info['name'] = child.text.strip()
+                elif local_name(child.tag) == 'type' and child.text:
+                    info['sport'] += ' ' + child.text.strip()
+        elif tag == 'Activity':
+            info['sport'] += ' ' + element.get('Sport', '')
+        elif tag == 'Calories' and element.text:
+            info['calories'] = (info['calories'] or 0) + float(element.text)
+        elif tag == 'Creator':
+            name = next((x.text for x in element if local_name(x.tag) == 'Name'), None)
+            info['device_name'] = name.strip() if name else None
+
+    df = pd.DataFrame.from_records(points)
+    if 'timestamp' in df.columns:
+        try:
+            df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+        except ValueError:
+            # pandas 2+ infers one format from the first point, some files mix whole and fractional seconds
+            df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True, format='ISO8601')
+        df['timestamp'] = df['timestamp'].dt.tz_localize(None)
+    return df, info
+
+
+def track_distance(lat, lon):
+    '''
+    :return: cumulative great circle distance in meters along the track, nan if it has no positions
+    '''
+    lat = np.radians(pd.Series(lat).ffill().bfill().to_numpy(dtype=float))
+    lon = np.radians(pd.Series(lon).ffill().bfill().to_numpy(dtype=float))
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return np.concatenate([[0], np.cumsum(2 * 6371008.8 * np.arcsin(np.sqrt(a)))])
+
+
+def point_streams(df):
+    '''
+    Turn file points into the streams strava would return for the activity (metric units, seconds from the start)
+    :param df: points with a timestamp (naive utc) column and any of point_columns
+    :return: (start_date_utc, {stream type: np array})
+    '''
+    df = df.dropna(subset=['timestamp']).sort_values('timestamp').drop_duplicates(subset='timestamp')
+    if len(df) == 0:
+        raise ValueError('No timestamped points')
+    df = df.reindex(columns=['timestamp'] + point_columns)
+    for col in point_columns:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    start = df['timestamp'].iloc[0]
+    seconds = (df['timestamp'] - start).dt.total_seconds().to_numpy()
+    time = seconds.astype('int64')
+    streams = {'time': time}
+    for col in ['heartrate', 'cadence', 'watts', 'temp', 'altitude']:
+        streams[col] = df[col].to_numpy(dtype=float)
+    has_position = df['lat'].notnull() & df['lon'].notnull()
+    if has_position.any():
+        streams['latlng'] = np.where(has_position.to_numpy()[:, None], df[['lat', 'lon']].to_numpy(dtype=float),
+                                     np.nan)
+
+    distance = df['distance'].to_numpy(dtype=float)
+    if np.isnan(distance).all() and has_position.any():
+        distance = track_distance(df['lat'], df['lon'])
+    streams['distance'] = distance
+
+    speed = df['speed'].to_numpy(dtype=float)
+    if np.isnan(speed).all() and not np.isnan(distance).all() and len(time) > 1:
+        speed = np.gradient(pd.Series(distance).interpolate(limit_direction='both').to_numpy(), seconds)
+    streams['velocity_smooth'] = speed
+
+    # Percent grade over the last 5 points, where the track moved
+    rise = pd.Series(streams['altitude']).diff(5)
+    run = pd.Series(distance).diff(5)
+    streams['grade_smooth'] = (rise / run.where(run > 1) * 100).clip(-50, 50).fillna(0).to_numpy()
+
+    with np.errstate(invalid='ignore'):
+        streams['moving'] = ((np.nan_to_num(speed) > .5) | (np.nan_to_num(streams['watts']) > 0) |
+                             (np.nan_to_num(streams['cadence']) > 0)).astype(float)
+    return start, streams
+
+
+def stream_stat(func, values):
+    # None when the activity does not have the stream, as the strava api returns it
+    values = np.asarray(values, dtype=float)
+    return None if len(values) == 0 or np.isnan(values).all() else float(func(values))
+
+
+def parse_activity_file(source, metadata, timezone):
+    '''
+    Parse an activity file into everything ImportedActivity needs, run in a process pool
+    :param source: (zip path or None, file path)
+    :param metadata: activity id, name, type, description and commute from activities.csv, where known
+    :param timezone: timezone for start_date_local when the file does not record its utc offset
+    :return: dict of ImportedActivity attributes
+    '''
+    fmt = activity_format(source[1])
+    data = read_source(source)
+    df, info = fit_points(data) if fmt == 'fit' else xml_points(data, fmt)
+    if 'timestamp' not in df.columns:
+        raise ValueError('No timestamped points')
+    start_date, streams = point_streams(df)
+
+    if info['utc_offset'] is not None:
+        # Rounded to the quarter hour, the offset is the difference of two timestamps written a moment apart
+        offset = pd.Timedelta(info['utc_offset']).round('15min')
+        start_date_local = start_date + offset
+        tz_name = 'UTC{}{:02d}:{:02d}'.format('-' if offset < pd.Timedelta(0) else '+',
+                                              int(abs(offset).total_seconds()) // 3600,
+                                              int(abs(offset).total_seconds()) % 3600 // 60)
+    else:
+        start_date_local = start_date.tz_localize('UTC').tz_convert(timezone).tz_localize(None)
+        tz_name = timezone
+
+    activity_type = metadata.get('type') or strava_type(info['sport'])
+    name = metadata.get('name') or info.get('name') or default_name(activity_type, start_date_local)
+    activity_id = metadata.get('activity_id')
+    if activity_id is None:
+        # Negative so it can never collide with a strava id
+        activity_id = -int(start_date.timestamp())
+
+    time = streams['time']
+    elapsed = np.diff(time, prepend=0)
+    moving = (streams['moving'] == 1) & (elapsed <= pause_seconds)
+    moving_time = int(elapsed[moving].sum())
+    distance = stream_stat(np.nanmax, streams['distance']) or 0.
+    watts = streams['watts'][moving] if moving.any() else streams['watts']
+    average_watts = stream_stat(np.nanmean, watts)
+    altitude = pd.Series(streams['altitude']).rolling(5, center=True, min_periods=1).mean().diff()
+    latlng = streams.get('latlng')
+    positions = latlng[~np.isnan(latlng).any(axis=1)] if latlng is not None else np.empty((0, 2))
+
+    df_summary = pd.DataFrame({
+        'activity_id': [activity_id],
+        'start_lat': [positions[0][0] if len(positions) > 0 else None],
+        'start_lon': [positions[0][1] if len(positions) > 0 else None],
+        'end_lat': [positions[-1][0] if len(positions) > 0 else None],
+        'end_lon': [positions[-1][1] if len(positions) > 0 else None],
+        'achievement_count': [None],
+        'average_heartrate': [stream_stat(np.nanmean, streams['heartrate'])],
+        'average_speed': [distance / moving_time * mps_to_mph if moving_time > 0 else 0.],
+        'average_watts': [average_watts],
+        'calories': [info['calories']],
+        'commute': [metadata.get('commute', False)],
+        'description': [metadata.get('description')],
+        'device_name': [info['device_name']],
+        'distance': [distance * meters_to_miles],
+        'elapsed_time': [int(time[-1])],
+        'gear_id': [None],
+        'kilojoules': [average_watts * moving_time / 1000 if average_watts is not None else None],
+        'location_city': [None],
+        'location_country': [None],
+        'location_state': [None],
+        'max_heartrate': [stream_stat(np.nanmax, streams['heartrate'])],
+        'max_speed': [(stream_stat(np.nanmax, streams['velocity_smooth']) or 0.) * mps_to_mph],
+        'max_watts': [stream_stat(np.nanmax, streams['watts'])],
+        'moving_time': [moving_time],
+        'name': [name],
+        'pr_count': [None],
+        'start_date_local': [start_date_local.to_pydatetime()],
+        'start_date_utc': [start_date.to_pydatetime()],
+        'start_day_local': [start_date_local.date()],
+        'timezone': [tz_name],
+        'total_elevation_gain': [altitude[altitude > 0].sum() * meters_to_feet],
+        'trainer': [len(positions) == 0 or any(x in info['sport'].lower() for x in trainer_sports)],
+        'type': [activity_type]
+    }).set_index('start_date_utc')
+
+    df_samples = build_samples_frame(
+        {k: (v.tolist() if k == 'latlng' else v) for k, v in streams.items()}, start_date_local)
+    df_samples['activity_id'] = activity_id
+    df_samples['act_name'] = name
+    return {
+        'id': activity_id,
+        'type': activity_type,
+        'name': name,
+        'start_date': start_date.to_pydatetime(),
+        'start_date_local': start_date_local.to_pydatetime(),
+        'max_watts': df_summary['max_watts'].iloc[0],
+        'max_heartrate': df_summary['max_heartrate'].iloc[0],
+        'average_watts': average_watts,
+        'df_summary': df_summary,
+        'df_samples': df_samples
+    }
+
+
+class ImportedActivity(ActivityAnalysis):
+    '''
+    An activity parsed from a file, analyzed and written with the same steps as one pulled from strava
+    '''
+    assign_athlete = FitlyActivity.assign_athlete
+    get_ftp = FitlyActivity.get_ftp
+    get_rest_hr = FitlyActivity.get_rest_hr
+    get_weight = FitlyActivity.get_weight
+    add_summary_analytics = FitlyActivity.add_summary_analytics
+    write_dfs_to_db = FitlyActivity.write_dfs_to_db
+
+    def __init__(self, parsed):
+        '''
+        :param parsed: parse_activity_file() result
+        '''
+        for attr, value in parsed.items():
+            setattr(self, attr, value)
+        # nan from the summary frame means the file has no power/heartrate
+        self.max_watts = None if pd.isnull(self.max_watts) else float(self.max_watts)
+        self.max_heartrate = None if pd.isnull(self.max_heartrate) else float(self.max_heartrate)
+
+    def prepare(self, athlete_id, index, as_of):
+        self.assign_athlete(athlete_id, index.athlete_info)
+        self.get_ftp(as_of, index.stryd_df)
+        self.get_rest_hr(as_of)
+        self.get_weight(as_of)
+
+
+def default_timezone(athlete_id=1):
+    '''
+    :return: timezone of the athlete's latest activity, UTC if there is none
+    '''
+    session, engine = db_connect()
+    latest = session.query(stravaSummary.timezone).filter(stravaSummary.athlete_id == athlete_id,
+                                                          stravaSummary.timezone.isnot(None)).order_by(
+        stravaSummary.start_date_utc.desc()).first()
+    session.close()
+    # Stored as i.e. '(GMT-05:00) America/New_York' or 'America/New_York'
+    timezone = latest[0].split(' ')[-1] if latest else 'UTC'
+    try:
+        pd.Timestamp.now(tz=timezone)
+    except Exception:
+        timezone = 'UTC'
+    return timezone
+
+
+def started_near(starts, start_date):
+    '''
+    :param starts: sorted DatetimeIndex of stored start dates
+    :return: True if a stored activity started within duplicate_start_seconds of start_date
+    '''
+    start_date = pd.Timestamp(start_date)
+    # The stored starts either side of where this one would go are the nearest, duplicate starts are fine
+    i = starts.searchsorted(start_date)
+    neighbors = starts[max(i - 1, 0):i + 1]
+    return bool((abs(neighbors - start_date) < pd.Timedelta(seconds=duplicate_start_seconds)).any())
+
+
+def import_activities(path, athlete_id=1, workers=None, timezone=None):
+    '''
+    Import every activity file in a Strava export or folder that is not already in strava_summary
+    :param path: Strava export zip, or a folder of FIT/GPX/TCX files (optionally gzipped)
+    :param workers: files parsed and analyzed in parallel, defaults to [strava] workers in config.ini
+    :param timezone: timezone of activities whose files do not record one, defaults to that of the latest activity
+    :return: (activities imported, duplicates skipped, files that could not be parsed)
+    '''
+    workers = strava_workers if workers is None else workers
+    timezone = default_timezone(athlete_id) if timezone is None else timezone
+    session, engine = db_connect()
+    stored = session.query(stravaSummary.activity_id, stravaSummary.start_date_utc).all()
+    session.close()
+    stored_ids = set(x[0] for x in stored)
+    stored_starts = pd.DatetimeIndex([x[1] for x in stored]).sort_values()
+
+    files = list_activity_files(path)
+    pending = [(source, meta) for source, meta in files if meta['activity_id'] not in stored_ids]
+    duplicates = len(files) - len(pending)
+    app.server.logger.info('Importing {} activity files from {} ({} already imported)'.format(
+        len(pending), path, duplicates))
+
+    imported, failed, earliest = 0, 0, None
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for batch_start in range(0, len(pending), import_batch_size):
+            batch = pending[batch_start:batch_start + import_batch_size]
+            futures = [pool.submit(parse_activity_file, source, meta, timezone) for source, meta in batch]
+            activities = []
+            for (source, meta), future in zip(batch, futures):
+                try:
+                    activity = ImportedActivity(future.result())
+                except Exception as e:
+                    app.server.logger.warning('Could not import {}: {}'.format(source[1], e))
+                    failed += 1
+                    continue
+                # Also catches files without a strava id that were already pulled from the api
+                if activity.id in stored_ids or started_near(stored_starts, activity.start_date):
+                    duplicates += 1
+                    continue
+                stored_ids.add(activity.id)
+                stored_starts = stored_starts.insert(stored_starts.searchsorted(activity.start_date),
+                                                     pd.Timestamp(activity.start_date))
+                activities.append(activity)
+            if len(activities) == 0:
+                continue
+            activities.sort(key=lambda x: x.start_date_local)
+
+            # Loaded per batch so ftp tests imported in earlier batches apply
+            index = load_ingestion_index(athlete_id)
+            if stryd_credentials_supplied and any(
+                    'run' in x.type.lower() or 'walk' in x.type.lower() for x in activities):
+                index.stryd_df = get_stryd_df_summary()
+            as_of = index.activity_values(activities)
+
+            def prepare(i, activity):
+                activity.prepare(athlete_id, index, as_of.loc[activity.id])
+                apply_batch_ftp_tests(activity, activities[:i])
+
+            def write(activity):
+                nonlocal imported
+                app.server.logger.debug('Activity id "{}": Writing imported activity to DB'.format(activity.id))
+                activity.write_dfs_to_db()
+                # No need to pull it from strava any more
+                dequeue_activities([activity.id])
+                imported += 1
+                report_progress('Importing activity files', imported, len(pending))
+
+            analysis_pipeline(activities, prepare, write, workers)
+            first_day = activities[0].start_date_local.date()
+            earliest = first_day if earliest is None else min(earliest, first_day)
+
+    if earliest is not None:
+        report_progress('Updating daily metrics')
+        update_daily_metrics(earliest, athlete_id=athlete_id)
+    return imported, duplicates, failed
@@ -84,7 +84,6 @@ def pull_fitbod_data():
         # Insert fitbod table into DB
         df.to_sql('fitbod', engine, if_exists='append', index=False)
         session.commit()
-        engine.dispose()
         session.close()
         # Delete file in local folder
         os.remove(filename)
@@ -1,14 +1,29 @@
 from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pickle
 import numpy as np
-from ..api.sqlalchemy_declarative import db_connect, ouraSleepSummary, withings, athlete, db_insert, stravaSummary, \
-    fitbod, hrvWorkoutStepLog
-from sqlalchemy import func, cast, Date
-from sweat.io.models.dataframes import WorkoutDataFrame, Athlete
+from ..api.sqlalchemy_declarative import db_connect, ouraSleepSummary, athlete, db_insert, stravaSummary, \
+    fitbod, hrvWorkoutStepLog, db_bulk_insert, stravaSamples, stravaBestSamples
+from sqlalchemy import func, cast, Date, delete
 from sweat.pdm import critical_power
 from sweat.metrics.core import weighted_average_power
 from sweat.metrics.power import *
 import stravalib
 from ..api.stravaApi import get_strava_client
+from ..api.streamCache import cached_streams
+from ..api.stravaQueue import dequeue_activities
+from ..api.jobQueue import report_progress
+from ..api.sampleStore import sample_store_enabled, write_samples, delete_samples, stream_dtypes, epoch
+from ..api.bestEnvelope import update_best_envelope, truncate_best_envelope
+from ..api.meanMaxPower import mean_max_power, personal_bests, delete_pr_events
+from ..api.asOfIndex import load_ingestion_index
+from ..api.samplePyramid import build_pyramid, delete_pyramid
+from ..api.hrvWorkflow import hrv_thresholds, hrv_workout_steps, hrv_lookback_days
+from ..api.dailyMetrics import hrv_baselines
+from ..api.trainingZones import classify_zones, power_zone_thresholds, heartrate_zone_thresholds, zone_sport, \
+    zone_intensities, intensity_buckets
 from stravalib import unithelper
 from ..api.pelotonApi import peloton_mapping_df, roundTime, set_peloton_workout_recommendations
 from ..api.strydAPI import get_stryd_df_summary
@@ -19,13 +34,73 @@ from ..utils import peloton_credentials_supplied, stryd_credentials_supplied, co
 types = ['time', 'latlng', 'distance', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp',
          'moving', 'grade_smooth']
 
+# Activities analyzed in parallel by scrape_activities(), 1 processes them one at a time
+strava_workers = int(config.get('strava', 'workers', fallback='1'))
 
-def calctime(time_sec, startdate):
-    try:
-        timestamp = startdate + timedelta(seconds=int(time_sec))
-    except BaseException as e:
-        timestamp = startdate
-    return timestamp
+
+# Strava streams are metric, samples are stored in mph and feet
+mps_to_mph = 3600 / 1609.344
+meters_to_feet = 1 / .3048
+
+
+def resample_stream(values, positions, length):
+    '''
+    Average the values landing in each bucket and linearly interpolate empty buckets, holding the first/last value at
+    either end (same as resample().mean().interpolate(limit_direction='both'))
+    :param positions: bucket of each value
+    :return: np array of one value per bucket, all nan if values has none
+    '''
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return np.full(length, np.nan)
+    counts = np.bincount(positions[valid], minlength=length)
+    sums = np.bincount(positions[valid], weights=values[valid], minlength=length)
+    filled = counts > 0
+    buckets = np.arange(length)
+    return np.interp(buckets, buckets[filled], sums[filled] / counts[filled])
+
+
+def build_samples_frame(streams, start_date_local, seconds=1):
+    '''
+    Turn raw strava streams into evenly spaced samples, with gaps interpolated and units converted
+    :param streams: {stream type: list of values}, as returned from get_activity_streams()
+    :param start_date_local: start of the activity, 'time' stream values are seconds after it
+    :return: df indexed on timestamp_local with a column for every stream type (nan when the activity does not have
+    it), in the compact dtypes of the sample store
+    '''
+    # Unparseable times are placed at the start of the activity
+    time = pd.to_numeric(pd.Series(streams.get('time', []), dtype=object), errors='coerce').fillna(0).to_numpy(
+        dtype='int64')
+    first = time.min() // seconds * seconds if len(time) > 0 else 0
+    positions = (time - first) // seconds
+    length = positions.max() + 1 if len(time) > 0 else 0
+
+    columns = {'time': first + np.arange(length) * seconds}
+    for item in types:
+        if item in ['time', 'latlng']:
+            continue
+        values = pd.to_numeric(pd.Series(streams[item], dtype=object), errors='coerce').to_numpy(
+            dtype=float) if item in streams else np.full(len(time), np.nan)
+        columns[item] = resample_stream(values, positions, length)
+    # Parse latlngs into seperate columns
+    latlng = np.array([x if isinstance(x, (list, tuple)) and len(x) == 2 else (np.nan, np.nan) for x in
+                       streams.get('latlng', [(np.nan, np.nan)] * len(time))], dtype=float).reshape(-1, 2)
+    columns['latitude'] = resample_stream(latlng[:, 0], positions, length)
+    columns['longitude'] = resample_stream(latlng[:, 1], positions, length)
+
+    # Convert celcius to farenheit, meters per second to mph and meters to feet
+    columns['temp'] = columns['temp'] * 9 / 5 + 32
+    columns['velocity_smooth'] = columns['velocity_smooth'] * mps_to_mph
+    columns['distance'] = columns['distance'] * meters_to_feet
+    columns['altitude'] = columns['altitude'] * meters_to_feet
+
+    index = pd.DatetimeIndex(pd.Timestamp(start_date_local) + pd.to_timedelta(columns['time'], unit='s'),
+                             name='timestamp_local')
+    df = pd.DataFrame({col: values.astype(stream_dtypes.get(col, 'float64')) for col, values in columns.items()},
+                      index=index)
+    df['time_interval'] = epoch + pd.to_timedelta(columns['time'], unit='s')
+    df['date'] = df.index.date
+    return df
 
 
 class FitlyActivity(stravalib.model.Activity):
@@ -34,10 +109,21 @@ class FitlyActivity(stravalib.model.Activity):
         activity.__class__ = FitlyActivity
         return activity
 
-    def stravaScrape(self, athlete_id):
+    def stravaScrape(self, athlete_id, index=None, as_of=None, replace=False):
+        self.fetch(athlete_id, index, as_of)
+        self.analyze()
+        # Write df_summary, df_samples and df_best_samples to db
+        app.server.logger.debug('Activity id "{}": Writing df_summary, df_samples and best samples to DB'.format(self.id))
+        self.write_dfs_to_db(replace=replace)
+
+    def fetch(self, athlete_id, index=None, as_of=None):
+        # I/O bound steps of stravaScrape()
+        # Resting hr, weight and ftp are looked up in the ingestion index, pass one in when fetching many activities
+        index = load_ingestion_index(athlete_id) if index is None else index
+        as_of = index.activity_values([self]).iloc[0] if as_of is None else as_of
         # # Set up athlete for the workout
         app.server.logger.debug('Activity id "{}": Assigning athlete id {}'.format(self.id, athlete_id))
-        self.assign_athlete(athlete_id)
+        self.assign_athlete(athlete_id, index.athlete_info)
         # Update strava names of peloton workouts
         if peloton_credentials_supplied:
             app.server.logger.debug('Activity id "{}": Pulling peloton title'.format(self.id))
@@ -50,13 +136,17 @@ class FitlyActivity(stravalib.model.Activity):
         self.build_df_summary()
         # Get FTP
         app.server.logger.debug('Activity id "{}": Pulling ftp'.format(self.id))
-        self.get_ftp()
+        self.get_ftp(as_of, index.stryd_df)
         # Get most recent resting heart rate
         app.server.logger.debug('Activity id "{}": Pulling resting hr'.format(self.id))
-        self.get_rest_hr()
+        self.get_rest_hr(as_of)
         # Get most recent weight
         app.server.logger.debug('Activity id "{}": Pulling weight'.format(self.id))
-        self.get_weight()
+        self.get_weight(as_of)
+        return self
+
+    def analyze(self):
+        # CPU bound steps of stravaScrape(), also run on an ActivityAnalysis in a process pool
         # Calculate power zones
         app.server.logger.debug('Activity id "{}": Calculating power zones'.format(self.id))
         self.calculate_power_zones()
@@ -69,18 +159,17 @@ class FitlyActivity(stravalib.model.Activity):
         # Get summary analytics
         app.server.logger.debug('Activity id "{}": Calculating summary analytics'.format(self.id))
         self.get_summary_analytics()
-        # Write strava_best_samples
-        app.server.logger.debug('Activity id "{}": Writing mean max power to DB'.format(self.id))
+        # Build strava_best_samples
+        app.server.logger.debug('Activity id "{}": Computing mean max power'.format(self.id))
         self.compute_mean_max_power(dbinsert=True)
-        # Write df_summary and df_samples to db
-        app.server.logger.debug('Activity id "{}": Writing df_summary and df_samples to DB'.format(self.id))
-        self.write_dfs_to_db()
+        return self
 
-    def assign_athlete(self, athlete_id):
-        session, engine = db_connect()
-        self.Athlete = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-        engine.dispose()
-        session.close()
+    def assign_athlete(self, athlete_id, athlete_info=None):
+        if athlete_info is None:
+            session, engine = db_connect()
+            athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+            session.close()
+        self.Athlete = athlete_info
 
         self.hearrate_zones = {
             1: float(self.Athlete.hr_zone_threshold_1),
@@ -119,57 +208,35 @@ class FitlyActivity(stravalib.model.Activity):
             if write_to_strava and client.get_activity(activity_id=self.id).name != self.peloton_title:
                 client.update_activity(activity_id=self.id, name=self.peloton_title)
 
-    def get_rest_hr(self):
+    def get_rest_hr(self, as_of):
         # TODO: Build this out so hearrate data can be pulled from other data sources
-        # Assign rhr to activities by their start date
-        session, engine = db_connect()
-        # Try grabbing last resting heartrate from oura
-        hr_lowest = session.query(ouraSleepSummary.hr_lowest).filter(
-            ouraSleepSummary.report_date <= self.start_date.date()).order_by(
-            ouraSleepSummary.report_date.desc()).first()
-        # If activity is prior to first oura data record, use first oura data record
-        if not hr_lowest:
-            hr_lowest = \
-                session.query(ouraSleepSummary.hr_lowest).order_by(ouraSleepSummary.report_date.asc()).first()
-        engine.dispose()
-        session.close()
-
-        if hr_lowest:
-            self.hr_lowest = hr_lowest[0]
+        # Assign rhr to activities by their start date, from the last oura resting heartrate (or the first oura record
+        # if the activity is prior to it)
+        if not pd.isnull(as_of['hr_lowest']):
+            self.hr_lowest = int(as_of['hr_lowest'])
         # Resort to manaully entered static athlete resting heartrate if no data source to pull from
         else:
             self.hr_lowest = self.Athlete.resting_hr
 
-    def get_weight(self):
+    def get_weight(self, as_of):
         # TODO: Build this out so weight data can be pulled from other data sources
-        session, engine = db_connect()
-        # Try grabbing last weight in withings before current workout
-        weight = session.query(withings.weight).filter(withings.date_utc <= self.start_date).order_by(
-            withings.date_utc.desc()).first()
-        # Else try getting most recent weight from withings
-        if not weight:
-            weight = session.query(withings.weight).order_by(withings.date_utc.asc()).first()
-
-        engine.dispose()
-        session.close()
-
-        if weight:
-            weight = float(weight[0])
+        # Last weight in withings before current workout, else the earliest weight in withings
+        weight = None if pd.isnull(as_of['weight']) else float(as_of['weight'])
         # If no weights in withings, resort to manually entered static weight from athlete table
-
         if not weight:
             weight = self.Athlete.weight_lbs
 
         self.weight = weight
         self.kg = weight * 0.453592
 
-    def get_ftp(
-            self):  # TODO: Update with auto calculated critical power so users do not have to flag (or take) FTP tests
+    def get_ftp(self, as_of, stryd_df=None):
+        # TODO: Update with auto calculated critical power so users do not have to flag (or take) FTP tests
         self.stryd_metrics = []
+        self.ftp_test_date = None
         if 'run' in self.type.lower() or 'walk' in self.type.lower():
             # If stryd credentials in config, grab ftp
             if stryd_credentials_supplied:
-                stryd_df = get_stryd_df_summary()
+                stryd_df = get_stryd_df_summary() if stryd_df is None else stryd_df
                 start = roundTime(self.start_date_local)
                 # Save stryd df for current workout to instance to use metrics later and avoid having to hit API again
                 self.stryd_metrics = stryd_df[
@@ -186,14 +253,11 @@ class FitlyActivity(stravalib.model.Activity):
                 self.ftp = self.Athlete.run_ftp
         elif 'ride' in self.type.lower():
             # TODO: Switch over to using Critical Power for everything once we get the critical power model working
-            session, engine = db_connect()
-            try:
-                self.ftp = float(
-                    session.query(stravaSummary.average_watts).order_by(stravaSummary.start_date_local.desc()).filter(
-                        stravaSummary.start_date_local < self.start_date_local,
-                        stravaSummary.type.ilike('%ride%'),
-                        stravaSummary.name.ilike('%ftp test%')).first()[0]) * .95
-            except:
+            # Latest ride ftp test prior to current activity
+            if not pd.isnull(as_of['ftp_test_watts']):
+                self.ftp = float(as_of['ftp_test_watts']) * .95
+                self.ftp_test_date = pd.Timestamp(as_of['ftp_test_date']).to_pydatetime()
+            else:
                 # If no FTP test prior to current activity
                 self.ftp = self.Athlete.ride_ftp
 
@@ -230,7 +294,6 @@ class FitlyActivity(stravalib.model.Activity):
                 (date - timedelta(days=180)) <= fitbod.date_utc,
                 fitbod.date_utc <= date + timedelta(days=1)
             ).statement, con=engine)
-        engine.dispose()
         session.close()
 
         # If no workout data found, return None as a WSS score can not be generated
@@ -392,66 +455,13 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_summary.set_index(['start_date_utc'], inplace=True)
 
     def build_df_samples(self):
-        seconds = 1
-        streams = get_strava_client().get_activity_streams(self.id, types=types)
-        self.df_samples = pd.DataFrame(columns=types)
-        # Write each row to a dataframe
-        for item in types:
-            if item in streams.keys():
-                self.df_samples[item] = pd.Series(streams[item].data, index=None)
-        self.df_samples['start_date_local'] = self.start_date_local
-        self.df_samples['timestamp_local'] = pd.Series(
-            map(calctime, self.df_samples['time'], self.df_samples['start_date_local']))
-        self.df_samples.set_index('timestamp_local', inplace=True)
-
-        # Parse latlngs into seperate columns
-        try:
-            self.df_samples['latitude'] = self.df_samples['latlng'].apply(
-                lambda x: x[0] if isinstance(x, list) else None).apply(
-                pd.to_numeric,
-                errors='coerce')
-            self.df_samples['longitude'] = self.df_samples['latlng'].apply(
-                lambda x: x[1] if isinstance(x, list) else None).apply(
-                pd.to_numeric,
-                errors='coerce')
-        except KeyError:
-            self.df_samples['latitude'] = None
-            self.df_samples['longitude'] = None
-
-        # Interpolate samples - each workout in samples data should already be at 1s intervals, calling resample fills in gaps so mean() does not matter
-        self.df_samples = self.df_samples.resample(str(seconds) + 'S').mean()
-        self.df_samples = self.df_samples.interpolate(
-            limit_direction='both')  # TODO: Consider if interpolating of nans is skuing data too much
-
-        try:  # Indoor activity samples wont have altitudes
-            self.df_samples['altitude'] = self.df_samples['altitude'] * 3.28084
-        except KeyError:
-            self.df_samples['altitude'] = None
-
-        try:
-            # Convert celcius to farenheit
-            self.df_samples['temp'] = unithelper.c2f(self.df_samples['temp'])
-        except:
-            pass
+        def download():
+            # Raises RateLimitExceeded before the request once the daily limit is used up
+            return {item: stream.data for item, stream in
+                    get_strava_client().get_activity_streams(self.id, types=types).items() if item in types}
 
-        try:
-            # Convert meter per second to mph
-            self.df_samples['velocity_smooth'] = unithelper.mph(self.df_samples['velocity_smooth']).num
-        except:
-            pass
-        try:
-            # Convert meters to feet
-            self.df_samples['distance'] = unithelper.feet(self.df_samples['distance']).num
-        except:
-            pass
-
-        # Add Time Interval
-        epoch = pd.to_datetime('1970-01-01')
-        self.df_samples['time_interval'] = self.df_samples['time'].astype('int').apply(
-            lambda x: epoch + timedelta(seconds=x))
-
-        # Add date column
-        self.df_samples['date'] = self.df_samples.index.date
+        streams = cached_streams(self.id, types, download)
+        self.df_samples = build_samples_frame(streams, self.start_date_local)
         # Add activity id and name back in
         self.df_samples['activity_id'] = self.id
         self.df_samples['act_name'] = self.name
@@ -459,31 +469,8 @@ class FitlyActivity(stravalib.model.Activity):
     def calculate_power_zones(self):
         if self.max_watts is not None:
             if self.ftp is not None:
-                if 'ride' in self.type.lower():
-                    pz_5, pz_6 = self.power_zones[5], self.power_zones[6]
-                elif 'run' in self.type.lower() or 'walk' in self.type.lower():
-                    pz_5, pz_6 = 99, 99
-                self.df_samples['power_zone'] = np.nan
-
-                for i in self.df_samples.index:
-                    watts = self.df_samples.loc[i].watts
-                    if watts is not None:
-                        if watts <= round(self.ftp * self.power_zones[1]):
-                            self.df_samples.at[i, 'power_zone'] = 1
-                        elif watts <= round(self.ftp * self.power_zones[2]):
-                            self.df_samples.at[i, 'power_zone'] = 2
-                        elif watts <= round(self.ftp * self.power_zones[3]):
-                            self.df_samples.at[i, 'power_zone'] = 3
-                        elif watts <= round(self.ftp * self.power_zones[4]):
-                            self.df_samples.at[i, 'power_zone'] = 4
-                        elif watts <= round(self.ftp * pz_5):
-                            self.df_samples.at[i, 'power_zone'] = 5
-                        elif watts <= round(self.ftp * pz_6):
-                            self.df_samples.at[i, 'power_zone'] = 6
-                        else:
-                            self.df_samples.at[i, 'power_zone'] = 7
-                    else:
-                        return np.nan
+                self.df_samples['power_zone'] = classify_zones(
+                    self.df_samples['watts'], power_zone_thresholds(self.ftp, self.power_zones, zone_sport(self.type)))
 
     def calculate_heartate_zones(self):
         if self.max_heartrate is not None:
@@ -491,105 +478,49 @@ class FitlyActivity(stravalib.model.Activity):
             self.athlete_max_hr = 220 - age
             self.rhr = self.hr_lowest
             self.hrr = self.athlete_max_hr - self.rhr
-            z1 = round((self.hrr * self.hearrate_zones[1]) + self.rhr)
-            z2 = round((self.hrr * self.hearrate_zones[2]) + self.rhr)
-            z3 = round((self.hrr * self.hearrate_zones[3]) + self.rhr)
-            z4 = round((self.hrr * self.hearrate_zones[4]) + self.rhr)
-
-            self.df_samples['hr_zone'] = np.nan
-            for i in self.df_samples.index:
-                heartrate = self.df_samples.loc[i].heartrate
-                if heartrate is not None:
-                    if heartrate <= z1:
-                        self.df_samples.at[i, 'hr_zone'] = 1
-                    elif heartrate <= z2:
-                        self.df_samples.at[i, 'hr_zone'] = 2
-                    elif heartrate <= z3:
-                        self.df_samples.at[i, 'hr_zone'] = 3
-                    elif heartrate <= z4:
-                        self.df_samples.at[i, 'hr_zone'] = 4
-                    else:
-                        self.df_samples.at[i, 'hr_zone'] = 5
-                else:
-                    return np.nan
+            self.df_samples['hr_zone'] = classify_zones(
+                self.df_samples['heartrate'], heartrate_zone_thresholds(self.rhr, self.hrr, self.hearrate_zones))
 
     def calculate_zone_intensities(self):
-        df_zone_intensities = self.df_samples.copy()
-        df_zone_intensities = df_zone_intensities[df_zone_intensities['time'] != 0]
+        df_zone_intensities = self.df_samples[self.df_samples['time'] != 0]
         # Check if power data, if not use heartrate data
         metric = 'power' if self.max_watts is not None and self.ftp is not None else 'heartrate' if self.max_heartrate is not None else 'none'
 
-        for i in df_zone_intensities.index:
-            # Check if power or heartrate data
-            if metric == 'power':
-                # If power data, check if run zones or ride zones should be used
-                if 'run' in self.type.lower() or 'walk' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1,
-                                                                                               2] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 3 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [4, 5] else None
-                elif 'ride' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1, 2,
-                                                                                               3] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 4 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [5, 6, 7] else None
-            elif metric == 'heartrate':
-                df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                      i, 'hr_zone'] in [1,
-                                                                                        2] else 'med' if \
-                    df_zone_intensities.at[i, 'hr_zone'] == 3 else 'high' if df_zone_intensities.at[
-                                                                                 i, 'hr_zone'] in [4,
-                                                                                                   5] else None
-        if 'intensity' in df_zone_intensities.columns:
-            intensity_seconds = df_zone_intensities['intensity'].value_counts()
-            try:
-                self.df_summary['low_intensity_seconds'] = [intensity_seconds.low]
-            except AttributeError:
-                self.df_summary['low_intensity_seconds'] = None
-            try:
-                self.df_summary['med_intensity_seconds'] = [intensity_seconds.med]
-            except AttributeError:
-                self.df_summary['med_intensity_seconds'] = None
-            try:
-                self.df_summary['high_intensity_seconds'] = [intensity_seconds.high]
-            except AttributeError:
-                self.df_summary['high_intensity_seconds'] = None
+        # If power data, check if run zones or ride zones should be used
+        buckets = intensity_buckets.get(zone_sport(self.type)) if metric == 'power' else intensity_buckets[
+            'heartrate'] if metric == 'heartrate' else None
+        if buckets is not None and len(df_zone_intensities) > 0:
+            zones = df_zone_intensities['power_zone' if metric == 'power' else 'hr_zone']
+            intensity_seconds = zone_intensities(zones.to_numpy(), buckets).value_counts()
+            for intensity in ['low', 'med', 'high']:
+                self.df_summary[intensity + '_intensity_seconds'] = [
+                    intensity_seconds[intensity]] if intensity in intensity_seconds.index else None
 
     def compute_mean_max_power(self, dbinsert=False):
+        self.df_best_samples = None
         if self.max_watts is not None:
-            df = self.df_samples.copy()
-            df = df.rename(columns={"watts": "power", "velocity_smooth": "speed"})
-            self.mmp_df = pd.Series(WorkoutDataFrame(df).compute_mean_max_power(), name='mmp').to_frame()
-            # Update time index so it starts at 1 second (instead of 0)
-            self.mmp_df['time'] = [x for x in range(1, len(self.mmp_df) + 1)]
-            self.mmp_df.set_index('time', inplace=True)
+            self.mmp_df = mean_max_power(self.df_samples['watts']).rename_axis('time').to_frame()
             if dbinsert:
-                df = self.df_samples.copy()
-                df.rename(columns={'time': 'interval'}, inplace=True)
-                for col in ['distance', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'moving', 'grade_smooth',
-                            'latitude', 'longitude', 'altitude', 'power_zone', 'hr_zone', 'temp']:
-                    if col in df.columns:
-                        df = df.drop(columns=col)
+                # One row per interval, using the sample at that many seconds into the workout for the timestamps
+                df = self.df_samples[['time', 'time_interval', 'date', 'activity_id', 'act_name']].rename(
+                    columns={'time': 'interval'})
                 df = df[df['interval'] != 0]
-                df['mmp'] = df['interval'].map(self.mmp_df['mmp'].to_dict())
+                df['mmp'] = self.mmp_df['mmp'].reindex(df['interval']).to_numpy()
                 df['watts_per_kg'] = df['mmp'] / self.kg
                 df['timestamp_local'] = df.index
                 df['type'] = self.type
                 df['athlete_id'] = self.Athlete.athlete_id
                 df['ftp'] = self.ftp
                 df.set_index(['activity_id', 'interval'], inplace=True)
-                db_insert(df, 'strava_best_samples')
+                # Written with the rest of the activity in write_dfs_to_db()
+                self.df_best_samples = df
 
     def sweatpy_cp_model(self, model='3_parameter_non_linear'):
         # Models that can be passed = '2_parameter_non_linear', '3_parameter_non_linear', 'extended_5_3','extended_7_3'
         # Run CP model to return fitted params
         return critical_power.model_fit(self.mmp_df.index, self.mmp_df['mmp'], model=model)
 
-    def write_dfs_to_db(self):
+    def add_summary_analytics(self):
         # Add athlete_id to df_summary
         self.df_summary['athlete_id'] = [self.Athlete.athlete_id]
         self.df_summary['ftp'] = [self.ftp]
@@ -601,12 +532,177 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_summary['variability_index'] = [self.variability_index]
         self.df_summary['weighted_average_power'] = [self.wap]
         self.df_summary['weight'] = [self.weight]
+
+    def write_dfs_to_db(self, replace=False):
+        # replace swaps out the rows already stored for the activity in the same transaction as the new ones
+        self.add_summary_analytics()
         # Add other columns to samples df
         self.df_samples['type'] = self.type
         self.df_samples['athlete_id'] = self.Athlete.athlete_id
 
-        db_insert(self.df_summary.fillna(np.nan), 'strava_summary')
-        db_insert(self.df_samples.fillna(np.nan), 'strava_samples')
+        frames = [(self.df_summary.fillna(np.nan), 'strava_summary')]
+        if sample_store_enabled:
+            # A replaced activity's samples are only written once its new rows are committed, below
+            if not replace:
+                write_samples(self.df_samples, self.id)
+        else:
+            frames.append((self.df_samples.fillna(np.nan), 'strava_samples'))
+        frames.append((build_pyramid(self.df_samples, self.id), 'strava_samples_pyramid'))
+        if getattr(self, 'df_best_samples', None) is not None:
+            frames.append((self.df_best_samples, 'strava_best_samples'))
+            # Compare against the bests stored before this activity is written
+            session, engine = db_connect()
+            df_pr_events = personal_bests(session, self.df_best_samples, use_envelope=not replace)
+            session.close()
+            if df_pr_events is not None and len(df_pr_events) > 0:
+                frames.append((df_pr_events, 'strava_pr_events'))
+                app.server.logger.info('Activity id "{}": {} new personal bests'.format(self.id, len(df_pr_events)))
+        # All tables for the activity go in one transaction so a failed write never leaves a partial activity behind
+        try:
+            rows, rows_per_sec = db_bulk_insert(
+                frames, before=(lambda conn: delete_activity_rows(conn, [self.id])) if replace else None)
+        except BaseException:
+            if sample_store_enabled and not replace:
+                delete_samples(self.id)
+            raise
+        if sample_store_enabled and replace:
+            write_samples(self.df_samples, self.id)
+        app.server.logger.debug(
+            'Activity id "{}": Inserted {} rows ({:.0f} rows/sec)'.format(self.id, rows, rows_per_sec))
+        if getattr(self, 'df_best_samples', None) is not None or replace:
+            update_best_envelope(getattr(self, 'df_best_samples', None))
+
+
+def delete_activity_rows(session, activity_ids):
+    '''
+    Delete the db rows stored for activities, the samples store is left to the caller
+    :param session: session or connection, the caller commits
+    '''
+    session.execute(delete(stravaSummary).where(stravaSummary.activity_id.in_(activity_ids)))
+    session.execute(delete(stravaSamples).where(stravaSamples.activity_id.in_(activity_ids)))
+    session.execute(delete(stravaBestSamples).where(stravaBestSamples.activity_id.in_(activity_ids)))
+    delete_pyramid(session, activity_ids)
+    delete_pr_events(session, activity_ids)
+    # The envelope may hold bests from the deleted activities, update_best_envelope() rebuilds it
+    truncate_best_envelope(session)
+
+
+class ActivityAnalysis(object):
+    '''
+    Picklable copy of the FitlyActivity state analyze() works on, so it can run in a process pool. stravalib keeps
+    entity attributes on the class descriptors rather than the instance, so a FitlyActivity can not be pickled itself.
+    '''
+    inputs = ['id', 'type', 'name', 'start_date', 'max_watts', 'max_heartrate', 'ftp', 'power_zones', 'hearrate_zones',
+              'Athlete', 'hr_lowest', 'stryd_metrics', 'kg', 'weight', 'df_samples', 'df_summary']
+    outputs = ['df_samples', 'df_summary', 'mmp_df', 'df_best_samples', 'athlete_max_hr', 'rhr', 'hrr', 'trimp',
+               'hrss', 'wap', 'tss', 'ri', 'variability_index', 'efficiency_factor']
+
+    def __init__(self, activity):
+        for attr in self.inputs:
+            setattr(self, attr, getattr(activity, attr, None))
+
+    def apply_to(self, activity):
+        for attr in self.outputs:
+            setattr(activity, attr, getattr(self, attr, None))
+        return activity
+
+    analyze = FitlyActivity.analyze
+    calculate_power_zones = FitlyActivity.calculate_power_zones
+    calculate_heartate_zones = FitlyActivity.calculate_heartate_zones
+    calculate_zone_intensities = FitlyActivity.calculate_zone_intensities
+    get_summary_analytics = FitlyActivity.get_summary_analytics
+    wss_score = FitlyActivity.wss_score
+    compute_mean_max_power = FitlyActivity.compute_mean_max_power
+
+
+def analyze_activity(analysis):
+    # Process pool entry point
+    return analysis.analyze()
+
+
+def apply_batch_ftp_tests(activity, previous_activities):
+    '''
+    Ride ftp comes from the latest earlier ftp test in the ingestion index, which is loaded before any of the batch is
+    written, so check the batch as well
+    '''
+    if 'ride' not in activity.type.lower():
+        return
+    tests = [x for x in previous_activities if 'ride' in x.type.lower() and 'ftp test' in x.name.lower() and
+             x.start_date_local < activity.start_date_local and x.average_watts and
+             (activity.ftp_test_date is None or x.start_date_local > activity.ftp_test_date)]
+    if len(tests) > 0:
+        test = max(tests, key=lambda x: x.start_date_local)
+        activity.ftp = float(test.average_watts) * .95
+        activity.ftp_test_date = test.start_date_local
+
+
+def analysis_pipeline(activities, prepare, write, workers):
+    '''
+    prepare() each activity on I/O threads, analyze() them in a process pool, and write() them serialized here in
+    activity order
+    :param prepare: called with (position in activities, activity), loads everything analyze() needs
+    :param write: called with the analyzed activity
+    '''
+    if workers <= 1 or len(activities) <= 1:
+        for i, activity in enumerate(activities):
+            prepare(i, activity)
+            activity.analyze()
+            write(activity)
+        return
+
+    def finish(activity, future):
+        try:
+            future.result().apply_to(activity)
+        except (pickle.PicklingError, BrokenProcessPool) as e:
+            app.server.logger.warning(
+                'Activity id "{}": Analysis failed in process pool ({}), analyzing inline'.format(activity.id, e))
+            activity.analyze()
+        write(activity)
+
+    with ThreadPoolExecutor(max_workers=workers) as io_pool, ProcessPoolExecutor(max_workers=workers) as cpu_pool:
+        prepared = [io_pool.submit(prepare, i, activity) for i, activity in enumerate(activities)]
+        pending = deque()
+        for activity, future in zip(activities, prepared):
+            future.result()
+            pending.append((activity, cpu_pool.submit(analyze_activity, ActivityAnalysis(activity))))
+            # Write whatever has finished, in order, while later activities are still being prepared
+            while len(pending) > 0 and pending[0][1].done():
+                finish(*pending.popleft())
+        while len(pending) > 0:
+            finish(*pending.popleft())
+
+
+def scrape_activities(activities, athlete_id, workers=None):
+    '''
+    Run stravaScrape() over new activities. With more than 1 worker, streams are fetched on I/O threads, zones, mmp
+    and trimp are computed in a process pool, and the db writes stay serialized here in activity order.
+    :param activities: FitlyActivity list sorted oldest to newest
+    :param workers: defaults to [strava] workers in config.ini
+    '''
+    workers = strava_workers if workers is None else workers
+    if len(activities) == 0:
+        return
+    # Look up resting hr, weight and ftp for every activity at once
+    index = load_ingestion_index(athlete_id)
+    if stryd_credentials_supplied and any('run' in x.type.lower() or 'walk' in x.type.lower() for x in activities):
+        index.stryd_df = get_stryd_df_summary()
+    as_of = index.activity_values(activities)
+
+    def fetch(i, fitly_act):
+        fitly_act.fetch(athlete_id, index, as_of.loc[fitly_act.id])
+        apply_batch_ftp_tests(fitly_act, activities[:i])
+
+    written = []
+
+    def write(fitly_act):
+        app.server.logger.debug(
+            'Activity id "{}": Writing df_summary, df_samples and best samples to DB'.format(fitly_act.id))
+        fitly_act.write_dfs_to_db()
+        dequeue_activities([fitly_act.id])
+        written.append(fitly_act.id)
+        report_progress('Importing strava activities', len(written), len(activities))
+
+    analysis_pipeline(activities, fetch, write, workers)
 
 
 def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
@@ -615,24 +711,16 @@ def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
     Once stored, continuously check if workout has been completed and fill in 'Compelted' field
     '''
 
-    # https://www.trainingpeaks.com/coach-blog/new-study-widens-hrv-evidence-for-more-athletes/
-
     session, engine = db_connect()
 
     # Check if entire table is empty, if so the earliest hrv plan can start is after 30 days of hrv readings
-    db_test = pd.read_sql(
-        sql=session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.athlete_id == athlete_id).statement,
-        con=engine, index_col='date')
-
-    if len(db_test) == 0:
+    if session.query(hrvWorkoutStepLog.id).filter(hrvWorkoutStepLog.athlete_id == athlete_id).first() is None:
         min_oura_date = pd.to_datetime(
             session.query(func.min(ouraSleepSummary.report_date))[0][0] + timedelta(29)).date()
-        db_test.at[min_oura_date, 'athlete_id'] = athlete_id
-        db_test.at[min_oura_date, 'hrv_workout_step'] = 0
-        db_test.at[min_oura_date, 'hrv_workout_step_desc'] = 'Low'
-        db_test.at[min_oura_date, 'completed'] = 0
-        db_test.at[min_oura_date, 'rationale'] = 'This is the first date 30 day hrv thresholds could be calculated'
-        db_insert(db_test, 'hrv_workout_step_log')
+        db_insert(pd.DataFrame({
+            'athlete_id': [athlete_id], 'hrv_workout_step': [0], 'hrv_workout_step_desc': ['Low'], 'completed': [0],
+            'rationale': ['This is the first date 30 day hrv thresholds could be calculated']
+        }, index=pd.Index([min_oura_date], name='date')), 'hrv_workout_step_log')
 
     # Check if a step has already been inserted for today and if so check if workout has been completed yet
     todays_plan = session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.athlete_id == athlete_id,
@@ -654,176 +742,46 @@ def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
 
     # If plan not yet created for today, create it
     else:
-        hrv_df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
-                             con=engine, index_col='report_date').sort_index(ascending=True)
-
+        today = datetime.today().date()
         # Wait for today's hrv to be loaded into cloud
-        if hrv_df.index.max() == datetime.today().date():  # or (datetime.now() - timedelta(hours=12)) > pd.to_datetime(datetime.today().date()):
-
-            step_log_df = pd.read_sql(
-                sql=session.query(hrvWorkoutStepLog.date, hrvWorkoutStepLog.hrv_workout_step,
-                                  hrvWorkoutStepLog.completed).filter(
-                    hrvWorkoutStepLog.athlete_id == 1).statement,
-                con=engine, index_col='date').sort_index(ascending=False)
+        if session.query(func.max(ouraSleepSummary.report_date)).scalar() == today:
+            # Pick up from the last logged step, every day since then gets a step
+            last_date, last_step = session.query(hrvWorkoutStepLog.date, hrvWorkoutStepLog.hrv_workout_step).filter(
+                hrvWorkoutStepLog.athlete_id == athlete_id).order_by(hrvWorkoutStepLog.date.desc()).first()
+            days = pd.date_range(pd.Timestamp(last_date) + timedelta(days=1), pd.Timestamp(today), freq='D')
+            # The first step (30 days after the first hrv reading) is still in the future on a new install
+            if len(days) == 0:
+                session.close()
+                return
 
             # Store the last value of step 2 "HIIT" or "Mod" to cycle between the 2
-            try:
-                last_hiit_mod = step_log_df[(step_log_df['hrv_workout_step'] == 2) & (step_log_df['completed'] == 1)][
-                    'hrv_workout_step_desc'].head(1).values[0]
-            except:
-                last_hiit_mod = 'HIIT'
-            next_hiit_mod = 'HIIT' if last_hiit_mod == 'Mod' else 'Mod'
-
-            step_log_df = step_log_df[step_log_df.index == step_log_df.index.max()]
-
-            # Store last step in variable for starting point in loop
-            last_db_step = step_log_df['hrv_workout_step'].iloc[0]
-
-            # Resample to today
-            step_log_df.at[pd.to_datetime(datetime.today().date()), 'hrv_workout_step'] = None
-            step_log_df.set_index(pd.to_datetime(step_log_df.index), inplace=True)
-            step_log_df = step_log_df.resample('D').mean()
-
-            # Remove first row from df so it does not get re inserted into db
-            step_log_df = step_log_df.iloc[1:]
-
-            # We already know there is no step for today from "current_step" parameter, so manually add today's date
-            step_log_df.at[pd.to_datetime(datetime.today().date()), 'completed'] = 0
-
-            # Check if gap between today and max date in step log, if so merge in all workouts for 'completed' flag
-            if step_log_df['completed'].isnull().values.any():
-                workouts = pd.read_sql(
-                    sql=session.query(stravaSummary.start_day_local, stravaSummary.activity_id).filter(
-                        stravaSummary.elapsed_time > min_non_warmup_workout_time)
-                        .statement, con=engine,
-                    index_col='start_day_local')
-                # Resample workouts to the per day level - just take max activity_id in case they were more than 1 workout for that day to avoid duplication of hrv data
-                workouts.set_index(pd.to_datetime(workouts.index), inplace=True)
-                workouts = workouts.resample('D').max()
-                step_log_df = step_log_df.merge(workouts, how='left', left_index=True, right_index=True)
-                # Completed = True if a workout (not just warmup) was done on that day or was a rest day
-                for x in step_log_df.index:
-                    step_log_df.at[x, 'completed'] = 0 if np.isnan(step_log_df.at[x, 'activity_id']) else 1
-
-            # Generate row with yesterdays plan completions status for looping below through workout cycle logic
-            step_log_df['completed_yesterday'] = step_log_df['completed'].shift(1)
-
-            # Drop historical rows that were used for 'yesterday calcs' so we are only working with todays data
-            # step_log_df = step_log_df.iloc[1:]
-
-            # Calculate HRV metrics
-            hrv_df.set_index(pd.to_datetime(hrv_df.index), inplace=True)
-            hrv_df = hrv_df.resample('D').mean()
-
-            hrv_df['rmssd_7'] = hrv_df['rmssd'].rolling(7, min_periods=0).mean()
-            hrv_df['rmssd_7_yesterday'] = hrv_df['rmssd_7'].shift(1)
-            hrv_df['rmssd_30'] = hrv_df['rmssd'].rolling(30, min_periods=0).mean()
-            hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].rolling(30, min_periods=0).std() * .5
-            hrv_df['swc_upper'] = hrv_df['rmssd_30'] + hrv_df['stdev_rmssd_30_threshold']
-            hrv_df['swc_lower'] = hrv_df['rmssd_30'] - hrv_df['stdev_rmssd_30_threshold']
-            hrv_df['under_low_threshold'] = hrv_df['rmssd_7'] < hrv_df['swc_lower']
-            hrv_df['under_low_threshold_yesterday'] = hrv_df['under_low_threshold'].shift(1)
-            hrv_df['over_upper_threshold'] = hrv_df['rmssd_7'] > hrv_df['swc_upper']
-            hrv_df['over_upper_threshold_yesterday'] = hrv_df['over_upper_threshold'].shift(1)
-            for i in hrv_df.index:
-                if hrv_df.at[i, 'under_low_threshold_yesterday'] == False and hrv_df.at[
-                    i, 'under_low_threshold'] == True:
-                    hrv_df.at[i, 'lower_threshold_crossed'] = True
-                else:
-                    hrv_df.at[i, 'lower_threshold_crossed'] = False
-                if hrv_df.at[i, 'over_upper_threshold_yesterday'] == False and hrv_df.at[
-                    i, 'over_upper_threshold'] == True:
-                    hrv_df.at[i, 'upper_threshold_crossed'] = True
-                else:
-                    hrv_df.at[i, 'upper_threshold_crossed'] = False
-
-            # Merge dfs
-            df = pd.merge(step_log_df, hrv_df, how='left', right_index=True, left_index=True)
-
-            last_step = last_db_step
-            for i in df.index:
-                # Completed / Completed_yesterday could show erroneous data for rest days, as the 0 is brought in based off if a workout is found in strava summary
-                df.at[i, 'completed_yesterday'] = 1 if last_step == 4 or last_step == 5 else df.at[
-                    i, 'completed_yesterday']
-
-                hrv_increase = df.at[i, 'rmssd_7'] >= df.at[i, 'rmssd_7_yesterday']
-
-                ### Low Threshold Exceptions ###
-                # If lower threshold is crossed, switch to low intensity track
-                if df.at[i, 'lower_threshold_crossed'] == True:
-                    current_step = 4
-                    rationale = '7 day HRV average crossed the 30 day baseline lower threshold.'
-                    app.server.logger.debug('Lower threshold crossed. Setting current step = 4')
-                # If we are below lower threshold, rest until back over threshold
-                elif df.at[i, 'under_low_threshold'] == True:
-                    current_step = 5
-                    rationale = '7 day HRV average is under the 30 day baseline lower threshold.'
-                    app.server.logger.debug('HRV is under threshold. Setting current step = 5')
-
-                ### Upper Threshold Exceptions ###
-                # If upper threshold is crossed, switch to high  intensity
-                elif df.at[i, 'upper_threshold_crossed'] == True:
-                    current_step = 1
-                    rationale = '7 day HRV average crossed the 30 day baseline upper threshold.'
-                    app.server.logger.debug('Upper threshold crossed. Setting current step = 1')
-                # If we are above upper threshold, load high intensity until back under threshold
-                elif df.at[i, 'over_upper_threshold'] == True:
-                    if hrv_increase:
-                        current_step = 1
-                        rationale = '7 day HRV average increased and is still over the 30 day baseline upper threshold.'
-                    else:
-                        current_step = 2
-                        rationale = "7 day HRV average decreased but is still over the 30 day baseline upper threshold."
-                    app.server.logger.debug(
-                        'HRV is above threshold. Setting current step = {}.'.format(current_step))
-
-                ### Missed Workout Exceptions ###
-                # If workout was not completed yesterday but we are still within thresholds and current step is high/moderate go high if hrv increases, or stay on moderate if hrv decreases
-                elif df.at[i, 'completed_yesterday'] == 0 and df.at[i, 'under_low_threshold'] == False and df.at[
-                    i, 'over_upper_threshold'] == False and (last_step == 1 or last_step == 2):
-                    if hrv_increase:
-                        current_step = 1
-                        rationale = "7 day HRV average increased and yesterday's workout was not completed."
-                    else:
-                        current_step = 2
-                        rationale = "7 day HRV average decreased and yesterday's workout was not completed."
-                    app.server.logger.debug(
-                        'No workout detected for previous day however still within thresholds. Maintaining last step = {}'.format(
-                            current_step))
-                else:
-                    app.server.logger.debug(
-                        'No exceptions detected. Following the normal workout plan workflow.')
-                    rationale = '7 day HRV average is within the tresholds. Following the normal workout plan workflow.'
-                    # Workout workflow logic when no exceptions
-                    if last_step == 0:
-                        current_step = 1
-                    elif last_step == 1:
-                        current_step = 2 if hrv_increase else 6
-                    elif last_step == 2:
-                        current_step = 3
-                    elif last_step == 3:
-                        current_step = 1 if hrv_increase else 4
-                    elif last_step == 4:
-                        current_step = 6 if hrv_increase else 5
-                    elif last_step == 5:
-                        current_step = 6
-                    elif last_step == 6:
-                        current_step = 1 if hrv_increase else 4
-
-                df.at[i, 'completed'] = 1 if current_step == 4 or current_step == 5 else df.at[i, 'completed']
-                df.at[i, 'hrv_workout_step'] = current_step
-                last_step = current_step
-
-                # Map descriptions and alternate every HIIT and Mod
-                df.at[i, 'hrv_workout_step_desc'] = \
-                    {0: 'Low', 1: 'High', 2: next_hiit_mod, 3: 'Low', 4: 'Rest', 5: 'Rest', 6: 'Low'}[
-                        df.at[i, 'hrv_workout_step']]
-                if df.at[i, 'hrv_workout_step'] == 2 and df.at[i, 'completed'] == 1:
-                    next_hiit_mod = 'HIIT' if next_hiit_mod == 'Mod' else 'Mod'
-
-                df.at[i, 'rationale'] = rationale
-
+            last_hiit_mod = session.query(hrvWorkoutStepLog.hrv_workout_step_desc).filter(
+                hrvWorkoutStepLog.athlete_id == athlete_id, hrvWorkoutStepLog.hrv_workout_step == 2,
+                hrvWorkoutStepLog.completed.is_(True)).order_by(hrvWorkoutStepLog.date.desc()).first()
+            next_hiit_mod = 'HIIT' if last_hiit_mod is not None and last_hiit_mod[0] == 'Mod' else 'Mod'
+
+            # We already know there is no step for today, so today's workout is not completed yet. If there is a gap
+            # since the last step, completed = True if a workout (not just warmup) was done on that day
+            completed = np.full(len(days), np.nan)
+            completed[-1] = 0
+            if len(days) > 1:
+                workout_days = set(pd.to_datetime([x[0] for x in session.query(stravaSummary.start_day_local).filter(
+                    stravaSummary.elapsed_time > min_non_warmup_workout_time,
+                    stravaSummary.start_day_local >= days[0].date()).distinct()]))
+                completed = np.array([1. if x in workout_days else 0. for x in days])
+
+            # Rolling baselines for the new days only need the 30 days before them
+            hrv_df = pd.read_sql(
+                sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).filter(
+                    ouraSleepSummary.report_date >= (days[0] - timedelta(days=hrv_lookback_days)).date()).statement,
+                con=engine, index_col='report_date').sort_index(ascending=True)
+            # Resampled so rolling is always done over the correct # of days
+            rmssd = hrv_df['rmssd'].set_axis(pd.to_datetime(hrv_df.index)).resample('D').mean()
+            baselines = hrv_thresholds(hrv_baselines(rmssd)).reindex(days)
+
+            df = hrv_workout_steps(last_step, next_hiit_mod, completed, baselines)
             df['athlete_id'] = athlete_id
+            df.index.name = 'date'
 
             df.reset_index(inplace=True)
             # Insert into db
@@ -834,5 +792,4 @@ def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
             if peloton_credentials_supplied:
                 set_peloton_workout_recommendations()
 
-    engine.dispose()
     session.close()
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+from ..app import app
+
+# HRV workout plan: 7 day rmssd average against a band of half a standard deviation around the 30 day average.
+# https://www.trainingpeaks.com/coach-blog/new-study-widens-hrv-evidence-for-more-athletes/
+# A day's step only depends on the 30 day window ending the day before it, so only that much history is loaded.
+hrv_lookback_days = 30
+
+hrv_step_desc = {0: 'Low', 1: 'High', 3: 'Low', 4: 'Rest', 5: 'Rest', 6: 'Low'}
+
+# Normal workflow when hrv is within the thresholds: {last step: (step if hrv increased, step if it decreased)}
+hrv_step_cycle = {0: (1, 1), 1: (2, 6), 2: (3, 3), 3: (1, 4), 4: (6, 5), 5: (6, 6), 6: (1, 4)}
+
+
+def hrv_thresholds(baselines):
+    '''
+    Threshold flags for every day, in one vectorized pass
+    :param baselines: dailyMetrics.hrv_baselines() over one row per calendar day
+    :return: df indexed on day with rmssd_7, rmssd_7_yesterday, under_low_threshold, over_upper_threshold,
+    lower_threshold_crossed and upper_threshold_crossed (flags are 1/0)
+    '''
+    rmssd_7 = baselines['rmssd_7']
+    # Comparisons against a missing baseline are False, as they are in pandas
+    under = (rmssd_7 < baselines['swc_lower']).to_numpy()
+    over = (rmssd_7 > baselines['swc_upper']).to_numpy()
+    # A threshold is crossed on the first day past it, the first day has no yesterday to compare with
+    lower_crossed = np.zeros(len(baselines), dtype=bool)
+    lower_crossed[1:] = under[1:] & ~under[:-1]
+    upper_crossed = np.zeros(len(baselines), dtype=bool)
+    upper_crossed[1:] = over[1:] & ~over[:-1]
+    return pd.DataFrame({
+        'rmssd_7': rmssd_7,
+        'rmssd_7_yesterday': rmssd_7.shift(1),
+        'under_low_threshold': under.astype(float),
+        'over_upper_threshold': over.astype(float),
+        'lower_threshold_crossed': lower_crossed.astype(float),
+        'upper_threshold_crossed': upper_crossed.astype(float)
+    }, index=baselines.index)
+
+
+def hrv_workout_steps(last_step, next_hiit_mod, completed, baselines):
+    '''
+    Step the workout plan forward a day at a time from the last logged step
+    :param next_hiit_mod: 'HIIT' or 'Mod', step 2 alternates between them each time it is completed
+    :param completed: 1/0 per day for whether a workout (not just a warmup) was done, nan where unknown
+    :param baselines: hrv_thresholds() reindexed to the same days, nan where there is no hrv
+    :return: df of hrv_workout_step, hrv_workout_step_desc, completed and rationale indexed on day, empty when there
+    are no days to step through
+    '''
+    if len(baselines) == 0:
+        return pd.DataFrame(columns=['hrv_workout_step', 'hrv_workout_step_desc', 'completed', 'rationale'],
+                            index=baselines.index)
+    completed = np.asarray(completed, dtype=float).copy()
+    completed_yesterday = np.concatenate([[np.nan], completed[:-1]])
+    rmssd_7 = baselines['rmssd_7'].to_numpy()
+    # nan >= anything is False, so days without hrv count as a decrease
+    with np.errstate(invalid='ignore'):
+        hrv_increases = rmssd_7 >= baselines['rmssd_7_yesterday'].to_numpy()
+    under = baselines['under_low_threshold'].to_numpy()
+    over = baselines['over_upper_threshold'].to_numpy()
+    lower_crossed = baselines['lower_threshold_crossed'].to_numpy()
+    upper_crossed = baselines['upper_threshold_crossed'].to_numpy()
+
+    steps, descriptions, rationales = [], [], []
+    for i in range(len(completed)):
+        # Rest days count as completed, whether or not a workout shows up in strava
+        if last_step == 4 or last_step == 5:
+            completed_yesterday[i] = 1
+        hrv_increase = hrv_increases[i]
+
+        ### Low Threshold Exceptions ###
+        # If lower threshold is crossed, switch to low intensity track
+        if lower_crossed[i] == 1:
+            current_step = 4
+            rationale = '7 day HRV average crossed the 30 day baseline lower threshold.'
+            app.server.logger.debug('Lower threshold crossed. Setting current step = 4')
+        # If we are below lower threshold, rest until back over threshold
+        elif under[i] == 1:
+            current_step = 5
+            rationale = '7 day HRV average is under the 30 day baseline lower threshold.'
+            app.server.logger.debug('HRV is under threshold. Setting current step = 5')
+
+        ### Upper Threshold Exceptions ###
+        # If upper threshold is crossed, switch to high  intensity
+        elif upper_crossed[i] == 1:
+            current_step = 1
+            rationale = '7 day HRV average crossed the 30 day baseline upper threshold.'
+            app.server.logger.debug('Upper threshold crossed. Setting current step = 1')
+        # If we are above upper threshold, load high intensity until back under threshold
+        elif over[i] == 1:
+            if hrv_increase:
+                current_step = 1
+                rationale = '7 day HRV average increased and is still over the 30 day baseline upper threshold.'
+            else:
+                current_step = 2
+                rationale = "7 day HRV average decreased but is still over the 30 day baseline upper threshold."
+            app.server.logger.debug('HRV is above threshold. Setting current step = {}.'.format(current_step))
+
+        ### Missed Workout Exceptions ###
+        # If workout was not completed yesterday but we are still within thresholds and current step is high/moderate
+        # go high if hrv increases, or stay on moderate if hrv decreases
+        elif completed_yesterday[i] == 0 and under[i] == 0 and over[i] == 0 and (last_step == 1 or last_step == 2):
+            if hrv_increase:
+                current_step = 1
+                rationale = "7 day HRV average increased and yesterday's workout was not completed."
+            else:
+                current_step = 2
+                rationale = "7 day HRV average decreased and yesterday's workout was not completed."
+            app.server.logger.debug(
+                'No workout detected for previous day however still within thresholds. Maintaining last step = {}'.format(
+                    current_step))
+        else:
+            app.server.logger.debug('No exceptions detected. Following the normal workout plan workflow.')
+            rationale = '7 day HRV average is within the tresholds. Following the normal workout plan workflow.'
+            current_step = hrv_step_cycle[last_step][0 if hrv_increase else 1]
+
+        if current_step == 4 or current_step == 5:
+            completed[i] = 1
+        last_step = current_step
+
+        # Map descriptions and alternate every HIIT and Mod
+        descriptions.append(next_hiit_mod if current_step == 2 else hrv_step_desc[current_step])
+        if current_step == 2 and completed[i] == 1:
+            next_hiit_mod = 'HIIT' if next_hiit_mod == 'Mod' else 'Mod'
+        steps.append(current_step)
+        rationales.append(rationale)
+
+    return pd.DataFrame({'hrv_workout_step': steps, 'hrv_workout_step_desc': descriptions, 'completed': completed,
+                         'rationale': rationales}, index=baselines.index)
@@ -0,0 +1,234 @@
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from ..api.sqlalchemy_declarative import session_scope, jobQueue
+from ..app import app
+from ..utils import config
+
+# Refreshes and reprocessing are queued in the job_queue table by the web app (and the hourly schedule) and run by a
+# worker: either a thread in the web app's scheduler, or `fitly-worker` when [worker] embedded = False. Web callbacks
+# only enqueue and poll, so an hour long import never holds up a request.
+worker_embedded = config.get('worker', 'embedded', fallback='True').lower() == 'true'
+worker_poll_seconds = float(config.get('worker', 'poll_seconds', fallback='5'))
+# Running jobs are stamped this often, a job that misses 10 heartbeats is taken to have lost its worker
+worker_heartbeat_seconds = float(config.get('worker', 'heartbeat_seconds', fallback='30'))
+
+# Job the worker in this process is running, progress reports from ingestion code are written against it
+running_job_id = None
+
+
+def enqueue_job(kind, **params):
+    '''
+    Queue a job, unless the same job is already waiting to run
+    :param kind: 'refresh', 'reprocess' or 'strava_event'
+    :param params: keyword arguments for the job, must be json serializable
+    :return: job id
+    '''
+    params = json.dumps(params, sort_keys=True, default=str)
+    with session_scope() as session:
+        queued = session.query(jobQueue.job_id).filter(jobQueue.status == 'queued', jobQueue.kind == kind,
+                                                       jobQueue.params == params).first()
+        if queued:
+            return queued[0]
+        job = jobQueue(kind=kind, params=params, status='queued', created_utc=datetime.utcnow())
+        session.add(job)
+        session.flush()
+        app.server.logger.debug('Queued {} job {}'.format(kind, job.job_id))
+        return job.job_id
+
+
+def merge_queued_job(kind, merge, **params):
+    '''
+    Fold a job into one of the same kind that is still waiting to run, queue it when there is none it merges with
+    :param merge: function(queued params, params) returning the merged params, or None when the two can not be merged
+    :return: job id
+    '''
+    with session_scope() as session:
+        queued = session.query(jobQueue.job_id, jobQueue.params).filter(
+            jobQueue.status == 'queued', jobQueue.kind == kind).order_by(jobQueue.job_id).all()
+        for job in queued:
+            merged = merge(json.loads(job.params), params)
+            if merged is None:
+                continue
+            # Only matches while the job is still queued, a worker may have claimed it since it was read
+            updated = session.query(jobQueue).filter(jobQueue.job_id == job.job_id, jobQueue.status == 'queued').update(
+                {'params': json.dumps(merged, sort_keys=True, default=str)}, synchronize_session=False)
+            if updated == 1:
+                app.server.logger.debug('Merged into queued {} job {}'.format(kind, job.job_id))
+                return job.job_id
+    return enqueue_job(kind, **params)
+
+
+def claim_job(worker):
+    '''
+    Mark the oldest queued job as running. The update only matches while the job is still queued, so two workers can
+    never both claim it
+    :return: (job id, kind, params) or None when nothing is queued
+    '''
+    with session_scope() as session:
+        job = session.query(jobQueue.job_id, jobQueue.kind, jobQueue.params).filter(
+            jobQueue.status == 'queued').order_by(jobQueue.job_id).first()
+        if job is None:
+            return None
+        now = datetime.utcnow()
+        claimed = session.query(jobQueue).filter(jobQueue.job_id == job.job_id, jobQueue.status == 'queued').update(
+            {'status': 'running', 'worker': worker, 'started_utc': now, 'heartbeat_utc': now},
+            synchronize_session=False)
+        return (job.job_id, job.kind, json.loads(job.params)) if claimed == 1 else None
+
+
+def update_job(job_id, **values):
+    with session_scope() as session:
+        session.query(jobQueue).filter(jobQueue.job_id == job_id).update(values, synchronize_session=False)
+
+
+def report_progress(stage, done=None, total=None):
+    '''
+    Record what the running job is doing, i.e. ('Importing strava activities', 12, 340). No-op outside of a job
+    '''
+    if running_job_id is not None:
+        try:
+            update_job(running_job_id, stage=stage[:255], progress_done=done, progress_total=total)
+        except BaseException as e:
+            app.server.logger.error('Error recording job progress: {}'.format(e))
+
+
+def latest_job(kinds=None):
+    '''
+    Most recently queued job
+    :return: dict of job_queue columns, None if there are no jobs
+    '''
+    with session_scope() as session:
+        query = session.query(jobQueue)
+        if kinds is not None:
+            query = query.filter(jobQueue.kind.in_(kinds))
+        job = query.order_by(jobQueue.job_id.desc()).first()
+        return None if job is None else {col.name: getattr(job, col.name) for col in jobQueue.__table__.columns}
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_dead(worker, heartbeat_utc, job_id=None):
+    '''
+    Whether the worker that claimed a running job is gone. Workers on this host are checked by pid, any worker counts
+    as gone once its heartbeat is stale
+    '''
+    host, _, pid = (worker or '').rpartition(':')
+    if worker == worker_name():
+        # Only one job runs per process, any other claimed under this name is from a previous run with the same pid
+        return job_id != running_job_id
+    # os.kill() terminates the process on windows rather than checking it
+    if host == socket.gethostname() and pid.isdigit() and os.name == 'posix' and not process_alive(int(pid)):
+        return True
+    return heartbeat_utc is None or \
+        datetime.utcnow() - heartbeat_utc > timedelta(seconds=worker_heartbeat_seconds * 10)
+
+
+def requeue_interrupted_jobs():
+    '''
+    Jobs left running by a worker that died are queued again. Refreshes and reprocessing can both be rerun safely,
+    the strava activity queue picks up where an import left off
+    :return: number of jobs requeued
+    '''
+    with session_scope() as session:
+        running = session.query(jobQueue.job_id, jobQueue.worker, jobQueue.heartbeat_utc).filter(
+            jobQueue.status == 'running').all()
+        job_ids = [job.job_id for job in running if worker_dead(job.worker, job.heartbeat_utc, job.job_id)]
+        if len(job_ids) == 0:
+            return 0
+        # Still matched on status so a job that finished in the meantime is left alone
+        requeued = session.query(jobQueue).filter(jobQueue.job_id.in_(job_ids), jobQueue.status == 'running').update(
+            {'status': 'queued', 'message': 'Requeued after its worker stopped'}, synchronize_session=False)
+    app.server.logger.warning('Requeued {} jobs left running by a stopped worker'.format(requeued))
+    return requeued
+
+
+def heartbeat(job_id, stop):
+    # Runs beside a job, which may go a long time between progress reports
+    while not stop.wait(worker_heartbeat_seconds):
+        try:
+            update_job(job_id, heartbeat_utc=datetime.utcnow())
+        except BaseException as e:
+            app.server.logger.error('Error recording job heartbeat: {}'.format(e))
+
+
+def run_job(kind, params):
+    '''
+    :return: message recorded with the finished job
+    '''
+    if kind == 'refresh':
+        from ..api.datapull import refresh_database
+        run_time = refresh_database(**params)
+        return None if run_time else 'Please define all athlete settings prior to refreshing data'
+    elif kind == 'reprocess':
+        from ..api.reprocess import reprocess_activities, affected_activities
+        settings = params.pop('settings', None)
+        if settings is not None:
+            params['activity_ids'] = sorted(set().union(
+                *[affected_activities(setting, params.get('athlete_id', 1)) for setting in settings]))
+            if len(params['activity_ids']) == 0:
+                return 'No activities depend on {}'.format(', '.join(settings))
+        return 'Reprocessed {} activities'.format(reprocess_activities(**params))
+    elif kind == 'strava_event':
+        from ..api.stravaWebhook import handle_strava_event
+        return handle_strava_event(**params)
+    raise ValueError('Unknown job kind "{}"'.format(kind))
+
+
+def run_queued_jobs():
+    '''
+    Run queued jobs one at a time until the queue is empty, after taking back any job a dead worker left running
+    :return: number of jobs run
+    '''
+    global running_job_id
+    requeue_interrupted_jobs()
+    worker = worker_name()
+    count = 0
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            return count
+        job_id, kind, params = job
+        app.server.logger.info('Running {} job {}'.format(kind, job_id))
+        running_job_id = job_id
+        stop = threading.Event()
+        threading.Thread(target=heartbeat, args=(job_id, stop), daemon=True).start()
+        try:
+            message = run_job(kind, params)
+            status = 'done'
+        except BaseException as e:
+            app.server.logger.error('Error running {} job {}: {}'.format(kind, job_id, e))
+            message = str(e)
+            status = 'failed'
+        finally:
+            stop.set()
+            running_job_id = None
+        update_job(job_id, status=status, message=None if message is None else message[:255],
+                   finished_utc=datetime.utcnow())
+        count += 1
+
+
+def schedule_jobs(scheduler):
+    '''
+    Add the queue polling job, and the refresh cron when [cron] hourly_pull is enabled, to an APScheduler scheduler.
+    With the strava webhook subscribed, [cron] refresh_hours can drop the refresh to a few sweeps a day
+    '''
+    scheduler.add_job(func=run_queued_jobs, trigger='interval', seconds=worker_poll_seconds, max_instances=1,
+                      coalesce=True)
+    if config.get('cron', 'hourly_pull', fallback='False').lower() == 'true':
+        scheduler.add_job(func=enqueue_job, args=['refresh'], kwargs={'refresh_method': 'system'}, trigger='cron',
+                          hour=config.get('cron', 'refresh_hours', fallback='*'))
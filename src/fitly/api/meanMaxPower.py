@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, delete
+from ..api.sqlalchemy_declarative import stravaBestSamples, stravaPrEvents, stravaBestEnvelope
+from ..api.bestEnvelope import activity_sport
+
+# Mean max power from the difference of cumulative energy, one vectorized pass per interval instead of sweat's
+# pandas diff() + np.append per interval. PR events are reported at log spaced intervals so a long workout is not
+# reported at every second.
+pr_intervals_per_decade = 12
+pr_metrics = ['mmp', 'watts_per_kg']
+
+
+def log_intervals(max_interval, per_decade=pr_intervals_per_decade):
+    '''
+    Roughly evenly spaced intervals on a log scale from 1 second to max_interval
+    :return: np array of unique whole seconds
+    '''
+    if max_interval < 1:
+        return np.array([], dtype=int)
+    num = int(np.ceil(np.log10(max_interval) * per_decade)) + 1
+    return np.unique(np.round(np.logspace(0, np.log10(max_interval), num=num)).astype(int))
+
+
+def mean_max_power(power, intervals=None):
+    '''
+    Best average power over each interval length. Same curve as sweat's mean_max(): intervals run from 1 to
+    len(power) - 1 seconds and never include the sample at time 0. Missing samples count as 0 watts
+    :param power: 1s power samples
+    :param intervals: interval lengths in seconds, defaults to every length
+    :return: series of mmp indexed on interval
+    '''
+    power = pd.to_numeric(pd.Series(power), errors='coerce').to_numpy(dtype=float)
+    max_interval = len(power) - 1
+    intervals = np.arange(1, max_interval + 1) if intervals is None else np.asarray(
+        [x for x in intervals if 1 <= x <= max_interval], dtype=int)
+    if np.isnan(power).all():
+        return pd.Series(np.nan, index=pd.Index(intervals, name='interval'), name='mmp')
+
+    # energy[i] - energy[i - t] is the work done over the t samples ending at i
+    energy = np.cumsum(np.nan_to_num(power))
+    work = np.empty(len(energy))
+    mmp = np.empty(len(intervals))
+    for i, t in enumerate(intervals):
+        window = work[:len(energy) - t]
+        np.subtract(energy[t:], energy[:-t], out=window)
+        mmp[i] = window.max() / t
+    return pd.Series(mmp, index=pd.Index(intervals, name='interval'), name='mmp')
+
+
+def previous_bests(session, sport, intervals, activity_id, use_envelope=True):
+    '''
+    Best mmp and W/kg stored for the sport at each interval, leaving out activity_id. Read from the all time envelope,
+    the strava_best_samples group by is only run when the envelope is empty (truncated and not rebuilt yet) or may
+    hold the activity's own bests
+    :return: df of mmp and watts_per_kg indexed on interval
+    '''
+    intervals = [int(x) for x in intervals]
+    if use_envelope:
+        df = pd.read_sql(
+            sql=session.query(stravaBestEnvelope.interval, stravaBestEnvelope.mmp,
+                              stravaBestEnvelope.max_watts_per_kg.label('watts_per_kg'),
+                              stravaBestEnvelope.activity_id).filter(
+                stravaBestEnvelope.sport == sport, stravaBestEnvelope.period == 'all').statement,
+            con=session.connection(), index_col='interval')
+        if len(df) > 0 and not (df['activity_id'] == activity_id).any():
+            return df[pr_metrics].reindex(intervals)
+    return pd.read_sql(
+        sql=session.query(stravaBestSamples.interval, func.max(stravaBestSamples.mmp).label('mmp'),
+                          func.max(stravaBestSamples.watts_per_kg).label('watts_per_kg')).filter(
+            stravaBestSamples.type.ilike('%' + sport + '%'),
+            stravaBestSamples.interval.in_(intervals),
+            stravaBestSamples.activity_id != activity_id).group_by(stravaBestSamples.interval).statement,
+        con=session.connection(), index_col='interval').reindex(intervals)
+
+
+def personal_bests(session, df_best_samples, intervals=None, use_envelope=True):
+    '''
+    PR events for an activity: intervals where its mmp or W/kg beat the best stored for the sport
+    :param df_best_samples: strava_best_samples rows for one activity, before they are written
+    :param intervals: intervals to report, defaults to log spaced intervals up to the length of the activity
+    :param use_envelope: False when the activity is already stored, so its own bests are left out of the comparison
+    :return: df indexed on (activity_id, metric, interval) matching strava_pr_events
+    '''
+    df = df_best_samples.reset_index()
+    df = df[df['mmp'].notnull()]
+    sport = activity_sport(df['type'].iloc[0]) if len(df) > 0 else None
+    if sport is None:
+        return None
+    intervals = log_intervals(df['interval'].max()) if intervals is None else intervals
+    df = df[df['interval'].isin(intervals)].set_index('interval')
+    if len(df) == 0:
+        return None
+
+    activity_id = int(df['activity_id'].iloc[0])
+    previous = previous_bests(session, sport, df.index, activity_id, use_envelope).set_axis(df.index)
+
+    events = []
+    for metric in pr_metrics:
+        # The first workout of a sport at an interval is a PR with no previous value
+        improved = ~(df[metric].to_numpy() <= previous[metric].to_numpy()) & df[metric].notnull().to_numpy()
+        events.append(pd.DataFrame({'metric': metric, 'value': df[metric], 'previous_value': previous[metric]})[
+                          improved])
+    events = pd.concat(events).reset_index()
+    events['activity_id'] = activity_id
+    events['sport'] = sport
+    events['timestamp_local'] = df['timestamp_local'].min()
+    events['act_name'] = df['act_name'].iloc[0]
+    events['athlete_id'] = df['athlete_id'].iloc[0]
+    return events.set_index(['activity_id', 'metric', 'interval'])
+
+
+def delete_pr_events(session, activity_ids=None):
+    '''
+    Delete PR events for the given activities (or every activity)
+    '''
+    if activity_ids is None:
+        session.execute(delete(stravaPrEvents))
+    else:
+        session.execute(delete(stravaPrEvents).where(stravaPrEvents.activity_id.in_(activity_ids)))
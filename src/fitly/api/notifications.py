@@ -7,7 +7,6 @@ import dash_bootstrap_components as dbc
 def last_body_measurement_notification():
     session, engine = db_connect()
     last_measurement_date = session.query(func.max(withings.date_utc))[0][0]
-    engine.dispose()
     session.close()
 
     if last_measurement_date:
@@ -30,7 +29,6 @@ def last_ftp_test_notification(ftp_type):
     ftp_week_threshold = session.query(athlete).filter(
         athlete.athlete_id == 1).first().ftp_test_notification_week_threshold
 
-    engine.dispose()
     session.close()
 
     if last_ftp_test_date:
@@ -1,11 +1,14 @@
 from oura import OuraClient
-from ..api.sqlalchemy_declarative import db_connect, db_insert, ouraReadinessSummary, ouraActivitySummary, \
-    ouraActivitySamples, ouraSleepSamples, ouraSleepSummary, apiTokens
+from ..api.sqlalchemy_declarative import db_connect, db_upsert, get_engine, ouraReadinessSummary, \
+    ouraActivitySummary, ouraSleepSummary, ouraDayHash, apiTokens, ouraActivitySamples, ouraSleepSamples
 from sqlalchemy import func, delete
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 from ..app import app
 import ast
+import hashlib
+import json
 from ..utils import config
 
 client_id = config.get('oura', 'client_id')
@@ -19,7 +22,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Oura').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         app.server.logger.error(e)
@@ -42,7 +44,6 @@ def save_oura_token(token_dict):
     # config.set("oura", "token_dict", str(token_dict))
     # with open('config.ini', 'w') as configfile:
     #     config.write(configfile)
-    engine.dispose()
     session.close()
 
 
@@ -82,17 +83,165 @@ def connect_oura_link(auth_client):
     return url[0]
 
 
+def payload_hashes(oura_data):
+    '''
+    Hash the raw api payload of each summary_date
+    :return: dict of {summary_date: hash}
+    '''
+    days = {}
+    for x in oura_data:
+        days.setdefault(x.get('summary_date'), []).append(x)
+    return {day: hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            for day, payload in days.items()}
+
+
+def changed_days(hashes):
+    return [pd.to_datetime(day).date() for day in hashes.keys()]
+
+
+def changed_payloads(oura_data, table_name):
+    '''
+    Filter api payload down to the days that are new or have changed since they were last written to table_name
+    :return: (filtered payload, dict of {summary_date: hash} for the days that changed)
+    '''
+    hashes = payload_hashes(oura_data)
+    session, engine = db_connect()
+    stored = dict(session.query(ouraDayHash.day, ouraDayHash.content_hash).filter(
+        ouraDayHash.table_name == table_name,
+        ouraDayHash.day.in_(changed_days(hashes))).all())
+    session.close()
+    changed = {day: content_hash for day, content_hash in hashes.items() if
+               stored.get(pd.to_datetime(day).date()) != content_hash}
+    app.server.logger.debug(
+        '{} of {} days changed for {}'.format(len(changed), len(hashes), table_name))
+    return [x for x in oura_data if x.get('summary_date') in changed], changed
+
+
+def save_payload_hashes(con, table_name, hashes):
+    df = pd.DataFrame({'table_name': table_name,
+                       'day': changed_days(hashes),
+                       'content_hash': list(hashes.values())})
+    db_upsert(df.set_index(['table_name', 'day']), 'oura_day_hash', con=con)
+
+
+activity_class_desc = ['Rest', 'Inactive', 'Low', 'Medium', 'High', 'Non-Wear']
+hypnogram_desc = ['Deep', 'Light', 'REM', 'Awake']
+
+
+def local_times(timestamps):
+    '''
+    Oura timestamps carry the utc offset of wherever the ring was, keep the local wall clock time without it
+    :return: naive datetime64 array
+    '''
+    return np.array([pd.Timestamp(x).tz_localize(None).to_datetime64() for x in timestamps], dtype='datetime64[ns]')
+
+
+def digit_codes(strings):
+    '''
+    Every day's string of 1 digit codes (class_5min, hypnogram_5min) as one flat int8 array
+    '''
+    return (np.frombuffer(''.join(strings).encode('ascii'), dtype=np.uint8) - ord('0')).astype(np.int8)
+
+
+def flat_samples(days, key):
+    '''
+    One list of numbers per day flattened into a single series, as the smallest int dtype that holds them (float when
+    there are gaps or fractions)
+    :return: (series, per day lengths)
+    '''
+    lists = [x.get(key) or [] for x in days]
+    lengths = np.array([len(x) for x in lists], dtype=np.int64)
+    values = pd.Series([y for x in lists for y in x], dtype='float64')
+    return pd.to_numeric(values, downcast='integer'), lengths
+
+
+def sample_times(starts, lengths, minutes):
+    '''
+    Timestamps of every sample: each day's start plus its position in the day times the sample interval
+    :param starts: datetime64 start of each day
+    :param lengths: number of samples in each day
+    '''
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets * np.timedelta64(minutes, 'm')
+
+
+def pad_to(values, lengths, day_lengths):
+    '''
+    Spread a flattened stream over days of day_lengths samples, the tail of a day is missing where the stream is
+    shorter than that day's longest stream
+    :return: series, unchanged when the stream fills every day
+    '''
+    if np.array_equal(lengths, day_lengths):
+        return values
+    padded = np.full(day_lengths.sum(), np.nan)
+    padded[np.arange(lengths.sum()) + np.repeat((np.cumsum(day_lengths) - day_lengths) - (np.cumsum(lengths) - lengths),
+                                                lengths)] = values
+    return pd.Series(padded)
+
+
+def activity_samples(oura_data):
+    '''
+    met_1min and class_5min for every day of an activity payload in one pass, class_5min is joined onto the 1 minute
+    sample at the start of each 5 minutes
+    :return: df indexed on timestamp_local
+    '''
+    day_starts = local_times(x.get('day_start') for x in oura_data)
+    summary_dates = pd.to_datetime([x.get('summary_date') for x in oura_data]).date
+
+    met, met_lengths = flat_samples(oura_data, 'met_1min')
+    df_1min = pd.DataFrame({'met_1min': met.astype('float64').to_numpy(),
+                            'summary_date': np.repeat(summary_dates, met_lengths)},
+                           index=pd.DatetimeIndex(sample_times(day_starts, met_lengths, 1), name='timestamp_local'))
+
+    classes = [x.get('class_5min') or '' for x in oura_data]
+    class_lengths = np.array([len(x) for x in classes], dtype=np.int64)
+    codes = digit_codes(classes)
+    df_5min = pd.DataFrame({
+        'class_5min': pd.array(codes, dtype='Int8'),
+        'class_5min_desc': pd.Categorical.from_codes(np.where(codes <= 5, codes, -1), activity_class_desc)
+    }, index=pd.DatetimeIndex(sample_times(day_starts, class_lengths, 5), name='timestamp_local'))
+
+    return df_1min.merge(df_5min, how='left', left_index=True, right_index=True)
+
+
+def sleep_samples(oura_data):
+    '''
+    hr_5min, rmssd_5min and hypnogram_5min for every night of a sleep payload in one pass. Streams of one night can
+    differ in length, the shorter ones are left missing at the end
+    :return: df indexed on timestamp_local
+    '''
+    bedtime_starts = local_times(x.get('bedtime_start') for x in oura_data)
+    summary_dates = pd.to_datetime([x.get('summary_date') for x in oura_data])
+
+    hr, hr_lengths = flat_samples(oura_data, 'hr_5min')
+    rmssd, rmssd_lengths = flat_samples(oura_data, 'rmssd_5min')
+    hypnograms = [x.get('hypnogram_5min') or '' for x in oura_data]
+    hypnogram_lengths = np.array([len(x) for x in hypnograms], dtype=np.int64)
+    day_lengths = np.maximum.reduce([hr_lengths, rmssd_lengths, hypnogram_lengths])
+
+    hypnogram = pad_to(pd.Series(digit_codes(hypnograms)), hypnogram_lengths, day_lengths)
+    codes = hypnogram.fillna(0).to_numpy(dtype=np.int8)
+    return pd.DataFrame({
+        'hr_5min': pad_to(hr, hr_lengths, day_lengths).to_numpy(),
+        'rmssd_5min': pad_to(rmssd, rmssd_lengths, day_lengths).to_numpy(),
+        'hypnogram_5min': pd.array(hypnogram.to_numpy(), dtype='Int8'),
+        'hypnogram_5min_desc': pd.Categorical.from_codes(np.where((codes >= 1) & (codes <= 4), codes - 1, -1),
+                                                         hypnogram_desc),
+        'summary_date': np.repeat(summary_dates.date, day_lengths),
+        'report_date': np.repeat((summary_dates + timedelta(days=1)).date, day_lengths)
+    }, index=pd.DatetimeIndex(sample_times(bedtime_starts, day_lengths, 5), name='timestamp_local'))
+
+
 def pull_readiness_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraReadinessSummary.report_date))
-    engine.dispose()
     session.close()
     start = '1999-01-01' if start[0][0] is None else datetime.strftime(start[0][0] - timedelta(days=days_back),
                                                                        '%Y-%m-%d')
 
     app.server.logger.debug('Pulling readiness from max date in oura_readiness_summary {}'.format(start))
-    oura_data = oura.readiness_summary(start=start)['readiness']
+    oura_data, hashes = changed_payloads(oura.readiness_summary(start=start)['readiness'], 'oura_readiness_summary')
 
     if len(oura_data) > 0:
         df_readiness_summary = pd.DataFrame.from_dict(oura_data)
@@ -102,29 +251,18 @@ def pull_readiness_data(oura, days_back=7):
                 pd.to_datetime(df_readiness_summary['summary_date']) + timedelta(days=1)).dt.date
         df_readiness_summary.set_index('report_date', inplace=True)
 
-        return df_readiness_summary
+        return df_readiness_summary, hashes
     else:
-        return []
+        return [], {}
 
 
-def insert_readiness_data(df_readiness_summary, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraReadinessSummary.report_date))
-    start = '1999-01-01' if start[0][0] is None else datetime.strftime(start[0][0] - timedelta(days=days_back),
-                                                                       '%Y-%m-%d')
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_readiness_summary'.format(start))
-        session.execute(delete(ouraReadinessSummary).where(ouraReadinessSummary.summary_date >= start))
-        session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
-
-    engine.dispose()
-    session.close()
-
-    app.server.logger.debug('Inserting oura readiness summary')
-    db_insert(df_readiness_summary, 'oura_readiness_summary')
+def insert_readiness_data(df_readiness_summary, hashes):
+    # Only days whose payload changed make it this far, upsert them so re-pulled days overwrite in place
+    if len(df_readiness_summary) > 0:
+        app.server.logger.debug('Upserting {} days into oura readiness summary'.format(len(df_readiness_summary)))
+        with get_engine().begin() as conn:
+            db_upsert(df_readiness_summary, 'oura_readiness_summary', con=conn)
+            save_payload_hashes(conn, 'oura_readiness_summary', hashes)
 
 
 def pull_activity_data(oura, days_back=7):
@@ -133,13 +271,12 @@ def pull_activity_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraActivitySummary.summary_date))[0][0]
-    engine.dispose()
     session.close()
 
     start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
 
     app.server.logger.debug('Pulling activity from max date in oura_activity_summary {}'.format(start))
-    oura_data = oura.activity_summary(start=start)['activity']
+    oura_data, hashes = changed_payloads(oura.activity_summary(start=start)['activity'], 'oura_activity_summary')
 
     if len(oura_data) > 0:
         df_activity_summary = pd.DataFrame.from_dict(oura_data)
@@ -152,86 +289,39 @@ def pull_activity_data(oura, days_back=7):
         df_activity_summary = df_activity_summary.drop(columns=['met_1min', 'day_end', 'day_start'], axis=1)
 
         # Generate Activity Samples
-        df_1min_list, df_5min_list = [], []
-        for x in oura_data:
-            # build 1 min metrics df
-            df_1min = pd.Series(x.get('met_1min'), name='met_1min').to_frame()
-            df_1min['timestamp_local'] = pd.to_datetime(x.get('day_start')) + pd.to_timedelta(df_1min.index, unit='m')
-            df_1min = df_1min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_1min.index = df_1min.index.tz_localize(None)
-            df_1min['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df_1min_list.append(df_1min)
-
-            # build 5 min metrics df
-            df_5min = pd.Series([int(y) for y in x.get('class_5min')], name='class_5min').to_frame()
-            df_5min['class_5min_desc'] = df_5min['class_5min'].fillna('5').astype('str').map(
-                {'0': 'Rest', '1': 'Inactive', '2': 'Low', '3': 'Medium', '4': 'High', '5': 'Non-Wear'})
-            df_5min.index += 1
-            df_5min['timestamp_local'] = (pd.to_datetime(x.get('day_start')) + pd.to_timedelta(df_5min.index * 5,
-                                                                                               unit='m')) - pd.to_timedelta(
-                5, unit='m')
-            df_5min = df_5min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_5min.index = df_5min.index.tz_localize(None)
-            df_5min['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df_5min_list.append(df_5min)
-
-        df_1min = pd.concat(df_1min_list)
-        df_5min = pd.concat(df_5min_list)
-
-        df_activity_samples = df_1min.merge(df_5min, how='left', left_index=True, right_index=True)
-        df_activity_samples['summary_date'] = df_activity_samples['summary_date_x']
-        df_activity_samples = df_activity_samples.drop(columns=['summary_date_x', 'summary_date_y'], axis=1)
-
-        return df_activity_summary, df_activity_samples
-    else:
-        return [], []
-
-
-def insert_activity_data(df_activity_summary, df_activity_samples, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraActivitySummary.summary_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
-
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_activity_summary'.format(start))
-        session.execute(delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= start))
-        app.server.logger.debug('Deleting >= {} records from oura_activity_samples'.format(start))
-        session.execute(delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= start))
-        session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
-
-    engine.dispose()
-    session.close()
-
-    # Insert Activity Summary
-    app.server.logger.debug('Inserting oura activity summary')
-    try:
-        db_insert(df_activity_summary, 'oura_activity_summary')
-    except BaseException as e:
-        app.server.logger.error(e)
+        df_activity_samples = activity_samples(oura_data)
 
-    # Insert Activity Samples
-    app.server.logger.debug('Inserting oura activity samples')
-    try:
-        db_insert(df_activity_samples, 'oura_activity_samples')
-    except BaseException as e:
-        app.server.logger.error(e)
+        return df_activity_summary, df_activity_samples, hashes
+    else:
+        return [], [], {}
+
+
+def insert_activity_data(df_activity_summary, df_activity_samples, hashes):
+    # Summary, samples and hashes for the changed days are written together so a failure leaves the days to be retried.
+    # A revised day can have fewer samples than before, so its old samples are deleted rather than upserted over
+    if len(df_activity_summary) > 0:
+        app.server.logger.debug('Upserting {} days into oura activity summary and samples'.format(
+            len(df_activity_summary)))
+        try:
+            with get_engine().begin() as conn:
+                db_upsert(df_activity_summary, 'oura_activity_summary', con=conn)
+                conn.execute(delete(ouraActivitySamples).where(
+                    ouraActivitySamples.summary_date.in_(changed_days(hashes))))
+                db_upsert(df_activity_samples, 'oura_activity_samples', con=conn)
+                save_payload_hashes(conn, 'oura_activity_summary', hashes)
+        except BaseException as e:
+            app.server.logger.error(e)
 
 
 def pull_sleep_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    engine.dispose()
     session.close()
     start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
 
     app.server.logger.debug('Pulling sleep from max date in oura_sleep_summary {}'.format(start))
-    oura_data = oura.sleep_summary(start=start)['sleep']
+    oura_data, hashes = changed_payloads(oura.sleep_summary(start=start)['sleep'], 'oura_sleep_summary')
 
     if len(oura_data) > 0:
         # Sleep Summary
@@ -250,65 +340,26 @@ def pull_sleep_data(oura, days_back=7):
                                                  axis=1)
 
         # Sleep Samples
-        df_samples_list = []
-        for x in oura_data:
-            df = pd.concat(
-                [pd.Series(x.get('hr_5min'), name='hr_5min'), pd.Series(x.get('rmssd_5min'), name='rmssd_5min'),
-                 pd.Series([int(y) for y in x.get('hypnogram_5min')], name='hypnogram_5min')],
-                axis=1)
-            df['hypnogram_5min_desc'] = df['hypnogram_5min'].map(
-                {1: 'Deep', 2: 'Light', 3: 'REM', 4: 'Awake'})
-
-            df.index += 1
-            df['timestamp_local'] = (pd.to_datetime(x.get('bedtime_start')) + pd.to_timedelta(df.index * 5,
-                                                                                              unit='m')) - pd.to_timedelta(
-                5, unit='m')
-
-            df['summary_date'] = pd.to_datetime(x.get('summary_date')).date()
-            df['report_date'] = df['summary_date'] + timedelta(days=1)
-            df = df.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df.index = df.index.tz_localize(None)
-            df_samples_list.append(df)
-
-        df_sleep_samples = pd.concat(df_samples_list)
-
-        return df_sleep_summary, df_sleep_samples
-    else:
-        return [], []
-
-
-def insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
+        df_sleep_samples = sleep_samples(oura_data)
 
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        app.server.logger.debug('Deleting >= {} records from oura_sleep_summary'.format(start))
-        session.execute(delete(ouraSleepSummary).where(ouraSleepSummary.summary_date >= start))
-        app.server.logger.debug('Deleting >= {} records from oura_sleep_samples'.format(start))
-        session.execute(delete(ouraSleepSamples).where(ouraSleepSamples.summary_date >= start))
-        session.commit()
-    except BaseException as e:
-        app.server.logger.error(e)
+        return df_sleep_summary, df_sleep_samples, hashes
+    else:
+        return [], [], {}
 
-    engine.dispose()
-    session.close()
 
-    # Insert Sleep Summary
-    app.server.logger.debug('Inserting oura sleep summary')
-    try:
-        db_insert(df_sleep_summary, 'oura_sleep_summary')
-    except BaseException as e:
-        app.server.logger.error(e)
-
-    # Insert Sleep Samples
-    # app.server.logger.debug('Inserting oura sleep samples')
-    try:
-        db_insert(df_sleep_samples, 'oura_sleep_samples')
-    except BaseException as e:
-        app.server.logger.error(e)
+def insert_sleep_data(df_sleep_summary, df_sleep_samples, hashes):
+    if len(df_sleep_summary) > 0:
+        app.server.logger.debug('Upserting {} days into oura sleep summary and samples'.format(len(df_sleep_summary)))
+        try:
+            with get_engine().begin() as conn:
+                db_upsert(df_sleep_summary, 'oura_sleep_summary', con=conn)
+                # Bedtimes can move when a day is revised, so samples are matched on the day rather than timestamp
+                conn.execute(delete(ouraSleepSamples).where(
+                    ouraSleepSamples.report_date.in_([day + timedelta(days=1) for day in changed_days(hashes)])))
+                db_upsert(df_sleep_samples, 'oura_sleep_samples', con=conn)
+                save_payload_hashes(conn, 'oura_sleep_summary', hashes)
+        except BaseException as e:
+            app.server.logger.error(e)
 
 
 def pull_oura_data():
@@ -318,15 +369,21 @@ def pull_oura_data():
         token_dict = current_token_dict()
         oura = OuraClient(client_id=client_id, client_secret=client_secret, access_token=token_dict['access_token'],
                           refresh_token=token_dict['refresh_token'], refresh_callback=save_oura_token)
-        df_readiness_summary = pull_readiness_data(oura, days_back)
-        df_activity_summary, df_activity_samples = pull_activity_data(oura, days_back)
-        df_sleep_summary, df_sleep_samples = pull_sleep_data(oura, days_back)
+        df_readiness_summary, readiness_hashes = pull_readiness_data(oura, days_back)
+        df_activity_summary, df_activity_samples, activity_hashes = pull_activity_data(oura, days_back)
+        df_sleep_summary, df_sleep_samples, sleep_hashes = pull_sleep_data(oura, days_back)
 
-        insert_readiness_data(df_readiness_summary, days_back)
-        insert_activity_data(df_activity_summary, df_activity_samples, days_back)
-        insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back)
+        insert_readiness_data(df_readiness_summary, readiness_hashes)
+        insert_activity_data(df_activity_summary, df_activity_samples, activity_hashes)
+        insert_sleep_data(df_sleep_summary, df_sleep_samples, sleep_hashes)
+
+        # Unchanged days are no longer re-pulled into the dfs, so compare what is now stored in the db
+        session, engine = db_connect()
+        latest_sleep = session.query(func.max(ouraSleepSummary.report_date))[0][0]
+        latest_readiness = session.query(func.max(ouraReadinessSummary.report_date))[0][0]
+        session.close()
 
-        return df_sleep_summary.index.max() == df_readiness_summary.index.max()  # == df_activity_summary.index.max()
+        return latest_sleep == latest_readiness
 
     # Oura API returns times (bedtime_start, bedtime_end etc. in the timezone of the location where went to sleep.
     # Do not need to convert to UTC because we want the time we went to sleep wherever we went to sleep, not necessarily always EST
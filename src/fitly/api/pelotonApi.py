@@ -755,7 +755,6 @@ def set_peloton_workout_recommendations():
         hrvWorkoutStepLog.date.desc()).first().hrv_workout_step_desc
     athlete_bookmarks = json.loads(session.query(athlete.peloton_auto_bookmark_ids).filter(
         athlete.athlete_id == 1).first().peloton_auto_bookmark_ids)
-    engine.dispose()
     session.close()
 
     fitness_disciplines = athlete_bookmarks.keys()
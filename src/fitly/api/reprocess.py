@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+from ..api.sqlalchemy_declarative import db_connect, db_upsert, get_engine, session_scope, stravaSummary
+from ..api.fitlyAPI import FitlyActivity, ActivityAnalysis, analysis_pipeline, strava_workers
+from ..api.asOfIndex import load_ingestion_index
+from ..api.sampleStore import get_activity_samples, has_samples, sample_store_enabled, write_samples
+from ..api.bestEnvelope import update_best_envelope, truncate_best_envelope
+from ..api.dailyMetrics import update_daily_metrics
+from ..api.strydAPI import get_stryd_df_summary
+from ..api.jobQueue import merge_queued_job, report_progress
+from ..app import app
+from ..utils import stryd_credentials_supplied
+
+# Recompute zones, intensities, tss/hrss/trimp and best samples from stored samples, so athlete setting changes can be
+# applied to history without truncating and re-downloading every stream from Strava.
+
+intensity_columns = ['low_intensity_seconds', 'med_intensity_seconds', 'high_intensity_seconds']
+
+
+class StoredActivity(ActivityAnalysis):
+    '''
+    An activity rebuilt from its strava_summary row and stored samples, analyzed with the same steps as a new one
+    '''
+    assign_athlete = FitlyActivity.assign_athlete
+    get_ftp = FitlyActivity.get_ftp
+    get_rest_hr = FitlyActivity.get_rest_hr
+    get_weight = FitlyActivity.get_weight
+    add_summary_analytics = FitlyActivity.add_summary_analytics
+
+    def __init__(self, summary):
+        '''
+        :param summary: strava_summary row
+        '''
+        self.id = int(summary['activity_id'])
+        self.type = '' if pd.isnull(summary['type']) else summary['type']
+        self.name = summary['name']
+        # strava_summary keeps utc start dates naive
+        self.start_date = pd.Timestamp(summary['start_date_utc']).to_pydatetime()
+        self.start_date_local = pd.Timestamp(summary['start_date_local']).to_pydatetime()
+        self.max_watts = None if pd.isnull(summary['max_watts']) else float(summary['max_watts'])
+        self.max_heartrate = None if pd.isnull(summary['max_heartrate']) else float(summary['max_heartrate'])
+        self.df_summary = summary.to_frame().T.set_index('start_date_utc')
+        self.in_sample_store = False
+
+    def prepare(self, athlete_id, index, as_of):
+        self.assign_athlete(athlete_id, index.athlete_info)
+        self.get_ftp(as_of, index.stryd_df)
+        self.get_rest_hr(as_of)
+        self.get_weight(as_of)
+        self.in_sample_store = sample_store_enabled and has_samples(self.id)
+        self.df_samples = get_activity_samples(self.id)
+        # Cleared so values that no longer apply (i.e. power zones after ftp was removed) are not kept
+        self.df_samples['power_zone'] = np.nan
+        self.df_samples['hr_zone'] = np.nan
+        for col in intensity_columns:
+            self.df_summary[col] = None
+
+    def write_reprocessed(self):
+        self.add_summary_analytics()
+        with get_engine().begin() as con:
+            db_upsert(self.df_summary, 'strava_summary', con=con)
+            if not self.in_sample_store:
+                db_upsert(self.df_samples[['power_zone', 'hr_zone']], 'strava_samples', con=con)
+            if getattr(self, 'df_best_samples', None) is not None:
+                db_upsert(self.df_best_samples, 'strava_best_samples', con=con)
+        if self.in_sample_store:
+            write_samples(self.df_samples, self.id)
+
+
+def load_stored_activities(activity_ids=None, since=None, until=None, sport=None):
+    '''
+    Activities in strava_summary, oldest to newest
+    :param since: first start_date_local to include
+    :param until: last start_date_local to include
+    :param sport: only activities whose type contains this (i.e. 'ride')
+    :return: list of StoredActivity
+    '''
+    session, engine = db_connect()
+    query = session.query(stravaSummary)
+    if activity_ids is not None:
+        query = query.filter(stravaSummary.activity_id.in_([int(x) for x in activity_ids]))
+    if since is not None:
+        query = query.filter(stravaSummary.start_date_local >= since)
+    if until is not None:
+        query = query.filter(stravaSummary.start_date_local <= until)
+    if sport is not None:
+        query = query.filter(stravaSummary.type.ilike('%' + sport + '%'))
+    df = pd.read_sql(sql=query.order_by(stravaSummary.start_date_local).statement, con=engine)
+    session.close()
+    return [StoredActivity(row) for _, row in df.iterrows()]
+
+
+def reprocess_activities(activity_ids=None, since=None, until=None, sport=None, workers=None, athlete_id=1):
+    '''
+    Recompute derived metrics for stored activities with the current athlete settings
+    :param workers: activities analyzed in parallel, defaults to [strava] workers in config.ini
+    :return: number of activities reprocessed
+    '''
+    workers = strava_workers if workers is None else workers
+    activities = load_stored_activities(activity_ids, since, until, sport)
+    if len(activities) == 0:
+        return 0
+    index = load_ingestion_index(athlete_id)
+    if stryd_credentials_supplied and any('run' in x.type.lower() or 'walk' in x.type.lower() for x in activities):
+        index.stryd_df = get_stryd_df_summary()
+    as_of = index.activity_values(activities)
+
+    def prepare(i, activity):
+        activity.prepare(athlete_id, index, as_of.loc[activity.id])
+
+    written = []
+
+    def write(activity):
+        app.server.logger.debug('Activity id "{}": Writing reprocessed metrics to DB'.format(activity.id))
+        activity.write_reprocessed()
+        written.append(activity.id)
+        report_progress('Reprocessing activities', len(written), len(activities))
+
+    analysis_pipeline(activities, prepare, write, workers)
+
+    # Best samples were replaced rather than added to, so the envelope is rebuilt instead of merged
+    report_progress('Rebuilding power curve envelope')
+    with session_scope() as session:
+        truncate_best_envelope(session)
+    update_best_envelope()
+    update_daily_metrics(activities[0].start_date_local.date(), athlete_id=athlete_id)
+    return len(activities)
+
+
+def affected_activities(setting, athlete_id=1):
+    '''
+    Activities whose derived metrics depend on an athlete setting
+    :param setting: athlete setting changed on the settings page
+    :return: list of activity ids, empty when the setting is not used by activity analysis
+    '''
+    session, engine = db_connect()
+    df = pd.read_sql(
+        sql=session.query(stravaSummary.activity_id, stravaSummary.type, stravaSummary.start_date_local,
+                          stravaSummary.max_watts, stravaSummary.max_heartrate).statement, con=engine)
+    session.close()
+    types = df['type'].fillna('').str.lower()
+    rides = types.str.contains('ride')
+    runs = types.str.contains('run') | types.str.contains('walk')
+    has_power = df['max_watts'].notnull()
+    has_hr = df['max_heartrate'].notnull()
+    none = pd.Series(False, index=df.index)
+
+    if setting == 'ride_ftp':
+        # Rides without an earlier ftp test use the static ride ftp
+        index = load_ingestion_index(athlete_id)
+        affected = rides & pd.isnull(index.ride_ftp_tests.asof(df['start_date_local']))
+    elif setting == 'run_ftp':
+        affected = runs
+    elif setting.startswith('cycle_power_zone_threshold'):
+        affected = rides & has_power
+    elif setting.startswith('run_power_zone_threshold'):
+        affected = runs & has_power
+    elif setting.startswith('hr_power_zone_threshold') or setting.startswith('hr_zone_threshold') or \
+            setting == 'birthday':
+        affected = has_hr
+    elif setting in ['rest_hr', 'resting_hr']:
+        # Only used when there is no oura resting hr to look up
+        affected = has_hr if len(load_ingestion_index(athlete_id).rest_hr) == 0 else none
+    elif setting in ['weight', 'weight_lbs']:
+        # Only used when there are no withings weights to look up, every summary stores the weight it was analyzed at
+        affected = ~none if len(load_ingestion_index(athlete_id).weight) == 0 else none
+    else:
+        affected = none
+    return [int(x) for x in df.loc[affected.to_numpy(), 'activity_id']]
+
+
+def reprocess_setting_change(setting, athlete_id=1):
+    '''
+    Queue a reprocess of the activities affected by an athlete setting change, for the worker to run. Editing several
+    settings before the worker gets to it queues a single reprocess covering all of them
+    :return: job id, None when the setting is not used by activity analysis
+    '''
+    if len(affected_activities(setting, athlete_id)) == 0:
+        return None
+    app.server.logger.info('Queueing reprocess of activities after {} changed'.format(setting))
+    return merge_queued_job('reprocess', merge_settings, settings=[setting], athlete_id=athlete_id)
+
+
+def merge_settings(queued, params):
+    # Only setting change jobs are merged, a reprocess queued from the cli runs as it was asked for
+    if sorted(queued) != ['athlete_id', 'settings'] or queued['athlete_id'] != params['athlete_id']:
+        return None
+    return dict(queued, settings=sorted(set(queued['settings']) | set(params['settings'])))
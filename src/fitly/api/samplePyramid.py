@@ -0,0 +1,122 @@
+import pandas as pd
+from sqlalchemy import func, delete
+from ..api.sqlalchemy_declarative import db_connect, db_insert, stravaSummary, stravaSamplesPyramid
+from ..api.sampleStore import get_activity_samples, epoch
+
+# Charting levels of each activity's 1s samples, bucketed to min/mean/max at coarser resolutions so the workout trend
+# chart sends a bounded number of points no matter how long the activity is. Level 1 is strava_samples itself.
+pyramid_resolutions = [5, 30, 120]
+pyramid_streams = ['velocity_smooth', 'cadence', 'heartrate', 'watts']
+
+# Points per trace the trend chart is sized for (roughly the modal width in pixels)
+max_chart_points = 1500
+
+
+def build_pyramid(df_samples, activity_id=None):
+    '''
+    Bucket one activity's samples into every pyramid level
+    :param df_samples: samples df for a single activity with a 'time' column in seconds
+    :return: df indexed on (activity_id, resolution, time) matching strava_samples_pyramid
+    '''
+    activity_id = int(df_samples['activity_id'].iloc[0]) if activity_id is None else int(activity_id)
+    df = df_samples.reindex(columns=['time'] + pyramid_streams).apply(pd.to_numeric, errors='coerce')
+    levels = []
+    for resolution in pyramid_resolutions:
+        level = df.groupby((df['time'] // resolution * resolution).rename('bucket'))[pyramid_streams].agg(
+            ['mean', 'min', 'max'])
+        level.columns = ['{}_{}'.format(stream, stat) for stream, stat in level.columns]
+        level['resolution'] = resolution
+        levels.append(level)
+    pyramid = pd.concat(levels).rename_axis('time').reset_index()
+    pyramid['time'] = pyramid['time'].astype(int)
+    pyramid['activity_id'] = activity_id
+    pyramid['time_interval'] = epoch + pd.to_timedelta(pyramid['time'], unit='s')
+    return pyramid.set_index(['activity_id', 'resolution', 'time'])
+
+
+def full_resolution(df_samples):
+    '''
+    1s samples in pyramid shape, min and max are the sample itself
+    '''
+    df = df_samples.reindex(columns=['time', 'time_interval'] + pyramid_streams)
+    for stream in pyramid_streams:
+        df[stream + '_mean'] = df[stream + '_min'] = df[stream + '_max'] = pd.to_numeric(df[stream], errors='coerce')
+    return df.drop(columns=pyramid_streams).reset_index(drop=True)
+
+
+def chart_resolution(seconds, max_points=max_chart_points):
+    '''
+    Finest level that fits a time range of the given length into max_points
+    '''
+    for resolution in [1] + pyramid_resolutions:
+        if seconds / resolution <= max_points:
+            return resolution
+    return pyramid_resolutions[-1]
+
+
+def get_chart_samples(activity_id, start_seconds=None, end_seconds=None, max_points=max_chart_points):
+    '''
+    Samples for the workout trend chart at the level that fits the requested range
+    :param start_seconds: start of the visible range, defaults to the start of the activity
+    :param end_seconds: end of the visible range, defaults to the end of the activity
+    :return: df with time, time_interval, resolution and <stream>_mean/_min/_max columns, one row per bucket
+    '''
+    session, engine = db_connect(read_only=True)
+    length = session.query(func.max(stravaSamplesPyramid.time)).filter(
+        stravaSamplesPyramid.activity_id == activity_id,
+        stravaSamplesPyramid.resolution == pyramid_resolutions[0]).scalar()
+    df_samples = None
+    if length is None:
+        # Activities ingested before the pyramid existed are bucketed on the fly
+        df_samples = get_activity_samples(activity_id, engine, session)
+        length = df_samples['time'].max() if len(df_samples) > 0 else 0
+    start = 0 if start_seconds is None else max(int(start_seconds), 0)
+    end = length + pyramid_resolutions[0] if end_seconds is None else int(end_seconds)
+    resolution = chart_resolution(end - start, max_points)
+
+    if resolution == 1:
+        df_samples = get_activity_samples(activity_id, engine, session) if df_samples is None else df_samples
+        df = full_resolution(df_samples)
+    elif df_samples is not None:
+        df = build_pyramid(df_samples, activity_id).loc[(int(activity_id), resolution)].reset_index()
+    else:
+        df = pd.read_sql(
+            sql=session.query(stravaSamplesPyramid).filter(stravaSamplesPyramid.activity_id == activity_id,
+                                                           stravaSamplesPyramid.resolution == resolution,
+                                                           stravaSamplesPyramid.time >= start - resolution,
+                                                           stravaSamplesPyramid.time <= end).statement,
+            con=engine)
+    session.close()
+    df = df[(df['time'] > start - resolution) & (df['time'] <= end)].sort_values('time')
+    df['time_interval'] = pd.to_datetime(df['time_interval'])
+    df['resolution'] = resolution
+    return df
+
+
+def delete_pyramid(session, activity_ids=None):
+    '''
+    Delete the pyramid for the given activities (or every activity)
+    '''
+    if activity_ids is None:
+        session.execute(delete(stravaSamplesPyramid))
+    else:
+        session.execute(delete(stravaSamplesPyramid).where(stravaSamplesPyramid.activity_id.in_(activity_ids)))
+
+
+def backfill_pyramid():
+    '''
+    Write the pyramid for every activity that does not have one yet
+    :return: number of activities written
+    '''
+    session, engine = db_connect()
+    built = {x[0] for x in session.query(stravaSamplesPyramid.activity_id).distinct().all()}
+    activity_ids = [x[0] for x in session.query(stravaSummary.activity_id).all() if x[0] not in built]
+    written = 0
+    for activity_id in activity_ids:
+        df_samples = get_activity_samples(activity_id, engine, session)
+        if len(df_samples) == 0:
+            continue
+        db_insert(build_pyramid(df_samples, activity_id), 'strava_samples_pyramid', con=engine)
+        written += 1
+    session.close()
+    return written
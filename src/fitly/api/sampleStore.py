@@ -0,0 +1,195 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from sqlalchemy import text
+from ..api.sqlalchemy_declarative import db_connect, stravaSamples, stravaSummary
+from ..utils import config
+
+# Per second activity streams stored as one .npy file per column under <path>/<activity_id>/, so they can be opened
+# with mmap and sliced without loading the activity into memory. Values repeated on every row of strava_samples
+# (act_name, type, athlete_id, date...) are kept once in meta.json.
+sample_store_enabled = config.get('sample_store', 'enabled', fallback='False').lower() == 'true'
+sample_store_path = config.get('sample_store', 'path', fallback='./config/samples')
+
+# Compact dtypes for each stream. Zones and other nullable integer streams stay float so NaN survives the round trip
+stream_dtypes = {
+    'time': 'int32',
+    'distance': 'float32',
+    'velocity_smooth': 'float32',
+    'temp': 'float32',
+    'altitude': 'float32',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'heartrate': 'float32',
+    'cadence': 'float32',
+    'watts': 'float32',
+    'moving': 'float32',
+    'grade_smooth': 'float32',
+    'ftp': 'float32',
+    'power_zone': 'float32',
+    'hr_zone': 'float32',
+    'hr_lowest': 'float32',
+}
+
+meta_columns = ['activity_id', 'act_name', 'type', 'athlete_id']
+
+epoch = pd.Timestamp('1970-01-01')
+
+
+def activity_path(activity_id):
+    return os.path.join(sample_store_path, str(int(activity_id)))
+
+
+def has_samples(activity_id):
+    return os.path.exists(os.path.join(activity_path(activity_id), 'meta.json'))
+
+
+def write_samples(df_samples, activity_id=None):
+    '''
+    Write a strava_samples shaped df (indexed on timestamp_local at 1s intervals) to the store
+    :param df_samples: samples df for a single activity
+    :param activity_id: defaults to the activity_id column of df_samples
+    :return: number of bytes written
+    '''
+    activity_id = int(df_samples['activity_id'].iloc[0]) if activity_id is None else int(activity_id)
+    df_samples = df_samples.sort_index()
+    meta = {col: (df_samples[col].iloc[0] if col in df_samples.columns else None) for col in meta_columns}
+    meta['activity_id'] = activity_id
+    meta['athlete_id'] = None if meta['athlete_id'] is None or pd.isnull(meta['athlete_id']) else int(
+        meta['athlete_id'])
+    meta['start'] = pd.Timestamp(df_samples.index[0]).isoformat()
+    meta['length'] = len(df_samples)
+    meta['columns'] = [col for col in stream_dtypes if col in df_samples.columns]
+
+    # Write to a temp dir and swap it in so readers never see a half written activity
+    path = activity_path(activity_id)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    size = 0
+    for col in meta['columns']:
+        values = pd.to_numeric(df_samples[col], errors='coerce').to_numpy(dtype='float64')
+        if np.issubdtype(np.dtype(stream_dtypes[col]), np.integer):
+            values = np.nan_to_num(values)
+        values = values.astype(stream_dtypes[col])
+        np.save(os.path.join(tmp_path, col + '.npy'), values)
+        size += values.nbytes
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return size
+
+
+def load_streams(activity_id, columns=None):
+    '''
+    Open an activity's streams without copying them into memory
+    :return: (meta dict, {column: read only np.memmap}) or (None, {}) if the activity is not in the store
+    '''
+    path = activity_path(activity_id)
+    if not has_samples(activity_id):
+        return None, {}
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = meta['columns'] if columns is None else [col for col in columns if col in meta['columns']]
+    return meta, {col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r') for col in columns}
+
+
+def load_samples(activity_id):
+    '''
+    Load an activity from the store as a df matching pd.read_sql() on strava_samples (indexed on timestamp_local)
+    :return: df, or None if the activity is not in the store
+    '''
+    meta, streams = load_streams(activity_id)
+    if meta is None:
+        return None
+    index = pd.DatetimeIndex(pd.Timestamp(meta['start']) + pd.to_timedelta(np.arange(meta['length']), unit='s'),
+                             name='timestamp_local')
+    df = pd.DataFrame(streams, index=index, copy=False)
+    if 'time' in df.columns:
+        df['time_interval'] = epoch + pd.to_timedelta(df['time'].astype('int64'), unit='s')
+    df['date'] = df.index.date
+    for col in meta_columns:
+        df[col] = meta.get(col)
+    return df
+
+
+def delete_samples(activity_id):
+    shutil.rmtree(activity_path(activity_id), ignore_errors=True)
+
+
+def delete_all_samples():
+    shutil.rmtree(sample_store_path, ignore_errors=True)
+
+
+def get_activity_samples(activity_id, engine=None, session=None):
+    '''
+    Samples for one activity, from the store when present, otherwise from strava_samples
+    '''
+    df = load_samples(activity_id) if sample_store_enabled else None
+    if df is None:
+        close = session is None
+        if close:
+            session, engine = db_connect(read_only=True)
+        df = pd.read_sql(
+            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
+            con=engine,
+            index_col=['timestamp_local'])
+        if close:
+            session.close()
+    return df
+
+
+def get_samples_since(start_date):
+    '''
+    Samples for every activity at or after start_date (local time), from the store and strava_samples
+    '''
+    session, engine = db_connect(read_only=True)
+    df = pd.read_sql(
+        sql=session.query(stravaSamples).filter(stravaSamples.timestamp_local >= start_date).statement,
+        con=engine,
+        index_col=['timestamp_local'])
+    if sample_store_enabled:
+        activity_ids = [x[0] for x in session.query(stravaSummary.activity_id).filter(
+            stravaSummary.start_date_local >= start_date - timedelta(days=1)).all()]
+        in_db = set(df['activity_id'].unique())
+        stored = [load_samples(x) for x in activity_ids if x not in in_db]
+        stored = [x[x.index >= start_date] for x in stored if x is not None]
+        if len(stored) > 0:
+            df = pd.concat([df] + stored, sort=False)
+    session.close()
+    return df
+
+
+def migrate_samples_to_store(purge=False):
+    '''
+    Copy every activity in strava_samples into the store
+    :param purge: delete the rows from strava_samples once the activity has been written and vacuum the db
+    :return: (activities migrated, bytes written)
+    '''
+    session, engine = db_connect()
+    activity_ids = [x[0] for x in session.query(stravaSamples.activity_id).distinct().all()]
+    migrated, size = 0, 0
+    for activity_id in activity_ids:
+        df = pd.read_sql(
+            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
+            con=engine,
+            index_col=['timestamp_local'])
+        if len(df) == 0:
+            continue
+        size += write_samples(df, activity_id)
+        migrated += 1
+        if purge:
+            session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).delete(
+                synchronize_session=False)
+            session.commit()
+    session.close()
+
+    if purge and engine.dialect.name == 'sqlite':
+        # Give the freed pages back to the filesystem
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+    return migrated, size
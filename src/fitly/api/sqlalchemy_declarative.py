@@ -1,30 +1,143 @@
+import os
 import sys
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, create_engine, BigInteger
+import time
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, create_engine, BigInteger, event, \
+    Index, inspect, text, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from datetime import datetime
+from urllib.parse import quote_plus
+import pandas as pd
+from ..utils import config
 
 Base = declarative_base()
 
-# db = "mysql+pymysql://{}:{}@{}/{}?host={}?port={}".format(config.get("database", 'user'),
-#                                                           config.get("database", 'password'),
-#                                                           config.get("database", 'host'),
-#                                                           config.get("database", 'db_name'),
-#                                                           config.get("database", 'host'),
-#                                                           config.get("database", 'port')
-#                                                           )
 
-db = 'sqlite:///./config/fitness.db'
-
-
-def db_connect(db=db):
+def database_url():
+    '''
+    SQLAlchemy url from the [database] section of config.ini. Defaults to the local sqlite db when nothing is set.
+    '''
+    url = config.get('database', 'url', fallback='')
+    if url:
+        return url
+    dialect = config.get('database', 'dialect', fallback='') or 'sqlite'
+    if dialect == 'sqlite':
+        return 'sqlite:///./config/fitness.db'
+    return '{}://{}:{}@{}:{}/{}'.format(dialect,
+                                        quote_plus(config.get('database', 'user')),
+                                        quote_plus(config.get('database', 'password')),
+                                        config.get('database', 'host'),
+                                        config.get('database', 'port'),
+                                        config.get('database', 'db_name'))
+
+
+db = database_url()
+
+# One pooled engine per (worker process, db url, read only). Gunicorn preloads the app and then forks, so engines are
+# keyed on the pid as well to make sure a worker never reuses connections opened by its parent.
+_engines = {}
+
+session_factory = sessionmaker()
+
+
+def sqlite_pragmas(read_only=False):
+    '''
+    SQLite connection profile from the [sqlite] section of config.ini.
+    WAL lets dashboard reads run while the refresh job is writing; the rest trade a little durability for throughput.
+    '''
+    pragmas = {
+        'journal_mode': config.get('sqlite', 'journal_mode', fallback='WAL'),
+        'synchronous': config.get('sqlite', 'synchronous', fallback='NORMAL'),
+        'cache_size': config.getint('sqlite', 'cache_size', fallback=-64000),
+        'mmap_size': config.getint('sqlite', 'mmap_size', fallback=268435456),
+        'busy_timeout': config.getint('sqlite', 'busy_timeout', fallback=30000),
+        'temp_store': 'MEMORY',
+    }
+    if read_only:
+        # journal_mode is persisted on the db file by the writer, read connections only need to refuse writes
+        del pragmas['journal_mode']
+        pragmas['query_only'] = 'ON'
+    return pragmas
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(pragma, value))
+        cursor.close()
+
+
+def create_server_engine(db, read_only=False):
+    '''
+    Engine for a server database (mysql, postgresql) sized from the [database] section of config.ini
+    statement_timeout (ms, 0 = none) caps long running queries so a stuck callback cannot hold a connection forever
+    '''
+    statement_timeout = config.getint('database', 'statement_timeout', fallback=0)
+    engine = create_engine(db,
+                           pool_size=config.getint('database', 'pool_size', fallback=5),
+                           max_overflow=config.getint('database', 'max_overflow', fallback=10),
+                           pool_recycle=config.getint('database', 'pool_recycle', fallback=3600),
+                           pool_pre_ping=True)
+    session_settings = []
+    if engine.dialect.name == 'postgresql':
+        if statement_timeout:
+            session_settings.append('SET statement_timeout = {}'.format(statement_timeout))
+        if read_only:
+            session_settings.append('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+    elif engine.dialect.name == 'mysql':
+        if statement_timeout:
+            session_settings.append('SET SESSION max_execution_time = {}'.format(statement_timeout))
+        if read_only:
+            session_settings.append('SET SESSION TRANSACTION READ ONLY')
+
+    if session_settings:
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for setting in session_settings:
+                cursor.execute(setting)
+            cursor.close()
+            # psycopg2 opens a transaction for the SETs, commit so they are not rolled back on checkin
+            dbapi_connection.commit()
+
+    return engine
+
+
+def get_engine(db=db, read_only=False):
+    key = (os.getpid(), db, read_only)
+    engine = _engines.get(key)
+    if engine is None:
+        if db.startswith('sqlite'):
+            pragmas = sqlite_pragmas(read_only)
+            # File based sqlite defaults to opening a new connection per checkout, pool them so pragmas and the page
+            # cache survive between queries. Read pool is sized for concurrent dash callbacks, the write pool is kept
+            # small since sqlite only ever allows one writer at a time anyway.
+            pool_size = config.getint('sqlite', 'read_pool_size', fallback=5) if read_only else 1
+            # Engine needs to be set to exact location for automation to work
+            engine = create_engine(db, poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size * 2,
+                                   pool_pre_ping=True,
+                                   connect_args={'check_same_thread': False,
+                                                 'timeout': pragmas['busy_timeout'] / 1000})
+            set_sqlite_pragmas(engine, pragmas)
+        else:
+            engine = create_server_engine(db, read_only)
+        _engines[key] = engine
+    return engine
+
+
+def db_connect(db=db, read_only=False):
     try:
-        # Engine needs to be set to exact location for automation to work
-        engine = create_engine(db)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        Session.remove()
+        engine = get_engine(db, read_only)
+        # Sessions are cheap; the pooled engine behind them is shared, so callers should close the session when done
+        # and leave the engine alone
+        session = session_factory(bind=engine)
         return session, engine
     except Exception as e:
         print('Error setting up DB: ', str(e))
@@ -32,12 +145,96 @@ def db_connect(db=db):
         sys.exit()
 
 
-def db_insert(df, tableName):
-    session, engine = db_connect()
+@contextmanager
+def session_scope(db=db):
+    '''
+    Transactional scope for jobs running outside of a request (ingestion, cron, cli).
+    Commits on success, rolls back on error and always returns the connection to the pool.
+    '''
+    session = session_factory(bind=get_engine(db))
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def db_insert(df, tableName, con=None, chunksize=10000):
+    con = get_engine() if con is None else con
+    # sqlite's executemany is the fastest path it has; server dbs do better with multi-row VALUES statements,
+    # which have to be kept under the bind parameter limit
+    if con.dialect.name == 'sqlite':
+        method = None
+    else:
+        method = 'multi'
+        chunksize = max(1, min(chunksize, 60000 // (len(df.columns) + df.index.nlevels)))
     # Insert into DB
-    df.to_sql(tableName, engine, if_exists='append', index=True)
-    engine.dispose()
-    session.close()
+    df.to_sql(tableName, con, if_exists='append', index=True, chunksize=chunksize, method=method)
+
+
+def db_upsert(df, tableName, con=None):
+    '''
+    Insert rows from df (including its index), updating rows whose primary key already exists
+    Columns that are not part of the table are ignored
+    :return: number of rows written
+    '''
+    con = get_engine() if con is None else con
+    table = Base.metadata.tables[tableName]
+    df = df.reset_index()
+    df = df[[col for col in df.columns if col in table.columns]]
+    if len(df) == 0:
+        return 0
+    # astype(object) turns numpy scalars into python types the db driver can bind
+    records = df.astype(object).where(pd.notnull(df), None).to_dict('records')
+    con.execute(upsert_statement(table, df.columns, con.dialect.name), records)
+    return len(records)
+
+
+def upsert_statement(table, columns, dialect):
+    '''
+    INSERT ... ON CONFLICT DO UPDATE (sqlite, postgresql) / ON DUPLICATE KEY UPDATE (mysql) for the given columns
+    '''
+    primary_keys = [col.name for col in table.primary_key.columns]
+    if dialect == 'mysql':
+        stmt = mysql_insert(table)
+        # mysql has no 'do nothing', re-assigning the first key is the usual no-op
+        updates = {col: stmt.inserted[col] for col in columns if col not in primary_keys} or \
+                  {primary_keys[0]: stmt.inserted[primary_keys[0]]}
+        return stmt.on_duplicate_key_update(**updates)
+
+    if dialect == 'postgresql':
+        stmt = postgresql_insert(table)
+    elif dialect == 'sqlite':
+        stmt = sqlite_insert(table)
+    else:
+        raise ValueError(
+            'Unsupported database dialect "{}" for upserts, use sqlite, postgresql or mysql'.format(dialect))
+    updates = {col: stmt.excluded[col] for col in columns if col not in primary_keys}
+    if updates:
+        return stmt.on_conflict_do_update(index_elements=primary_keys, set_=updates)
+    return stmt.on_conflict_do_nothing(index_elements=primary_keys)
+
+
+def db_bulk_insert(frames, chunksize=10000, before=None):
+    '''
+    Append several dataframes in a single transaction so either all of them land or none do
+    :param frames: iterable of (df, tableName) tuples, written in order
+    :param before: called with the connection ahead of the inserts, i.e. to delete rows the frames replace
+    :return: (rows inserted, rows per second)
+    '''
+    start = time.perf_counter()
+    rows = 0
+    with get_engine().begin() as conn:
+        if before is not None:
+            before(conn)
+        for df, tableName in frames:
+            db_insert(df, tableName, con=conn, chunksize=chunksize)
+            rows += len(df)
+    elapsed = time.perf_counter() - start
+    return rows, rows / elapsed if elapsed > 0 else float(rows)
 
 
 ##### Athlete Table #####
@@ -107,6 +304,9 @@ class annotations(Base):
 
 class stravaSamples(Base):
     __tablename__ = 'strava_samples'
+    __table_args__ = (
+        Index('ix_strava_samples_activity_id', 'activity_id'),
+    )
     timestamp_local = Column('timestamp_local', DateTime(), index=True, primary_key=True)
     time_interval = Column('time_interval', DateTime())
     activity_id = Column('activity_id', BigInteger())
@@ -132,8 +332,33 @@ class stravaSamples(Base):
     hr_lowest = Column('hr_lowest', Integer())
 
 
+class stravaSamplesPyramid(Base):
+    # Downsampled charting levels of strava_samples, written at ingest by api/samplePyramid.py
+    __tablename__ = 'strava_samples_pyramid'
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
+    resolution = Column('resolution', Integer(), primary_key=True)
+    time = Column('time', Integer(), primary_key=True)
+    time_interval = Column('time_interval', DateTime())
+    velocity_smooth_mean = Column('velocity_smooth_mean', Float())
+    velocity_smooth_min = Column('velocity_smooth_min', Float())
+    velocity_smooth_max = Column('velocity_smooth_max', Float())
+    cadence_mean = Column('cadence_mean', Float())
+    cadence_min = Column('cadence_min', Float())
+    cadence_max = Column('cadence_max', Float())
+    heartrate_mean = Column('heartrate_mean', Float())
+    heartrate_min = Column('heartrate_min', Float())
+    heartrate_max = Column('heartrate_max', Float())
+    watts_mean = Column('watts_mean', Float())
+    watts_min = Column('watts_min', Float())
+    watts_max = Column('watts_max', Float())
+
+
 class stravaBestSamples(Base):
     __tablename__ = 'strava_best_samples'
+    __table_args__ = (
+        # type is only ever matched with a leading wildcard, which can not use an index, so it is left out
+        Index('ix_strava_best_samples_interval_timestamp_local', 'interval', 'timestamp_local'),
+    )
     activity_id = Column('activity_id', BigInteger(), index=True, primary_key=True)
     interval = Column('interval', Integer, index=True, primary_key=True)
     mmp = Column('mmp', Float())
@@ -147,8 +372,53 @@ class stravaBestSamples(Base):
     athlete_id = Column('athlete_id', BigInteger())
 
 
+class stravaBestEnvelope(Base):
+    # Best mmp per (sport, period, interval) with the activity it came from, maintained by api/bestEnvelope.py
+    __tablename__ = 'strava_best_envelope'
+    sport = Column('sport', String(255), primary_key=True)
+    period = Column('period', String(255), primary_key=True)
+    interval = Column('interval', Integer, primary_key=True)
+    mmp = Column('mmp', Float())
+    ftp = Column('ftp', Float())
+    watts_per_kg = Column('watts_per_kg', Float())
+    activity_id = Column('activity_id', BigInteger())
+    act_name = Column('act_name', String(255))
+    timestamp_local = Column('timestamp_local', DateTime())
+    time_interval = Column('time_interval', DateTime())
+    date = Column('date', Date())
+    # Best W/kg of any workout at the interval, watts_per_kg above belongs to the best mmp
+    max_watts_per_kg = Column('max_watts_per_kg', Float())
+
+
+class stravaPrEvents(Base):
+    # Intervals where an activity beat the previous best mmp or W/kg for its sport, written by api/meanMaxPower.py
+    __tablename__ = 'strava_pr_events'
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
+    metric = Column('metric', String(255), primary_key=True)
+    interval = Column('interval', Integer, primary_key=True)
+    sport = Column('sport', String(255))
+    value = Column('value', Float())
+    previous_value = Column('previous_value', Float())
+    timestamp_local = Column('timestamp_local', DateTime())
+    act_name = Column('act_name', String(255))
+    athlete_id = Column('athlete_id', BigInteger())
+
+
+class stravaActivityQueue(Base):
+    # Activities found on strava but not yet ingested, so a refresh stopped by the rate limit resumes where it left off
+    __tablename__ = 'strava_activity_queue'
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
+    athlete_id = Column('athlete_id', BigInteger())
+    start_date_local = Column('start_date_local', DateTime())
+    queued_utc = Column('queued_utc', DateTime())
+
+
 class stravaSummary(Base):
     __tablename__ = 'strava_summary'
+    __table_args__ = (
+        Index('ix_strava_summary_activity_id', 'activity_id'),
+        Index('ix_strava_summary_start_date_local_type', 'start_date_local', 'type'),
+    )
     start_date_utc = Column('start_date_utc', DateTime(), index=True, primary_key=True)
     activity_id = Column('activity_id', BigInteger())
     athlete_id = Column('athlete_id', BigInteger())
@@ -254,6 +524,9 @@ class ouraActivitySummary(Base):
 
 class ouraActivitySamples(Base):
     __tablename__ = 'oura_activity_samples'
+    __table_args__ = (
+        Index('ix_oura_activity_samples_summary_date', 'summary_date'),
+    )
     timestamp_local = Column('timestamp_local', DateTime(), index=True, primary_key=True)
     summary_date = Column('summary_date', Date())
     met_1min = Column('met_1min', Float())
@@ -303,6 +576,9 @@ class ouraSleepSummary(Base):
 
 class ouraSleepSamples(Base):
     __tablename__ = 'oura_sleep_samples'
+    __table_args__ = (
+        Index('ix_oura_sleep_samples_report_date', 'report_date'),
+    )
     timestamp_local = Column('timestamp_local', DateTime(), index=True, primary_key=True)
     summary_date = Column('summary_date', Date())
     report_date = Column('report_date', Date())
@@ -312,6 +588,41 @@ class ouraSleepSamples(Base):
     hypnogram_5min_desc = Column('hypnogram_5min_desc', String(8))
 
 
+class ouraDayHash(Base):
+    # Hash of the raw api payload for each day written to an oura table, used to skip days that have not changed
+    __tablename__ = 'oura_day_hash'
+    table_name = Column('table_name', String(255), primary_key=True)
+    day = Column('day', Date(), primary_key=True)
+    content_hash = Column('content_hash', String(40))
+
+
+##### Derived Tables #####
+class dailyMetrics(Base):
+    # One row per athlete day, maintained by ingestion (api/dailyMetrics.py) so the performance page reads a single range
+    __tablename__ = 'daily_metrics'
+    athlete_id = Column('athlete_id', Integer(), primary_key=True)
+    date = Column('date', Date(), index=True, primary_key=True)
+    stress_score = Column('stress_score', Float())
+    tss = Column('tss', Float())
+    hrss = Column('hrss', Float())
+    low_intensity_seconds = Column('low_intensity_seconds', Integer())
+    med_intensity_seconds = Column('med_intensity_seconds', Integer())
+    high_intensity_seconds = Column('high_intensity_seconds', Integer())
+    tss_flag = Column('tss_flag', Float())
+    ctl = Column('ctl', Float())
+    atl = Column('atl', Float())
+    tsb = Column('tsb', Float())
+    ramp_rate = Column('ramp_rate', Float())
+    rmssd = Column('rmssd', Float())
+    rmssd_7 = Column('rmssd_7', Float())
+    rmssd_30 = Column('rmssd_30', Float())
+    swc_upper = Column('swc_upper', Float())
+    swc_lower = Column('swc_lower', Float())
+    readiness_score = Column('readiness_score', Integer())
+    sleep_score = Column('sleep_score', Integer())
+    weight = Column('weight', Float())
+
+
 class apiTokens(Base):
     __tablename__ = 'api_tokens'
     date_utc = Column('date_utc', DateTime(), index=True, primary_key=True)
@@ -319,6 +630,27 @@ class apiTokens(Base):
     tokens = Column('tokens', String(255))
 
 
+class jobQueue(Base):
+    # Refreshes and reprocessing queued by the web app and run by the ingestion worker, see api/jobQueue.py
+    __tablename__ = 'job_queue'
+    __table_args__ = (
+        Index('ix_job_queue_status_job_id', 'status', 'job_id'),
+    )
+    job_id = Column('job_id', Integer(), primary_key=True, autoincrement=True)
+    kind = Column('kind', String(255))
+    params = Column('params', String(4000))
+    status = Column('status', String(255))
+    stage = Column('stage', String(255))
+    progress_done = Column('progress_done', Integer())
+    progress_total = Column('progress_total', Integer())
+    message = Column('message', String(255))
+    worker = Column('worker', String(255))
+    created_utc = Column('created_utc', DateTime())
+    started_utc = Column('started_utc', DateTime())
+    heartbeat_utc = Column('heartbeat_utc', DateTime())
+    finished_utc = Column('finished_utc', DateTime())
+
+
 class dbRefreshStatus(Base):
     __tablename__ = 'db_refresh'
     timestamp_utc = Column('timestamp_utc', DateTime(), index=True, primary_key=True)
@@ -356,6 +688,50 @@ class fitbod_muscles(Base):
     muscle = Column('Muscle', String(255))
 
 
+# Indexes that have been replaced, dropped from existing databases by migrate_db()
+obsolete_indexes = {
+    'strava_best_samples': ['ix_strava_best_samples_type_interval_timestamp_local'],
+    'strava_summary': ['ix_strava_summary_type_start_date_local'],
+}
+
+
+def migrate_db(engine=None):
+    '''
+    Bring an existing database up to the declared schema. create_all() only creates missing tables, so columns and
+    indexes declared after a table was first created are added here, and indexes they replace are dropped.
+    :return: list of the columns and indexes that were created, i.e. ['column job_queue.heartbeat_utc']
+    '''
+    engine = get_engine() if engine is None else engine
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    created = []
+    for table in Base.metadata.sorted_tables:
+        # Added columns are all nullable, so existing rows just get NULL
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                with engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        quote(table.name), quote(column.name), column.type.compile(dialect=engine.dialect))))
+                created.append('column {}.{}'.format(table.name, column.name))
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        obsolete = [name for name in obsolete_indexes.get(table.name, []) if name in existing]
+        if obsolete:
+            for index in Table(table.name, MetaData(), autoload_with=engine).indexes:
+                if index.name in obsolete:
+                    index.drop(bind=engine)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append('index {}'.format(index.name))
+    if engine.dialect.name == 'sqlite':
+        # Refresh planner statistics so the new indexes are picked over full scans
+        with engine.connect() as conn:
+            conn.execute(text('ANALYZE'))
+    return created
+
+
 session, engine = db_connect()
 Base.metadata.create_all(engine)
 athlete_exists = True if len(session.query(athlete).all()) > 0 else False
@@ -595,5 +971,6 @@ if not fitbod_muscles_table:
         session.add(fitbod_muscles(exercise=exercise, muscle=muscle))
     session.commit()
 
-engine.dispose()
 session.close()
+# Drop the connections opened while bootstrapping so forked workers start with an empty pool
+engine.dispose()
@@ -1,4 +1,8 @@
 from stravalib.client import Client
+import requests
+from stravalib import exc
+from stravalib.util.limiter import get_rates_from_response_headers, get_seconds_until_next_quarter, \
+    get_seconds_until_next_day
 import datetime
 from datetime import datetime
 from sqlalchemy import delete
@@ -7,12 +11,90 @@ from ..utils import config
 from ..app import app
 import ast
 import time
+import threading
 
 
 
 client_id = config.get('strava', 'client_id')
 client_secret = config.get('strava', 'client_secret')
 redirect_uri = config.get('strava', 'redirect_uri')
+# Requests left unused in each rate limit window, so the app can still reach strava while an import is running
+rate_limit_reserve = int(config.get('strava', 'rate_limit_reserve', fallback='10'))
+
+
+class StravaRateLimiter(object):
+    '''
+    Paces requests from every client (and thread) in this process to Strava's 15 minute and daily limits, using the
+    usage Strava reports in the X-RateLimit headers of each response. Requests are spread evenly over what is left of
+    the 15 minute window, and once the daily limit is used up RateLimitExceeded is raised until the next UTC day so
+    callers can park their remaining work instead of sleeping for hours. stravalib reports usage after each response,
+    which is never thrown away, the next request is held back or refused by check() before it is sent.
+    '''
+
+    def __init__(self, reserve=rate_limit_reserve):
+        self.reserve = reserve
+        self.short_usage, self.long_usage = 0, 0
+        self.short_limit, self.long_limit = 600, 30000
+        self.spacing = 0
+        self.next_slot = 0
+        self.exhausted_until = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        '''
+        Called before each request. Raise RateLimitExceeded when the daily limit has been reached, otherwise wait for
+        the request's turn in the 15 minute window
+        '''
+        timeout = self.exhausted_until - time.time()
+        if timeout > 0:
+            raise exc.RateLimitExceeded(
+                'Strava daily rate limit of {} reached, try again in {} seconds'.format(self.long_limit, int(timeout)),
+                timeout=timeout, limit=self.long_limit)
+        with self.lock:
+            now = time.time()
+            wait = max(self.next_slot - now, 0)
+            self.next_slot = max(self.next_slot, now) + self.spacing
+        if wait > 0:
+            app.server.logger.debug('Strava rate limit: waiting {:.1f} seconds'.format(wait))
+            time.sleep(wait)
+
+    def resume_time(self):
+        '''
+        :return: utc datetime requests can resume, None if they are not being held back
+        '''
+        return datetime.utcfromtimestamp(self.exhausted_until) if self.exhausted_until > time.time() else None
+
+    def __call__(self, response_headers):
+        # Called by stravalib with the headers of every response, only records the usage
+        rates = get_rates_from_response_headers(response_headers)
+        with self.lock:
+            now = time.time()
+            if rates:
+                self.short_usage, self.long_usage = rates.short_usage, rates.long_usage
+                self.short_limit, self.long_limit = rates.short_limit, rates.long_limit
+            short_left = self.short_limit - self.reserve - self.short_usage
+            long_left = self.long_limit - self.reserve - self.long_usage
+            if long_left <= 0:
+                self.exhausted_until = now + get_seconds_until_next_day() + 1
+            elif short_left <= 0:
+                # Everything waits for the next 15 minute window
+                self.next_slot = max(self.next_slot, now + get_seconds_until_next_quarter() + 1)
+            else:
+                self.spacing = get_seconds_until_next_quarter() / short_left
+
+
+class RateLimitedSession(requests.Session):
+    '''
+    Requests session for stravalib clients that checks strava_rate_limiter before every request is sent
+    '''
+
+    def request(self, *args, **kwargs):
+        strava_rate_limiter.check()
+        return super(RateLimitedSession, self).request(*args, **kwargs)
+
+
+strava_rate_limiter = StravaRateLimiter()
+
 
 # Retrieve current tokens from db
 def current_token_dict():
@@ -20,7 +102,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Strava').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         app.server.logger.error(e)
@@ -38,14 +119,13 @@ def save_strava_token(token_dict):
     app.server.logger.debug('Inserting new strava tokens')
     session.add(apiTokens(date_utc=datetime.utcnow(), service='Strava', tokens=str(token_dict)))
     session.commit()
-    engine.dispose()
     session.close()
 
 
 def get_strava_client():
     token_dict = current_token_dict()
     if token_dict:
-        client = Client()
+        client = Client(rate_limiter=strava_rate_limiter, requests_session=RateLimitedSession())
         client.access_token = token_dict['access_token']
         client.refresh_token = token_dict['refresh_token']
         # If token is old, refresh it
@@ -59,7 +139,7 @@ def get_strava_client():
             client.access_token = refresh_response['access_token']
             client.refresh_token = refresh_response['refresh_token']
     else:
-        client = Client()
+        client = Client(rate_limiter=strava_rate_limiter, requests_session=RateLimitedSession())
 
     return client
 
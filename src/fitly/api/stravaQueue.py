@@ -0,0 +1,34 @@
+from datetime import datetime
+from sqlalchemy import delete
+from ..api.sqlalchemy_declarative import session_scope, stravaActivityQueue
+
+# New strava activities are queued before any of their streams are downloaded and removed once they are written, so a
+# refresh cut short by the daily rate limit (or a crash) picks the rest up on the next refresh.
+
+
+def enqueue_activities(activities, athlete_id):
+    '''
+    Queue activities that are not already queued
+    :param activities: strava activities
+    :return: number of activities added
+    '''
+    with session_scope() as session:
+        queued = set(x[0] for x in session.query(stravaActivityQueue.activity_id).all())
+        new = [stravaActivityQueue(activity_id=act.id, athlete_id=athlete_id, start_date_local=act.start_date_local,
+                                   queued_utc=datetime.utcnow()) for act in activities if act.id not in queued]
+        session.add_all(new)
+    return len(new)
+
+
+def queued_activity_ids(athlete_id):
+    '''
+    :return: queued activity ids, oldest activity first
+    '''
+    with session_scope() as session:
+        return [x[0] for x in session.query(stravaActivityQueue.activity_id).filter(
+            stravaActivityQueue.athlete_id == athlete_id).order_by(stravaActivityQueue.start_date_local).all()]
+
+
+def dequeue_activities(activity_ids):
+    with session_scope() as session:
+        session.execute(delete(stravaActivityQueue).where(stravaActivityQueue.activity_id.in_(activity_ids)))
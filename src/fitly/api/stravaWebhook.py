@@ -0,0 +1,118 @@
+from flask import request, jsonify
+from stravalib.exc import ObjectNotFound
+from ..api.sqlalchemy_declarative import session_scope, stravaSummary
+from ..api.stravaApi import get_strava_client
+from ..api.stravaQueue import enqueue_activities, dequeue_activities
+from ..api.sampleStore import delete_samples
+from ..api.streamCache import delete_streams
+from ..api.bestEnvelope import update_best_envelope
+from ..api.dailyMetrics import update_daily_metrics
+from ..api.fitlyAPI import FitlyActivity, delete_activity_rows, types as stream_types
+from ..api.jobQueue import enqueue_job
+from ..app import app
+from ..utils import config
+
+# Strava push subscription: https://developers.strava.com/docs/webhooks/
+# Strava expects a 200 within 2 seconds, so events are queued as jobs and ingested by the worker. The hourly refresh
+# still lists recent activities, which catches any event that was missed.
+webhook_path = '/strava/webhook'
+webhook_verify_token = config.get('strava', 'webhook_verify_token', fallback='')
+webhook_subscription_id = config.get('strava', 'webhook_subscription_id', fallback='')
+
+# Activity updates that change how an activity is analyzed or displayed, privacy changes are ignored
+reingest_updates = ['title', 'type']
+
+
+def strava_webhook_verify():
+    # Subscription validation request sent by strava when the subscription is created
+    if request.args.get('hub.mode') != 'subscribe' or request.args.get('hub.verify_token') != webhook_verify_token:
+        app.server.logger.warning('Rejected strava webhook validation request')
+        return jsonify({'error': 'Invalid verify token'}), 403
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+
+def strava_webhook_event():
+    event = request.get_json(silent=True) or {}
+    if str(event.get('subscription_id')) != webhook_subscription_id:
+        app.server.logger.warning('Rejected strava webhook event for subscription {}'.format(
+            event.get('subscription_id')))
+        return jsonify({'error': 'Unknown subscription'}), 403
+    if event.get('object_type') == 'activity' and event.get('aspect_type') in ['create', 'update', 'delete']:
+        app.server.logger.info('Strava webhook: activity {} {}'.format(event.get('object_id'), event['aspect_type']))
+        enqueue_job('strava_event', activity_id=int(event['object_id']), aspect_type=event['aspect_type'],
+                    updates=event.get('updates') or {})
+    elif event.get('object_type') == 'athlete' and (event.get('updates') or {}).get('authorized') == 'false':
+        app.server.logger.warning('Strava webhook: athlete {} deauthorized fitly'.format(event.get('owner_id')))
+    return jsonify({}), 200
+
+
+# Validation only needs the verify token, events are only accepted once the subscription id it returned is configured
+if webhook_verify_token:
+    app.server.add_url_rule(webhook_path, view_func=strava_webhook_verify, methods=['GET'])
+    if webhook_subscription_id:
+        app.server.add_url_rule(webhook_path, view_func=strava_webhook_event, methods=['POST'])
+    else:
+        app.server.logger.warning('Strava webhook events are ignored until [strava] webhook_subscription_id is set')
+
+
+def delete_activities(activity_ids):
+    '''
+    Delete everything stored for activities removed from strava
+    '''
+    with session_scope() as session:
+        delete_activity_rows(session, activity_ids)
+    for activity_id in activity_ids:
+        delete_samples(activity_id)
+        delete_streams(activity_id, stream_types)
+    dequeue_activities(activity_ids)
+    update_best_envelope()
+
+
+def stored_activity(activity_id):
+    '''
+    :return: (name, start_date_local) of an ingested activity, None if it is not in strava_summary
+    '''
+    with session_scope() as session:
+        return session.query(stravaSummary.name, stravaSummary.start_date_local).filter(
+            stravaSummary.activity_id == activity_id).first()
+
+
+def handle_strava_event(activity_id, aspect_type, updates=None, athlete_id=1):
+    '''
+    Ingest, re-ingest or delete a single activity for a webhook event
+    :return: message recorded with the job
+    '''
+    updates = updates or {}
+    stored = stored_activity(activity_id)
+
+    if aspect_type == 'update':
+        # Renaming to the peloton class title during ingestion sends an update for the name already stored
+        if not any(x in updates for x in reingest_updates) or \
+                (list(updates) == ['title'] and stored is not None and updates['title'] == stored[0]):
+            return 'Nothing to update for activity {}'.format(activity_id)
+    if aspect_type == 'delete':
+        if stored is None:
+            return 'Activity {} is not ingested'.format(activity_id)
+        # Only trust strava itself that the activity is gone, any other error fails the job and keeps the activity
+        try:
+            get_strava_client().get_activity(activity_id)
+        except ObjectNotFound:
+            delete_activities([activity_id])
+            update_daily_metrics(stored[1].date(), athlete_id=athlete_id)
+            return 'Deleted activity {}'.format(activity_id)
+        return 'Activity {} still exists on strava, not deleted'.format(activity_id)
+    if aspect_type == 'create' and stored is not None:
+        return 'Activity {} already ingested'.format(activity_id)
+    if aspect_type == 'update' and 'type' in updates:
+        # Download the streams again rather than re-analyze the cached payload of the activity as it was
+        delete_streams(activity_id, stream_types)
+
+    # Queued first so a failure (i.e. the rate limit) leaves it for the next refresh. An update is analyzed before the
+    # stored rows are touched, then swapped for them in one transaction
+    activity = FitlyActivity(get_strava_client().get_activity(activity_id))
+    enqueue_activities([activity], athlete_id)
+    activity.stravaScrape(athlete_id, replace=stored is not None)
+    dequeue_activities([activity_id])
+    update_daily_metrics(min(activity.start_date_local.date(), stored[1].date()) if stored is not None else
+                         activity.start_date_local.date(), athlete_id=athlete_id)
+    return 'Ingested activity {}'.format(activity_id)
@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from ..utils import config
+
+# Raw Strava stream payloads kept as gzipped json, named by a hash of the activity id and stream types requested, so a
+# truncate and refresh (or a refresh resumed after a crash) rebuilds samples without downloading the streams again.
+# Least recently read payloads are deleted once the cache is over max_size_mb.
+stream_cache_enabled = config.get('stream_cache', 'enabled', fallback='True').lower() == 'true'
+stream_cache_path = config.get('stream_cache', 'path', fallback='./config/stream_cache')
+stream_cache_max_bytes = float(config.get('stream_cache', 'max_size_mb', fallback='1024')) * 1024 * 1024
+
+# Bytes in the cache, seeded from disk on first write and kept up to date as payloads are written and deleted, so the
+# cache is only scanned when it has to be evicted. Other processes writing to the same cache are picked up then.
+cache_bytes = None
+cache_lock = threading.Lock()
+
+
+def stream_key(activity_id, types):
+    '''
+    Cache key for a stream request, independent of the order types are listed in
+    '''
+    request = json.dumps({'activity_id': int(activity_id), 'types': sorted(set(types))}, sort_keys=True)
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+def stream_file(key):
+    # Spread over 256 sub directories so no single directory holds every activity
+    return os.path.join(stream_cache_path, key[:2], key + '.json.gz')
+
+
+def read_streams(activity_id, types):
+    '''
+    :return: {stream type: list of values}, or None when the request is not cached
+    '''
+    path = stream_file(stream_key(activity_id, types))
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            streams = json.load(f)
+    except (OSError, ValueError, EOFError):
+        # Missing, or a truncated file left by a crash which will be overwritten by the next download
+        return None
+    # Mark as recently used for eviction
+    os.utime(path)
+    return streams
+
+
+def write_streams(activity_id, types, streams):
+    '''
+    Cache downloaded streams, then evict the least recently used payloads if the cache is over its size limit
+    :param streams: {stream type: list of values}
+    '''
+    path = stream_file(stream_key(activity_id, types))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name and renamed so readers never see a partial payload
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(streams, f, separators=(',', ':'))
+    size = os.path.getsize(tmp_path)
+    replaced = file_size(path)
+    os.replace(tmp_path, path)
+    if track_size(size - replaced) > stream_cache_max_bytes:
+        evict_streams()
+
+
+def delete_streams(activity_id, types):
+    '''
+    Drop a cached request, i.e. when the activity was deleted or its type changed on Strava
+    '''
+    path = stream_file(stream_key(activity_id, types))
+    size = file_size(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    track_size(-size)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def cached_files():
+    '''
+    :return: list of (mtime, size, path) of every cached payload
+    '''
+    files = []
+    for root, dirs, names in os.walk(stream_cache_path):
+        for name in names:
+            if name.endswith('.json.gz'):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    return files
+
+
+def track_size(change):
+    '''
+    Add change to the running cache size, scanning the cache the first time
+    :return: bytes in the cache
+    '''
+    global cache_bytes
+    with cache_lock:
+        if cache_bytes is None:
+            cache_bytes = sum(x[1] for x in cached_files())
+        else:
+            cache_bytes += change
+        return cache_bytes
+
+
+def evict_streams(max_bytes=None):
+    '''
+    Delete least recently used payloads until the cache fits in max_bytes
+    :param max_bytes: defaults to [stream_cache] max_size_mb in config.ini
+    :return: number of payloads deleted
+    '''
+    global cache_bytes
+    max_bytes = stream_cache_max_bytes if max_bytes is None else max_bytes
+    with cache_lock:
+        files = cached_files()
+        total = sum(x[1] for x in files)
+        deleted = 0
+        for mtime, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+        # Resynced with what is actually on disk
+        cache_bytes = total
+    return deleted
+
+
+def cached_streams(activity_id, types, download):
+    '''
+    Streams for an activity from the cache, downloading and caching them on a miss
+    :param download: called with no arguments on a miss, returns {stream type: list of values}
+    :return: {stream type: list of values}
+    '''
+    if not stream_cache_enabled:
+        return download()
+    streams = read_streams(activity_id, types)
+    if streams is None:
+        streams = download()
+        write_streams(activity_id, types, streams)
+    return streams
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+# Labels whole sample arrays with power/heart rate zones at once. Thresholds are the upper bound of each zone: a sample
+# on a threshold belongs to the lower zone, and anything above the last threshold (or missing) is in the top zone.
+
+# Zone -> intensity bucket behind low/med/high intensity seconds. Run power zones stop at 5, 6 and 7 are not bucketed
+intensity_buckets = {
+    'ride': {1: 'low', 2: 'low', 3: 'low', 4: 'med', 5: 'high', 6: 'high', 7: 'high'},
+    'run': {1: 'low', 2: 'low', 3: 'med', 4: 'high', 5: 'high'},
+    'heartrate': {1: 'low', 2: 'low', 3: 'med', 4: 'high', 5: 'high'}
+}
+
+
+def zone_sport(activity_type):
+    '''
+    Which set of power zones an activity type uses, walks use run zones
+    '''
+    activity_type = activity_type.lower()
+    return 'ride' if 'ride' in activity_type else 'run' if 'run' in activity_type or 'walk' in activity_type else None
+
+
+def power_zone_thresholds(ftp, power_zones, sport):
+    '''
+    Upper watts of power zones 1-6
+    :param power_zones: {zone: fraction of ftp}. Rides have 6 thresholds, runs have 4 and everything above is zone 5
+    :return: list of watts
+    '''
+    if sport == 'ride':
+        fractions = [power_zones[x] for x in range(1, 7)]
+    else:
+        fractions = [power_zones[x] for x in range(1, 5)] + [99, 99]
+    return [round(ftp * x) for x in fractions]
+
+
+def heartrate_zone_thresholds(rhr, hrr, hearrate_zones):
+    '''
+    Upper heart rate of zones 1-4
+    :param hrr: heart rate reserve (max hr - resting hr)
+    :param hearrate_zones: {zone: fraction of heart rate reserve above resting hr}
+    :return: list of bpm
+    '''
+    return [round((hrr * hearrate_zones[x]) + rhr) for x in range(1, 5)]
+
+
+def classify_zones(values, thresholds):
+    '''
+    Label each value with the first zone whose threshold it is at or below
+    :param thresholds: ascending upper bound of every zone but the top one
+    :return: float np array of zones 1 to len(thresholds) + 1
+    '''
+    values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+    # nan sorts after every threshold, so missing samples land in the top zone
+    return np.searchsorted(np.asarray(thresholds, dtype=float), values, side='left') + 1.
+
+
+def zone_intensities(zones, buckets):
+    '''
+    Map zone labels to 'low'/'med'/'high', nan for zones without a bucket
+    '''
+    return pd.Series(zones).map(buckets)
@@ -18,7 +18,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Withings').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         app.server.logger.error(e)
@@ -59,7 +58,6 @@ def save_withings_token(tokens):
     session.add(apiTokens(date_utc=datetime.utcnow(), service='Withings', tokens=str(token_dict)))
     session.commit()
 
-    engine.dispose()
     session.close()
     app.server.logger.debug('***** SAVED TOKENS *****')
 
@@ -117,7 +115,6 @@ def pull_withings_data():
         withings_max_date = session.query(func.max(withings.date_utc)).first()[0]
         withings_max_date = datetime.strptime('1991-08-30 00:00:00',
                                               '%Y-%m-%d %H:%M:%S') if not withings_max_date else withings_max_date
-        engine.dispose()
         session.close()
 
         df = df[(df.index > withings_max_date) & (~np.isnan(df['weight'])) & (~np.isnan(df['fat_ratio']))]
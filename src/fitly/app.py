@@ -27,13 +27,15 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 with server.app_context():
     # load the rest of our Dash app
     from . import index
+    # strava push subscription endpoint
+    from .api import stravaWebhook
 
-    # Enable refresh cron
-    if config.get('cron', 'hourly_pull').lower() == 'true':
+    # Run queued jobs and the refresh cron here, unless a separate fitly-worker process owns them
+    from .api.jobQueue import worker_embedded, schedule_jobs
+    if worker_embedded:
         try:
-            from .api.datapull import refresh_database
             scheduler = BackgroundScheduler()
-            scheduler.add_job(func=refresh_database, trigger="cron", hour='*')
+            schedule_jobs(scheduler)
             app.server.logger.info('Starting cron jobs')
             scheduler.start()
         except BaseException as e:
@@ -0,0 +1,184 @@
+"""Click command line script for managing the Fit.ly database and ingestion."""
+
+import click
+
+
+@click.group()
+def main():
+    """Fit.ly management commands."""
+
+
+@main.group()
+def db():
+    """Database maintenance."""
+
+
+@db.command()
+def migrate():
+    """Create missing tables, columns and indexes on an existing database."""
+    from .api.sqlalchemy_declarative import migrate_db, session_scope
+    from .api.bestEnvelope import update_best_envelope, truncate_best_envelope
+
+    created = migrate_db()
+    if created:
+        for name in created:
+            click.echo(f"Created {name}")
+    else:
+        click.echo("Database is up to date")
+    if any(name.startswith("column strava_best_envelope.") for name in created):
+        # Derived from strava_best_samples, rebuilt below so the new columns are filled in
+        with session_scope() as session:
+            truncate_best_envelope(session)
+    rows = update_best_envelope()
+    if rows:
+        click.echo(f"Built power curve envelope ({rows} rows)")
+
+
+@db.command("migrate-samples")
+@click.option(
+    "--purge/--no-purge",
+    default=False,
+    help="Delete migrated rows from strava_samples and vacuum the database. Defaults to False",
+)
+def migrate_samples(purge):
+    """Copy strava_samples into the columnar sample store."""
+    from .api.sampleStore import migrate_samples_to_store
+
+    migrated, size = migrate_samples_to_store(purge=purge)
+    click.echo(f"Migrated {migrated} activities ({size / 1024 / 1024:.1f} MB)")
+
+
+@db.command("build-pyramid")
+def build_pyramid():
+    """Write chart downsampling levels for activities ingested before they existed."""
+    from .api.samplePyramid import backfill_pyramid
+
+    click.echo(f"Built sample pyramid for {backfill_pyramid()} activities")
+
+
+@db.command("daily-metrics")
+@click.option(
+    "--since",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Recompute from this date (YYYY-MM-DD). Defaults to the recent days an incremental refresh covers",
+)
+@click.option("--rebuild", is_flag=True, help="Delete and rebuild every day of daily_metrics")
+def daily_metrics(since, rebuild):
+    """Recompute the daily_metrics fact table."""
+    from .api.dailyMetrics import update_daily_metrics, truncate_daily_metrics
+    from .api.sqlalchemy_declarative import session_scope
+
+    if rebuild:
+        with session_scope() as session:
+            truncate_daily_metrics(session)
+    days = update_daily_metrics(since.date() if since else None)
+    click.echo(f"Updated {days} days of daily_metrics")
+
+
+@main.command()
+@click.option(
+    "--full-sweep",
+    is_flag=True,
+    help="List every Strava activity since activities_after_date instead of only recent ones, to pick up anything missed",
+)
+def refresh(full_sweep):
+    """Pull new data from every connected source."""
+    from .api.datapull import refresh_database
+
+    refresh_database(refresh_method="cli", full_sweep=full_sweep)
+
+
+@main.command()
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help="First activity date (YYYY-MM-DD)")
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help="Last activity date (YYYY-MM-DD)")
+@click.option("--activity", "activity_ids", multiple=True, type=int, help="Activity id to reprocess, can be repeated")
+@click.option("--sport", default=None, help="Only activities whose type contains this (i.e. ride)")
+@click.option(
+    "--setting",
+    default=None,
+    help="Only activities affected by this athlete setting (i.e. ride_ftp, rest_hr, cycle_power_zone_threshold_1)",
+)
+@click.option("--workers", type=int, default=None, help="Activities analyzed in parallel. Defaults to [strava] workers")
+def reprocess(since, until, activity_ids, sport, setting, workers):
+    """Recompute zones, scores and best samples from stored samples without downloading from Strava."""
+    from .api.reprocess import reprocess_activities, affected_activities
+
+    activity_ids = list(activity_ids) or None
+    if setting:
+        affected = affected_activities(setting)
+        activity_ids = affected if activity_ids is None else [x for x in activity_ids if x in affected]
+        if not activity_ids:
+            click.echo(f"No activities depend on {setting}")
+            return
+    if until:
+        # Include every activity on the last day
+        until = until.replace(hour=23, minute=59, second=59)
+    count = reprocess_activities(activity_ids, since=since, until=until, sport=sport, workers=workers)
+    click.echo(f"Reprocessed {count} activities")
+
+
+@main.command("import")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--workers", type=int, default=None, help="Files parsed and analyzed in parallel. Defaults to [strava] workers")
+@click.option(
+    "--timezone",
+    default=None,
+    help="Timezone of files that do not record one (i.e. America/New_York). Defaults to that of the latest activity",
+)
+def import_files(path, workers, timezone):
+    """Import a Strava export archive or a folder of FIT/GPX/TCX files without the Strava API."""
+    from .api.fileImport import import_activities
+
+    imported, duplicates, failed = import_activities(path, workers=workers, timezone=timezone)
+    click.echo(f"Imported {imported} activities ({duplicates} already imported, {failed} could not be read)")
+
+
+@main.group()
+def strava():
+    """Strava push subscription."""
+
+
+@strava.command()
+@click.option("--callback-url", required=True, help="Public url of the webhook, i.e. https://fitly.example.com/strava/webhook")
+def subscribe(callback_url):
+    """Subscribe to Strava activity events. Fit.ly must be reachable at the callback url to answer validation."""
+    from stravalib import Client
+    from .api.stravaWebhook import webhook_verify_token
+    from .utils import config
+
+    if not webhook_verify_token:
+        raise click.ClickException("Set [strava] webhook_verify_token in config.ini first")
+    subscription = Client().create_subscription(
+        client_id=config.get("strava", "client_id"),
+        client_secret=config.get("strava", "client_secret"),
+        callback_url=callback_url,
+        verify_token=webhook_verify_token,
+    )
+    click.echo(f"Created subscription {subscription.id}, set [strava] webhook_subscription_id = {subscription.id}")
+
+
+@strava.command("test-event")
+@click.option("--url", default="http://127.0.0.1:8050/strava/webhook", help="Webhook url. Defaults to the dev app")
+@click.option("--activity", "activity_id", type=int, required=True, help="Strava activity id")
+@click.option("--aspect", type=click.Choice(["create", "update", "delete"]), default="create")
+@click.option("--title", default=None, help="New activity title sent with an update")
+def test_event(url, activity_id, aspect, title):
+    """Post an event shaped like Strava's to the webhook, in place of a real subscription."""
+    import time
+    import requests
+    from .api.stravaWebhook import webhook_subscription_id
+
+    if not webhook_subscription_id:
+        raise click.ClickException("Set [strava] webhook_subscription_id in config.ini first, any id will do locally")
+    event = {
+        "object_type": "activity",
+        "object_id": activity_id,
+        "aspect_type": aspect,
+        "updates": {"title": title} if title else {},
+        "owner_id": None,
+        "subscription_id": int(webhook_subscription_id),
+        "event_time": int(time.time()),
+    }
+    response = requests.post(url, json=event, timeout=10)
+    click.echo(f"{response.status_code} {response.text.strip()}")
@@ -91,22 +91,20 @@ def modal_range_buttons(df, resample='D'):
 
 
 def get_max_week_ending():
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     date = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    engine.dispose()
     session.close()
     return pd.to_datetime(date)
 
 
 # TODO: Fix y axis sort
 def generate_sleep_stages_chart(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraSleepSamples).filter(
             ouraSleepSamples.report_date == date, ouraSleepSamples.hypnogram_5min_desc != None).statement, con=engine,
         index_col='timestamp_local').sort_index(
         ascending=False)
-    engine.dispose()
     session.close()
 
     df['Task'] = df['hypnogram_5min_desc']
@@ -194,13 +192,12 @@ def daily_movement_color(x, name=False):
 
 
 def generate_daily_movement_chart(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraActivitySamples.timestamp_local, ouraActivitySamples.met_1min,
                           ouraActivitySamples.class_5min).filter(
             ouraActivitySamples.summary_date == date, ouraActivitySamples.class_5min != None).statement, con=engine,
         index_col='timestamp_local')
-    engine.dispose()
     session.close()
 
     df['color'] = df['met_1min'].apply(daily_movement_color)
@@ -280,7 +277,7 @@ def generate_daily_movement_chart(date):
 
 
 def generate_rhr_day_chart(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraSleepSamples.timestamp_local, ouraSleepSamples.hr_5min).filter(
             ouraSleepSamples.report_date == date).statement, con=engine, index_col='timestamp_local')
@@ -291,7 +288,6 @@ def generate_rhr_day_chart(date):
             sql=session.query(ouraSleepSamples.timestamp_local, ouraSleepSamples.hr_5min).filter(
                 ouraSleepSamples.report_date == date).statement, con=engine, index_col='timestamp_local')
 
-    engine.dispose()
     session.close()
 
     # Remove 0s from plotted line
@@ -471,7 +467,7 @@ def generate_kpi_donut(kpi_name, metric, goal, current_streak, best_streak, colo
 
 def calculate_streak_off_oura_readiness(date, readiness_lookup, df):
     ## Yoga on days when readiness between 70-84, workout on days when readiness >= 85
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     if readiness_lookup == 'yoga':
         df_readiness = pd.read_sql(
             sql=session.query(ouraReadinessSummary.report_date, ouraReadinessSummary.score).filter(
@@ -484,7 +480,6 @@ def calculate_streak_off_oura_readiness(date, readiness_lookup, df):
                 ouraReadinessSummary.score >= 85).statement, con=engine)
 
     df_readiness = df_readiness.set_index(pd.to_datetime(df_readiness['report_date']))
-    engine.dispose()
     session.close()
 
     current_streak, best_streak, temp_best_streak = 0, 0, 0
@@ -569,7 +564,7 @@ def calculate_streak(date, series, weekly_goal, sum_metric=None):
 
 def generate_content_kpi_trend(df_name, metric):
     rolling_days = 42
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     if df_name == 'sleep':
         df = pd.read_sql(sql=session.query(ouraSleepSummary).statement, con=engine).set_index('report_date')
     elif df_name == 'readiness':
@@ -582,7 +577,6 @@ def generate_content_kpi_trend(df_name, metric):
         # If multiple measurements in a single day, average together to only show 1 point per day on trend
         df = df.resample('D').mean().ffill()
 
-    engine.dispose()
     session.close()
 
     df.index = pd.DatetimeIndex(df.index)
@@ -777,12 +771,11 @@ def generate_content_kpi_trend(df_name, metric):
 
 
 def update_kpis(date, days=7):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df_summary = pd.read_sql(
         sql=session.query(stravaSummary).filter(stravaSummary.start_date_utc <= date).statement, con=engine,
         index_col='start_date_local')
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
 
     ### Oura Donuts ###
@@ -1015,7 +1008,7 @@ def generate_contributor_bar(df, id, column_name, top_left_title, top_right_titl
 
 
 def generate_oura_sleep_header_kpi(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraSleepSummary.score).filter(ouraSleepSummary.report_date == date).statement,
         con=engine)
@@ -1026,7 +1019,6 @@ def generate_oura_sleep_header_kpi(date):
             sql=session.query(ouraSleepSummary.score).filter(ouraSleepSummary.report_date == date).statement,
             con=engine)
 
-    engine.dispose()
     session.close()
 
     score = df.loc[df.index.max()]['score']
@@ -1037,7 +1029,7 @@ def generate_oura_sleep_header_kpi(date):
 
 def generate_oura_sleep_header_chart(date, days=7, summary=False, resample='D'):
     height = chartHeight if not summary else 300
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     if summary:
         df = pd.read_sql(sql=session.query(ouraSleepSummary).statement,
                          con=engine, index_col='report_date')
@@ -1046,7 +1038,6 @@ def generate_oura_sleep_header_chart(date, days=7, summary=False, resample='D'):
                          con=engine, index_col='report_date')[:days]
 
     daily_sleep_hr_target = session.query(athlete).filter(athlete.athlete_id == 1).first().daily_sleep_hr_target
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -1393,14 +1384,13 @@ def generate_oura_sleep_header_chart(date, days=7, summary=False, resample='D'):
 
 
 def generate_oura_sleep_content(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     # If the date passed is today's date (usually the default on load), grab the max date from db just in case oura cloud does not have current date yet
     if not date or date == datetime.today().date():
         date = session.query(func.max(ouraSleepSummary.report_date))[0][0]
 
     df = pd.read_sql(sql=session.query(ouraSleepSummary).filter(ouraSleepSummary.report_date == date).statement,
                      con=engine, index_col='report_date')
-    engine.dispose()
     session.close()
 
     return [html.Div(className='row', children=[
@@ -1471,13 +1461,12 @@ def generate_oura_sleep_content(date):
 
 def generate_sleep_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.score, ouraSleepSummary.total,
                           ouraSleepSummary.bedtime_end_local).filter(
             ouraSleepSummary.report_date > date).statement, con=engine,
         index_col='report_date')
-    engine.dispose()
     session.close()
 
     df['wakeup'] = df['bedtime_end_local'].apply(
@@ -1667,7 +1656,7 @@ def generate_sleep_modal_summary(days=7):
 
 
 def generate_oura_readiness_header_kpi(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraReadinessSummary.score).filter(ouraReadinessSummary.report_date == date).statement,
         con=engine)
@@ -1678,7 +1667,6 @@ def generate_oura_readiness_header_kpi(date):
             sql=session.query(ouraReadinessSummary.score).filter(
                 ouraReadinessSummary.report_date == date).statement,
             con=engine)
-    engine.dispose()
     session.close()
     score = df.loc[df.index.max()]['score']
     star = (score >= 85)
@@ -1688,7 +1676,7 @@ def generate_oura_readiness_header_kpi(date):
 
 def generate_oura_readiness_header_chart(date, days=7, summary=False, resample='D'):
     height = chartHeight if not summary else 300
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     if summary:
         df = pd.read_sql(
             sql=session.query(ouraReadinessSummary).statement, con=engine,
@@ -1713,7 +1701,6 @@ def generate_oura_readiness_header_chart(date, days=7, summary=False, resample='
     # Merge with rediness summary
     df = df.merge(hrv_df, how='left', left_index=True, right_index=True)
 
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -1944,7 +1931,7 @@ def generate_oura_readiness_header_chart(date, days=7, summary=False, resample='
 
 def generate_oura_readiness_content(date):
     # Most readiness data comes from sleep tables
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     # If the date passed is today's date (usually the default on load), grab the max date from db just in case oura cloud does not have current date yet
     if not date or date == datetime.today().date():
         sleep_date = session.query(func.max(ouraSleepSummary.report_date))[0][0]
@@ -1957,7 +1944,6 @@ def generate_oura_readiness_content(date):
     df_contributors = pd.read_sql(
         sql=session.query(ouraReadinessSummary).filter(ouraReadinessSummary.report_date == ready_date).statement,
         con=engine, index_col='report_date')
-    engine.dispose()
     session.close()
 
     return [html.Div(className='row', children=[
@@ -2037,7 +2023,7 @@ def generate_oura_readiness_content(date):
 
 def generate_readiness_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraReadinessSummary).filter(ouraReadinessSummary.report_date > date).statement,
         con=engine,
@@ -2046,7 +2032,6 @@ def generate_readiness_modal_summary(days=7):
         sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd, ouraSleepSummary.hr_lowest).filter(
             ouraSleepSummary.report_date > date).statement, con=engine,
         index_col='report_date')
-    engine.dispose()
     session.close()
     df = df.merge(hrv_df, how='left', left_index=True, right_index=True)
 
@@ -2316,7 +2301,7 @@ def generate_readiness_modal_summary(days=7):
 
 
 def generate_oura_activity_header_kpi(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraActivitySummary.score).filter(ouraActivitySummary.summary_date == date).statement,
         con=engine)
@@ -2327,7 +2312,6 @@ def generate_oura_activity_header_kpi(date):
             sql=session.query(ouraActivitySummary.score).filter(ouraActivitySummary.summary_date == date).statement,
             con=engine)
 
-    engine.dispose()
     session.close()
     score = df.loc[df.index.max()]['score']
     star = (score >= 85)
@@ -2336,14 +2320,13 @@ def generate_oura_activity_header_kpi(date):
 
 def generate_oura_activity_header_chart(date, days=7, summary=False, resample='D'):
     height = chartHeight if not summary else 300
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     if summary:
         df = pd.read_sql(sql=session.query(ouraActivitySummary).statement, con=engine, index_col='summary_date')
     else:
         df = pd.read_sql(
             sql=session.query(ouraActivitySummary).filter(ouraActivitySummary.summary_date > date).statement,
             con=engine, index_col='summary_date')[:days]
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -2527,14 +2510,13 @@ def generate_oura_activity_header_chart(date, days=7, summary=False, resample='D
 
 
 def generate_oura_activity_content(date):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     # If the date passed is today's date (usually the default on load), grab the max date from db just in case oura cloud does not have current date yet
     if not date or date == datetime.today().date():
         date = session.query(func.max(ouraActivitySummary.summary_date))[0][0]
 
     df = pd.read_sql(sql=session.query(ouraActivitySummary).filter(ouraActivitySummary.summary_date == date).statement,
                      con=engine, index_col='summary_date')
-    engine.dispose()
     session.close()
 
     return [html.Div(className='row', children=[
@@ -2605,14 +2587,13 @@ def generate_oura_activity_content(date):
 
 def generate_activity_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(
         sql=session.query(ouraActivitySummary.summary_date, ouraActivitySummary.score, ouraActivitySummary.cal_active,
                           ouraActivitySummary.target_calories, ouraActivitySummary.inactive).filter(
             ouraActivitySummary.summary_date > date).statement, con=engine,
         index_col='summary_date')
 
-    engine.dispose()
     session.close()
 
     df['completion'] = df['cal_active'] / df['target_calories']
@@ -2813,9 +2794,8 @@ def toggle_forward_arrow_display(week_ending):
     [Input('week-ending', 'children')]
 )
 def toggle_back_arrow_display(week_ending):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     min_saturday = calc_next_saturday(pd.to_datetime(session.query(func.min(ouraSleepSummary.report_date))[0][0]))
-    engine.dispose()
     session.close()
     if calc_next_saturday(datetime.strptime(week_ending, '%A %b %d, %Y')) == min_saturday:
         return {'color': 'rgba(0,0,0,0)', 'backgroundColor': 'rgba(0,0,0,0)',
@@ -2838,9 +2818,8 @@ def cycle_week(back_week_n_clicks, forward_week_n_clicks, current_week_selection
     else:
         button_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     min_saturday = calc_next_saturday(pd.to_datetime(session.query(func.min(ouraSleepSummary.report_date))[0][0]))
-    engine.dispose()
     session.close()
 
     if button_id == 'back-week':
@@ -2988,11 +2967,10 @@ def update_last_clicked(sleepClick, readinessClick, activityClick):
 def show_sleep_exclamation(dummy):
     show = {'display': 'inline-block', 'fontSize': '1rem', 'color': orange, 'paddingLeft': '1%'}
     hide = {'display': 'none'}
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     sleep_style = show if max_sleep_date != max_date else hide
@@ -3008,11 +2986,10 @@ def show_sleep_exclamation(dummy):
 def show_readiness_exclamation(dummy):
     show = {'display': 'inline-block', 'fontSize': '1rem', 'color': orange, 'paddingLeft': '1%'}
     hide = {'display': 'none'}
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     readiness_style = show if max_readiness_date != max_date else hide
@@ -3028,11 +3005,10 @@ def show_readiness_exclamation(dummy):
 def show_activity_exclamation(dummy):
     show = {'display': 'inline-block', 'fontSize': '1rem', 'color': orange, 'paddingLeft': '1%'}
     hide = {'display': 'none'}
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     activity_style = show if max_activity_date != max_date else hide
@@ -67,9 +67,8 @@ ftp_color = 'rgb(100, 217, 236)'
 
 
 def generate_exercise_charts(timeframe, muscle_options):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df = pd.read_sql(sql=session.query(fitbod).statement, con=engine)
-    engine.dispose()
     session.close()
     # Merge 'muscle' into exercise table for mapping
     df_muscle = pd.read_sql(sql=session.query(fitbod_muscles).statement, con=engine)
@@ -1,4 +1,3 @@
-import re
 from datetime import datetime, timedelta
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
@@ -9,13 +8,17 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from sqlalchemy import or_, delete, extract
 from ..app import app
-from ..api.sqlalchemy_declarative import db_insert, db_connect, athlete, stravaSummary, stravaSamples, \
+from ..api.sqlalchemy_declarative import db_insert, db_connect, athlete, stravaSummary, \
     hrvWorkoutStepLog, \
-    ouraSleepSummary, ouraReadinessSummary, annotations
+    ouraSleepSummary, ouraReadinessSummary, annotations, dailyMetrics
 from ..utils import utc_to_local, config, oura_credentials_supplied
 from ..pages.power import power_curve, zone_chart
+from ..api.sampleStore import get_activity_samples, epoch
+from ..api.samplePyramid import get_chart_samples, pyramid_streams
+from ..api.dailyMetrics import daily_training_load, extend_training_load, hrv_baselines, load_columns
 
 transition = int(config.get('dashboard', 'transition'))
 
@@ -522,7 +525,7 @@ def create_activity_table(date=None):
                                 'relative_intensity', 'efficiency_factor', 'variability_index', 'ftp', 'activity_id']
 
     # Covert date to datetime object if read from clickData
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
 
     if date is not None:
         df_table = pd.read_sql(sql=session.query(stravaSummary.start_day_local, stravaSummary.name, stravaSummary.type,
@@ -545,7 +548,6 @@ def create_activity_table(date=None):
                                                  stravaSummary.variability_index, stravaSummary.ftp,
                                                  stravaSummary.activity_id)
                                .statement, con=engine)
-    engine.dispose()
     session.close()
 
     df_table['distance'] = df_table['distance'].replace({0: np.nan})
@@ -615,7 +617,7 @@ def create_growth_kpis(date, cy_tss, ly_tss, target):
 
 
 def create_growth_chart(metric='tss'):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     weekly_tss_goal = session.query(athlete).filter(athlete.athlete_id == 1).first().weekly_tss_goal
 
     df = pd.read_sql(
@@ -624,7 +626,6 @@ def create_growth_chart(metric='tss'):
             extract('year', stravaSummary.start_date_utc) == (datetime.utcnow().year - 1))
         ).statement, con=engine, index_col='start_date_utc').sort_index(ascending=True)
 
-    engine.dispose()
     session.close()
 
     df['year'] = df.index.year
@@ -750,23 +751,30 @@ def get_workout_types(df_summary, run_status, ride_status, all_status):
 
 
 def create_fitness_chart(run_status, ride_status, all_status, power_status, hr_status):
-    session, engine = db_connect()
-    df_summary = pd.read_sql(sql=session.query(stravaSummary).statement, con=engine,
-                             index_col='start_date_local').sort_index(ascending=True)
-
-    hrv_df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
-                         con=engine,
-                         index_col='report_date').sort_index(ascending=True)
+    session, engine = db_connect(read_only=True)
+    # The default view (all sports, power and hr stress) is maintained in daily_metrics by ingestion
+    default_view = run_status and ride_status and all_status and power_status and hr_status
+    df_daily = pd.read_sql(sql=session.query(dailyMetrics).filter(dailyMetrics.athlete_id == 1).statement,
+                           con=engine, index_col='date').sort_index(ascending=True) if default_view else pd.DataFrame()
+    use_daily_metrics = len(df_daily) > 0
+
+    if not use_daily_metrics:
+        df_summary = pd.read_sql(sql=session.query(stravaSummary).statement, con=engine,
+                                 index_col='start_date_local').sort_index(ascending=True)
+
+        hrv_df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
+                             con=engine,
+                             index_col='report_date').sort_index(ascending=True)
+
+        df_readiness = pd.read_sql(
+            sql=session.query(ouraReadinessSummary.report_date, ouraReadinessSummary.score).statement,
+            con=engine,
+            index_col='report_date').sort_index(ascending=True)
 
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
     rr_max_threshold = athlete_info.rr_max_goal
     rr_min_threshold = athlete_info.rr_min_goal
 
-    df_readiness = pd.read_sql(
-        sql=session.query(ouraReadinessSummary.report_date, ouraReadinessSummary.score).statement,
-        con=engine,
-        index_col='report_date').sort_index(ascending=True)
-
     df_plan = pd.read_sql(
         sql=session.query(hrvWorkoutStepLog.date, hrvWorkoutStepLog.hrv_workout_step_desc,
                           hrvWorkoutStepLog.rationale).statement,
@@ -779,7 +787,6 @@ def create_fitness_chart(run_status, ride_status, all_status, power_status, hr_s
         con=engine,
         index_col='date').sort_index(ascending=False)
 
-    engine.dispose()
     session.close()
 
     chart_annotations = [go.layout.Annotation(
@@ -796,111 +803,29 @@ def create_fitness_chart(run_status, ride_status, all_status, power_status, hr_s
     ) for (x, y) in zip(df_annotations.index, df_annotations.annotation)
     ]
 
-    if oura_credentials_supplied:
-        # Resample hrv to fill any missing dates so rolling is always done at the correct # of days
-        hrv_df.set_index(pd.to_datetime(hrv_df.index), inplace=True)
-        hrv_df = hrv_df.resample('D').mean()
-        # Any changes to this code will have to be done in strava api hrv_workout_cycle() and hrv_workout_step_log would need to be truncated
-        # Recalculating here to plot on PMC (same calcs as in datapull.py)
-
-        # hrv_df['rmssd_7'] = hrv_df['rmssd'].ewm(7, min_periods=0).mean()
-        hrv_df['rmssd_7'] = hrv_df['rmssd'].rolling(7, min_periods=0).mean()
-        # hrv_df['rmssd_30'] = hrv_df['rmssd'].ewm(30, min_periods=0).mean()
-        hrv_df['rmssd_30'] = hrv_df['rmssd'].rolling(30, min_periods=0).mean()
-        # hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].ewm(30, min_periods=0).std() * .5
-        hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].rolling(30, min_periods=0).std() * .5
-        hrv_df['swc_upper'] = hrv_df['rmssd_30'] + hrv_df['stdev_rmssd_30_threshold']
-        hrv_df['swc_lower'] = hrv_df['rmssd_30'] - hrv_df['stdev_rmssd_30_threshold']
-
-    # Create flag to color tss bars when ftp test - use number so column remains through resample
-    df_new_run_ftp = df_summary[df_summary['type'].str.lower().str.contains('run')]
-    df_new_run_ftp['new_run_ftp_flag'] = 0
-    if len(df_new_run_ftp) > 0:
-        df_new_run_ftp['previous_ftp'] = df_new_run_ftp['ftp'].shift(1)
-        df_new_run_ftp = df_new_run_ftp[~np.isnan(df_new_run_ftp['previous_ftp'])]
-        df_new_run_ftp.loc[df_new_run_ftp['previous_ftp'] > df_new_run_ftp['ftp'], 'new_run_ftp_flag'] = -1
-        df_new_run_ftp.loc[df_new_run_ftp['previous_ftp'] < df_new_run_ftp['ftp'], 'new_run_ftp_flag'] = 1
-        # Highlight the workout which caused the new FTP to be set
-        df_new_run_ftp['new_run_ftp_flag'] = df_new_run_ftp['new_run_ftp_flag'].shift(-1)
-
-    df_new_ride_ftp = df_summary[df_summary['type'].str.lower().str.contains('ride')]
-    df_new_ride_ftp['new_ride_ftp_flag'] = 0
-    if len(df_new_ride_ftp) > 0:
-        df_new_ride_ftp['previous_ftp'] = df_new_ride_ftp['ftp'].shift(1)
-        df_new_ride_ftp = df_new_ride_ftp[~np.isnan(df_new_ride_ftp['previous_ftp'])]
-        df_new_ride_ftp.loc[df_new_ride_ftp['previous_ftp'] > df_new_ride_ftp['ftp'], 'new_ride_ftp_flag'] = -1
-        df_new_ride_ftp.loc[df_new_ride_ftp['previous_ftp'] < df_new_ride_ftp['ftp'], 'new_ride_ftp_flag'] = 1
-        # Highlight the workout which caused the new FTP to be set
-        df_new_ride_ftp['new_ride_ftp_flag'] = df_new_ride_ftp['new_ride_ftp_flag'].shift(-1)
-
-    # Add flags back to main df
-    df_summary = df_summary.merge(df_new_run_ftp['new_run_ftp_flag'].to_frame(), how='left', left_index=True,
-                                  right_index=True)
-    df_summary = df_summary.merge(df_new_ride_ftp['new_ride_ftp_flag'].to_frame(), how='left', left_index=True,
-                                  right_index=True)
-
-    df_summary.loc[df_summary['new_run_ftp_flag'] == 1, 'tss_flag'] = 1
-    df_summary.loc[df_summary['new_run_ftp_flag'] == -1, 'tss_flag'] = -1
-    df_summary.loc[df_summary['new_ride_ftp_flag'] == 1, 'tss_flag'] = 1
-    df_summary.loc[df_summary['new_ride_ftp_flag'] == -1, 'tss_flag'] = -1
-
-    # Create df of ftp tests to plot
     forecast_days = 13
-    atl_days = 7
-    initial_atl = 0
-    atl_exp = np.exp(-1 / atl_days)
-    ctl_days = 42
-    initial_ctl = 0
-    ctl_exp = np.exp(-1 / ctl_days)
-
-    # Insert dummy row with current date+forecast_days to ensure resample gets all dates
-    df_summary.loc[utc_to_local(datetime.utcnow()) + timedelta(days=forecast_days)] = None
-
-    if power_status and hr_status:
-        # If tss not available, use hrss
-        df_summary['stress_score'] = df_summary.apply(lambda row: row['hrss'] if np.isnan(row['tss']) else row['tss'],
-                                                      axis=1).fillna(0)
-    elif power_status:
-        df_summary['stress_score'] = df_summary['tss']
-    elif hr_status:
-        df_summary['stress_score'] = df_summary['hrss']
+    end_date = utc_to_local(datetime.utcnow()) + timedelta(days=forecast_days)
+
+    if use_daily_metrics:
+        df_daily.set_index(pd.to_datetime(df_daily.index), inplace=True)
+        # Stop hrv at the last night of data so the kpis show the latest baseline
+        hrv_df = df_daily.loc[:df_daily['rmssd'].last_valid_index(),
+                              ['rmssd', 'rmssd_7', 'rmssd_30', 'swc_upper', 'swc_lower']]
+        df_readiness = df_daily['readiness_score'].rename('score').to_frame()
+        pmd = extend_training_load(df_daily[load_columns + ['ctl', 'atl']].rename(
+            columns={'ctl': 'CTL', 'atl': 'ATL'}), end_date)
     else:
-        df_summary['stress_score'] = 0
-
-    # Calculate Metrics
-
-    # ATL should always be based off of ALL sports
-    # Sample to daily level and sum stress scores to aggregate multiple workouts per day
-    atl_df = df_summary[['stress_score', 'tss', 'hrss']].resample('D').sum()
-    atl_df['ATL'] = np.nan
-    atl_df['ATL'].iloc[0] = (atl_df['stress_score'].iloc[0] * (1 - atl_exp)) + (initial_atl * atl_exp)
-    for i in range(1, len(atl_df)):
-        atl_df['ATL'].iloc[i] = (atl_df['stress_score'].iloc[i] * (1 - atl_exp)) + (atl_df['ATL'].iloc[i - 1] * atl_exp)
-    atl_df['atl_tooltip'] = ['Fatigue: <b>{:.1f} ({}{:.1f})</b>'.format(x, '+' if x - y > 0 else '', x - y) for (x, y)
-                             in zip(atl_df['ATL'], atl_df['ATL'].shift(1))]
-
-    atl_df = atl_df.drop(columns=['stress_score', 'tss', 'hrss'])
-
-    # Sample to daily level and sum stress scores to aggregate multiple workouts per day
-
-    # Fitness and Form will change based off booleans that are selected
-    workout_types = get_workout_types(df_summary, run_status, ride_status, all_status)
+        if oura_credentials_supplied:
+            # Resample hrv to fill any missing dates so rolling is always done at the correct # of days
+            hrv_df.set_index(pd.to_datetime(hrv_df.index), inplace=True)
+            hrv_df = hrv_baselines(hrv_df['rmssd'].resample('D').mean())
 
-    pmd = df_summary[df_summary['type'].isin(workout_types)]
-    # Make sure df goes to same max date as ATL df
-    pmd.at[atl_df.index.max(), 'name'] = None
+        # Fitness and Form will change based off booleans that are selected, ATL is always based off of ALL sports
+        workout_types = get_workout_types(df_summary.copy(), run_status, ride_status, all_status)
+        pmd = daily_training_load(df_summary, end_date, workout_types, power_status, hr_status)
 
-    pmd = pmd[
-        ['stress_score', 'tss', 'hrss', 'low_intensity_seconds', 'med_intensity_seconds', 'high_intensity_seconds',
-         'tss_flag']].resample('D').sum()
-
-    pmd['CTL'] = np.nan
-    pmd['CTL'].iloc[0] = (pmd['stress_score'].iloc[0] * (1 - ctl_exp)) + (initial_ctl * ctl_exp)
-    for i in range(1, len(pmd)):
-        pmd['CTL'].iloc[i] = (pmd['stress_score'].iloc[i] * (1 - ctl_exp)) + (pmd['CTL'].iloc[i - 1] * ctl_exp)
-
-    # Merge pmd into ATL df
-    pmd = pmd.merge(atl_df, how='right', right_index=True, left_index=True)
+    pmd['atl_tooltip'] = ['Fatigue: <b>{:.1f} ({}{:.1f})</b>'.format(x, '+' if x - y > 0 else '', x - y) for (x, y)
+                          in zip(pmd['ATL'], pmd['ATL'].shift(1))]
 
     pmd['l6w_low_intensity'] = pmd['low_intensity_seconds'].rolling(42).sum()
     pmd['l6w_high_intensity'] = (pmd['med_intensity_seconds'] + pmd['high_intensity_seconds']).rolling(42).sum()
@@ -1299,7 +1224,7 @@ def create_fitness_chart(run_status, ride_status, all_status, power_status, hr_s
 
 
 def workout_distribution(run_status, ride_status, all_status):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     min_non_warmup_workout_time = session.query(athlete).filter(
         athlete.athlete_id == 1).first().min_non_warmup_workout_time
 
@@ -1311,7 +1236,6 @@ def workout_distribution(run_status, ride_status, all_status):
                 stravaSummary.high_intensity_seconds > 0)
         ).statement,
         con=engine, index_col='start_date_utc')
-    engine.dispose()
     session.close()
 
     # Generate list of all workout types for when the 'all' boolean is selected
@@ -1463,183 +1387,155 @@ def workout_summary_kpi(df_samples):
 
 def workout_details(df_samples, start_seconds=None, end_seconds=None):
     '''
-    :param df_samples filtered on 1 activity
+    :param df_samples: chart samples for 1 activity from get_chart_samples()
     :return: metric trend charts
     '''
+    return html.Div([
+        dcc.Graph(
+            id='trends', style={'height': '100%'},
+            config={
+                'displayModeBar': False,
+            },
+            figure=workout_trends_figure(df_samples, start_seconds, end_seconds)
+        )])
 
-    df_samples['watts'] = df_samples['watts'].fillna(0)
-    df_samples['heartrate'] = df_samples['heartrate'].fillna(0)
-    df_samples['velocity_smooth'] = df_samples['velocity_smooth'].fillna(0)
-    df_samples['cadence'] = df_samples['cadence'].fillna(0)
+
+def workout_trends_figure(df_samples, start_seconds=None, end_seconds=None):
+    '''
+    :param df_samples: chart samples for 1 activity from get_chart_samples()
+    :param start_seconds: start of range to highlight
+    :param end_seconds: end of range to highlight
+    :return: trend chart figure. Bucketed samples draw their min/max as a band behind the mean
+    '''
+    df_samples = df_samples.copy()
+    mean_columns = [stream + '_mean' for stream in pyramid_streams]
+    df_samples[mean_columns] = df_samples[mean_columns].fillna(0)
 
     # Create df of records to highlight if clickData present from callback
     if start_seconds is not None and end_seconds is not None:
-        highlight_df = df_samples[(df_samples['time'] >= int(start_seconds)) & (df_samples['time'] <= int(end_seconds))]
-
+        highlighted = (df_samples['time'] >= int(start_seconds)) & (df_samples['time'] <= int(end_seconds))
     else:
-        highlight_df = df_samples[df_samples['activity_id'] == 0]  # Dummy
+        highlighted = pd.Series(False, index=df_samples.index)
+    highlight_df = df_samples[highlighted]
 
     # Remove best points from main df_samples so lines do not overlap nor show 2 hoverinfos
-    for idx, row in df_samples.iterrows():
-        if idx in highlight_df.index:
-            df_samples.loc[idx, 'velocity_smooth'] = np.nan
-            df_samples.loc[idx, 'cadence'] = np.nan
-            df_samples.loc[idx, 'heartrate'] = np.nan
-            df_samples.loc[idx, 'watts'] = np.nan
+    df_samples.loc[highlighted, mean_columns] = np.nan
 
-    return html.Div([
-        dcc.Graph(
-            id='trends', style={'height': '100%'},
-            config={
-                'displayModeBar': False,
-            },
-            # figure= fig
-            figure={
-                'data': [
-                    go.Scatter(
-                        name='Speed',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['velocity_smooth']),
-                        # hoverinfo='x+y',
-                        yaxis='y2',
-                        mode='lines',
-                        line={'color': teal}
-                    ),
-                    go.Scatter(
-                        name='Speed',
-                        x=highlight_df['time_interval'],
-                        y=round(highlight_df['velocity_smooth']),
-                        # hoverinfo='x+y',
-                        yaxis='y2',
-                        mode='lines',
-                        line={'color': orange}
-                    ),
-                    go.Scatter(
-                        name='Cadence',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['cadence']),
-                        # hoverinfo='x+y',
-                        yaxis='y',
-                        mode='lines',
-                        line={'color': teal}
-                    ),
-                    go.Scatter(
-                        name='Cadence',
-                        x=highlight_df['time_interval'],
-                        y=round(highlight_df['cadence']),
-                        # hoverinfo='x+y',
-                        yaxis='y',
-                        mode='lines',
-                        line={'color': orange}
-                    ),
-                    go.Scatter(
-                        name='Heart Rate',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['heartrate']),
-                        # hoverinfo='x+y',
-                        yaxis='y3',
-                        mode='lines',
-                        line={'color': teal}
-                    ),
-                    go.Scatter(
-                        name='Heart Rate',
-                        x=highlight_df['time_interval'],
-                        y=round(highlight_df['heartrate']),
-                        # hoverinfo='x+y',
-                        yaxis='y3',
-                        mode='lines',
-                        line={'color': orange}
-                    ),
-                    go.Scatter(
-                        name='Power',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['watts']),
-                        # hoverinfo='x+y',
-                        yaxis='y4',
-                        mode='lines',
-                        line={'color': teal}
-                    ),
-                    go.Scatter(
-                        name='Power',
-                        x=highlight_df['time_interval'],
-                        y=round(highlight_df['watts']),
-                        # hoverinfo='x+y',
-                        yaxis='y4',
-                        mode='lines',
-                        line={'color': orange}
-                    ),
+    bucketed = len(df_samples) > 0 and df_samples['resolution'].max() > 1
+    data = []
+    for name, stream, yaxis in [('Speed', 'velocity_smooth', 'y2'), ('Cadence', 'cadence', 'y'),
+                                ('Heart Rate', 'heartrate', 'y3'), ('Power', 'watts', 'y4')]:
+        if bucketed:
+            data += [
+                go.Scatter(
+                    name=name,
+                    x=df_samples['time_interval'],
+                    y=round(df_samples[stream + '_max']),
+                    hoverinfo='skip',
+                    yaxis=yaxis,
+                    mode='lines',
+                    line={'color': teal, 'width': 0}
+                ),
+                go.Scatter(
+                    name=name,
+                    x=df_samples['time_interval'],
+                    y=round(df_samples[stream + '_min']),
+                    hoverinfo='skip',
+                    yaxis=yaxis,
+                    mode='lines',
+                    fill='tonexty',
+                    fillcolor=teal,
+                    opacity=0.25,
+                    line={'color': teal, 'width': 0}
+                ),
+            ]
+        data += [
+            go.Scatter(
+                name=name,
+                x=df_samples['time_interval'],
+                y=round(df_samples[stream + '_mean']),
+                # hoverinfo='x+y',
+                yaxis=yaxis,
+                mode='lines',
+                line={'color': teal}
+            ),
+            go.Scatter(
+                name=name,
+                x=highlight_df['time_interval'],
+                y=round(highlight_df[stream + '_mean']),
+                # hoverinfo='x+y',
+                yaxis=yaxis,
+                mode='lines',
+                line={'color': orange}
+            ),
+        ]
 
-                ],
-                'layout': go.Layout(
-                    # transition=dict(duration=transition),
+    def tickvals(stream):
+        return [round(df_samples[stream + '_min'].fillna(0).min()), round(df_samples[stream + '_max'].fillna(0).max())]
 
-                    font=dict(
-                        color='rgb(220,220,220)'
-                    ),
+    return {
+        'data': data,
+        'layout': go.Layout(
+            # transition=dict(duration=transition),
 
-                    hovermode='x',
-                    margin={'l': 40, 'b': 25, 't': 5, 'r': 40},
-                    showlegend=False,
-                    # legend={'x': .5, 'y': 1.05, 'xanchor': 'center', 'orientation': 'h',
-                    #         'traceorder': 'normal', 'bgcolor': 'rgba(127, 127, 127, 0)'},
-                    xaxis=dict(
-                        showticklabels=True,
-                        showgrid=False,
-                        showline=True,
-                        tickformat="%Mm",
-                        hoverformat="%H:%M:%S",
-                        spikemode='across',
-                        showspikes=True,
-                        spikesnap='cursor',
-                        zeroline=False,
-                        # tickvals=[1, 2, 5, 10, 30, 60, 120, 5 * 60, 10 * 60, 20 * 60, 60 * 60, 60 * 90],
-                        # ticktext=['1s', '2s', '5s', '10s', '30s', '1m',
-                        #           '2m', '5m', '10m', '20m', '60m', '90m'],
-                    ),
-                    yaxis=dict(
-                        color=white,
-                        showticklabels=True,
-                        tickvals=[df_samples['cadence'].min(),
-                                  # round(df_samples['cadence'].mean()),
-                                  df_samples['cadence'].max()],
-                        zeroline=False,
-                        domain=[0, 0.24],
-                        anchor='x'
-                    ),
-                    yaxis2=dict(
-                        color=white,
-                        showticklabels=True,
-                        tickvals=[round(df_samples['velocity_smooth'].min()),
-                                  # round(df_samples['velocity_smooth'].mean()),
-                                  round(df_samples['velocity_smooth'].max())],
-                        zeroline=False,
-                        domain=[0.26, 0.49],
-                        anchor='x'
-                    ),
-                    yaxis3=dict(
-                        color=white,
-                        showticklabels=True,
-                        tickvals=[df_samples['heartrate'].min(),
-                                  # round(df_samples['heartrate'].mean()),
-                                  df_samples['heartrate'].max()],
-                        zeroline=False,
-                        domain=[0.51, 0.74],
-                        anchor='x'
-                    ),
-                    yaxis4=dict(
-                        color=white,
-                        showticklabels=True,
-                        tickvals=[df_samples['watts'].min(),
-                                  # round(df_samples['watts'].mean()),
-                                  df_samples['watts'].max()],
-                        zeroline=False,
-                        domain=[0.76, 1],
-                        anchor='x'
-                    )
+            font=dict(
+                color='rgb(220,220,220)'
+            ),
 
-                )
-            }
-        )])
+            hovermode='x',
+            margin={'l': 40, 'b': 25, 't': 5, 'r': 40},
+            showlegend=False,
+            # legend={'x': .5, 'y': 1.05, 'xanchor': 'center', 'orientation': 'h',
+            #         'traceorder': 'normal', 'bgcolor': 'rgba(127, 127, 127, 0)'},
+            xaxis=dict(
+                showticklabels=True,
+                showgrid=False,
+                showline=True,
+                tickformat="%Mm",
+                hoverformat="%H:%M:%S",
+                spikemode='across',
+                showspikes=True,
+                spikesnap='cursor',
+                zeroline=False,
+                # tickvals=[1, 2, 5, 10, 30, 60, 120, 5 * 60, 10 * 60, 20 * 60, 60 * 60, 60 * 90],
+                # ticktext=['1s', '2s', '5s', '10s', '30s', '1m',
+                #           '2m', '5m', '10m', '20m', '60m', '90m'],
+            ),
+            yaxis=dict(
+                color=white,
+                showticklabels=True,
+                tickvals=tickvals('cadence'),
+                zeroline=False,
+                domain=[0, 0.24],
+                anchor='x'
+            ),
+            yaxis2=dict(
+                color=white,
+                showticklabels=True,
+                tickvals=tickvals('velocity_smooth'),
+                zeroline=False,
+                domain=[0.26, 0.49],
+                anchor='x'
+            ),
+            yaxis3=dict(
+                color=white,
+                showticklabels=True,
+                tickvals=tickvals('heartrate'),
+                zeroline=False,
+                domain=[0.51, 0.74],
+                anchor='x'
+            ),
+            yaxis4=dict(
+                color=white,
+                showticklabels=True,
+                tickvals=tickvals('watts'),
+                zeroline=False,
+                domain=[0.76, 1],
+                anchor='x'
+            )
+
+        )
+    }
 
 
 def calculate_splits(df_samples):
@@ -1709,12 +1605,11 @@ def calculate_splits(df_samples):
 
 
 def create_annotation_table():
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df_annotations = pd.read_sql(
         sql=session.query(annotations.athlete_id, annotations.date, annotations.annotation).filter(
             athlete.athlete_id == 1).statement,
         con=engine).sort_index(ascending=False)
-    engine.dispose()
     session.close()
 
     return dash_table.DataTable(id='annotation-table',
@@ -1879,9 +1774,8 @@ def toggle_activity_modal(active_cell, n2, data, is_open):
         if activity_id:
             # if open, populate charts
             if not is_open:
-                session, engine = db_connect()
+                session, engine = db_connect(read_only=True)
                 activity = session.query(stravaSummary).filter(stravaSummary.activity_id == activity_id).first()
-                engine.dispose()
                 session.close()
                 # return activity_id
                 return not is_open, html.H5(
@@ -1946,18 +1840,33 @@ def modal_power_zone(activity, is_open):
 def modal_workout_trends(activity, is_open):
     if activity and is_open:
         activity_id = activity.split('|')[0]
-        session, engine = db_connect()
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-            con=engine,
-            index_col=['timestamp_local'])
-        engine.dispose()
-        session.close()
-        return workout_summary_kpi(df_samples), workout_details(df_samples), calculate_splits(df_samples)
+        df_samples = get_activity_samples(activity_id)
+        return workout_summary_kpi(df_samples), workout_details(get_chart_samples(activity_id)), calculate_splits(
+            df_samples)
     else:
         return None, None, None
 
 
+# Activity modal trend chart zoom, re-read samples at the level that fits the visible range
+@app.callback(
+    Output('trends', 'figure'),
+    [Input('trends', 'relayoutData')],
+    [State("modal-activity-id-type-metric", "children")]
+)
+def zoom_workout_trends(relayoutData, activity):
+    if not relayoutData or not activity:
+        raise PreventUpdate
+    if 'xaxis.range[0]' in relayoutData:
+        start_seconds, end_seconds = [(pd.Timestamp(relayoutData['xaxis.range[{}]'.format(i)]) - epoch).total_seconds()
+                                      for i in range(2)]
+    elif relayoutData.get('xaxis.autorange'):
+        start_seconds, end_seconds = None, None
+    else:
+        raise PreventUpdate
+    activity_id = activity.split('|')[0]
+    return workout_trends_figure(get_chart_samples(activity_id, start_seconds, end_seconds))
+
+
 # # Annotation Modal Toggle
 @app.callback(
     Output("annotation-modal", "is_open"),
@@ -2008,7 +1917,6 @@ def annotation_table_save(n_clicks, password, data):
             session, engine = db_connect()
             session.execute(delete(annotations).where(annotations.athlete_id == 1))
             session.commit()
-            engine.dispose()
             session.close()
             # Add annotations
             db_insert(df, 'annotations')
@@ -6,14 +6,17 @@ import plotly.graph_objs as go
 import dash_daq as daq
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
-from ..api.sqlalchemy_declarative import db_connect, stravaSummary, stravaSamples, stravaBestSamples, athlete, withings
+from ..api.sqlalchemy_declarative import db_connect, stravaSummary, stravaBestSamples, athlete, withings, \
+    stravaBestEnvelope
 from ..app import app
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from ..utils import config, stryd_credentials_supplied
-from sqlalchemy import func, or_
+from sqlalchemy import func
 import math
 from ..api.strydAPI import get_training_distribution
+from ..api.sampleStore import get_activity_samples, get_samples_since
+from ..api.bestEnvelope import activity_sport
 
 # pre_style = {"backgroundColor": "#ddd", "fontSize": 20, "padding": "10px", "margin": "10px"}
 hidden_style = {"display": "none"}
@@ -82,17 +85,13 @@ def create_power_curve_kpis(interval, all, L90D, l6w, last, pr):
 
 
 def get_workout_title(activity_id=None):
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     min_non_warmup_workout_time = session.query(athlete).filter(
         athlete.athlete_id == 1).first().min_non_warmup_workout_time
     activity_id = session.query(stravaSummary.activity_id).filter(stravaSummary.type.ilike('%ride%'),
                                                                   stravaSummary.elapsed_time > min_non_warmup_workout_time).order_by(
         stravaSummary.start_date_utc.desc()).first()[0] if not activity_id else activity_id
-    df_samples = pd.read_sql(
-        sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-        con=engine,
-        index_col=['timestamp_local'])
-    engine.dispose()
+    df_samples = get_activity_samples(activity_id, engine=engine, session=session)
     session.close()
 
     return [html.H6(datetime.strftime(df_samples['date'][0], "%A %b %d, %Y"), style={'height': '50%'}),
@@ -101,13 +100,12 @@ def get_workout_title(activity_id=None):
 
 def power_profiles(interval, activity_type='ride', power_unit='mmp', group='M'):
     activity_type = '%' + activity_type + '%'
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     # Filter on interval passed
     df_best_samples = pd.read_sql(
         sql=session.query(stravaBestSamples).filter(stravaBestSamples.type.ilike(activity_type),
                                                     stravaBestSamples.interval == interval).statement, con=engine,
         index_col=['timestamp_local'])
-    engine.dispose()
     session.close()
     if len(df_best_samples) < 1:
         return {}
@@ -161,34 +159,22 @@ def power_profiles(interval, activity_type='ride', power_unit='mmp', group='M'):
 
 
 def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend=False, strydmetrics=True):
-    activity_type = '%' + activity_type + '%'
-
-    session, engine = db_connect()
+    activity_type = activity_sport(activity_type) or activity_type
+    session, engine = db_connect(read_only=True)
 
-    max_interval = session.query(
-        func.max(stravaBestSamples.interval).label('interval')).filter(
-        stravaBestSamples.type.ilike(activity_type)).first()[0]
-
-    act_dict = pd.read_sql(
-        sql=session.query(stravaBestSamples.activity_id, stravaBestSamples.act_name).distinct().statement, con=engine,
-        index_col='activity_id').to_dict()
+    # Best interval for each period is maintained in strava_best_envelope (api/bestEnvelope.py)
+    df_envelope = pd.read_sql(
+        sql=session.query(stravaBestEnvelope).filter(stravaBestEnvelope.sport == activity_type).statement,
+        con=engine, index_col='interval').sort_index()
+    all_time_df = df_envelope[df_envelope['period'] == 'all']
+    max_interval = all_time_df.index.max() if len(all_time_df) > 0 else 0
 
     # Data points for Power Curve Training Disribution
-    TD_df_L90D = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=90))
-                                                      ).statement, con=engine)
+    TD_df_L90D = df_envelope[df_envelope['period'] == 'L90D'].reset_index()
 
     td_data_exists = len(TD_df_L90D) > 0
     # If training distribution data exists
     if td_data_exists:
-        TD_df_L90D['act_name'] = TD_df_L90D['activity_id'].map(act_dict['act_name'])
-
         # Join in weight at the time of workout for calculating FTP_W/kg at point in time (of workout)
         TD_df_L90D = TD_df_L90D.merge(pd.read_sql(
             sql=session.query(stravaSummary.activity_id, stravaSummary.weight).filter(
@@ -216,16 +202,7 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend
         # Muscle power is just best 10 second power (weight/ftp do not matter)
         muscle_power = TD_df_L90D.loc[10][power_unit]
 
-        TD_df_at = pd.read_sql(
-            sql=session.query(
-                func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-                stravaBestSamples.interval, stravaBestSamples.time_interval,
-                stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-            ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.type.ilike(activity_type),
-                                                          or_(stravaBestSamples.interval == 10,
-                                                              stravaBestSamples.interval == int(fatigue_df.name),
-                                                              stravaBestSamples.interval == int(endurance_df.name)),
-                                                          ).statement, con=engine, index_col='interval')
+        TD_df_at = all_time_df
 
         muscle_power_best = True if TD_df_at.loc[10][power_unit] == muscle_power else False
         endurance_best = True if TD_df_at.loc[endurance_df.name][power_unit] == endurance_df[power_unit] else False
@@ -238,60 +215,30 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend
     # 30 second intervals for everything after 20 mins
     interval_lengths += [i for i in range(1230, (int(math.floor(max_interval / 10.0)) * 10) + 1, 30)]
 
-    all_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'),
-            stravaBestSamples.activity_id, stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type)).statement,
-        con=engine, index_col='interval')
-    all_best_interval_df['act_name'] = all_best_interval_df['activity_id'].map(act_dict['act_name'])
+    all_best_interval_df = all_time_df[all_time_df.index.isin(interval_lengths)]
 
-    L90D_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id, stravaBestSamples.ftp,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=90))
-                                                      ).statement, con=engine, index_col='interval')
+    L90D_best_interval_df = df_envelope[
+        (df_envelope['period'] == 'L90D') & (df_envelope.index.isin(interval_lengths))].copy()
 
-    L90D_best_interval_df['act_name'] = L90D_best_interval_df['activity_id'].map(act_dict['act_name'])
-
-    L6W_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=42))
-                                                      ).statement, con=engine, index_col='interval')
-    L6W_best_interval_df['act_name'] = L6W_best_interval_df['activity_id'].map(act_dict['act_name'])
+    L6W_best_interval_df = df_envelope[(df_envelope['period'] == 'L6W') & (df_envelope.index.isin(interval_lengths))]
 
     # Pull max power from all intervals from latest workout
 
     if last_id is None:
-        last_id = session.query(stravaSummary.activity_id).filter(stravaSummary.type.ilike(activity_type)).order_by(
-            stravaSummary.start_date_utc.desc()).first()[0]
+        last_id = session.query(stravaSummary.activity_id).filter(
+            stravaSummary.type.ilike('%' + activity_type + '%')).order_by(stravaSummary.start_date_utc.desc()).first()[0]
 
     recent_best_interval_df = pd.read_sql(
         sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
+            stravaBestSamples.mmp, stravaBestSamples.activity_id, stravaBestSamples.act_name,
             stravaBestSamples.interval, stravaBestSamples.time_interval,
             stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.activity_id == last_id,
-                                                      stravaBestSamples.interval.in_(interval_lengths),
-                                                      ).statement, con=engine, index_col='interval')
-    recent_best_interval_df['act_name'] = recent_best_interval_df['activity_id'].map(act_dict['act_name'])
+        ).filter(stravaBestSamples.activity_id == last_id,
+                 stravaBestSamples.interval.in_(interval_lengths),
+                 ).statement, con=engine, index_col='interval').sort_index()
 
     first_workout_date = session.query(func.min(stravaSummary.start_date_utc)).first()[0]
 
-    engine.dispose()
     session.close()
 
     if len(all_best_interval_df) < 1:
@@ -716,14 +663,13 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend
 
 def create_ftp_chart(activity_type='ride', power_unit='watts'):
     activity_type = '%' + activity_type + '%'
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     df_ftp = pd.read_sql(
         sql=session.query(stravaSummary).filter(stravaSummary.type.ilike(activity_type),
                                                 stravaSummary.start_date_utc >= (
                                                         datetime.utcnow() - relativedelta(months=12))
                                                 ).statement, con=engine,
         index_col='start_day_local')[['activity_id', 'ftp', 'weight']]
-    engine.dispose()
     session.close()
 
     if len(df_ftp) < 1:
@@ -803,21 +749,10 @@ def create_ftp_chart(activity_type='ride', power_unit='watts'):
 
 def zone_chart(activity_id=None, metric='power_zone', chart_id='power-zone-chart'):
     # If activity_id passed, filter only that workout, otherwise show distribution across last 6 weeks
-    session, engine = db_connect()
     if activity_id:
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-            con=engine,
-            index_col=['timestamp_local'])
+        df_samples = get_activity_samples(activity_id)
     else:
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(
-                stravaSamples.timestamp_local >= (datetime.now() - timedelta(days=42))).statement,
-            con=engine,
-            index_col=['timestamp_local'])
-
-    engine.dispose()
-    session.close()
+        df_samples = get_samples_since(datetime.now() - timedelta(days=42))
 
     pz_df = df_samples.groupby(metric).size().reset_index(name='counts')
     pz_df['seconds'] = pz_df['counts']
@@ -11,7 +11,8 @@ from ..api.withingsAPI import withings_connected, connect_withings_link, save_wi
 from ..api.pelotonApi import get_class_types
 from nokia import NokiaAuth, NokiaApi
 from ..api.sqlalchemy_declarative import db_connect, stravaSummary, ouraSleepSummary, athlete, hrvWorkoutStepLog
-from ..api.datapull import refresh_database
+from ..api.reprocess import reprocess_setting_change
+from ..api.jobQueue import enqueue_job, latest_job
 from sqlalchemy import delete
 import pandas as pd
 from dateutil.relativedelta import relativedelta
@@ -99,7 +100,7 @@ def check_withings_connection():
 
 def generate_cycle_power_zone_card():
     # TODO: Switch over to using Critical Power for everything once we get the critical power model working
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     # Use last ftp test ride so power zones shows immideately here after workout is done (and you don't have to wait for 1 more since ftp doesnt take 'effect' until ride after ftp test)
     cftp = pd.read_sql(
         sql=session.query(stravaSummary.average_watts).filter(stravaSummary.type.like('ride'),
@@ -108,7 +109,6 @@ def generate_cycle_power_zone_card():
     cftp = round(int(cftp.loc[cftp.index.max()].fillna(0)['average_watts']) * .95) if len(cftp) > 0 else 0
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
-    engine.dispose()
     session.close()
 
     cycle_power_zone_threshold_1 = athlete_info.cycle_power_zone_threshold_1
@@ -157,13 +157,12 @@ def generate_cycle_power_zone_card():
 
 def generate_run_power_zone_card():
     # TODO: Switch over to using Critical Power for everything once we get the critical power model working
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     rftp = pd.read_sql(
         sql=session.query(stravaSummary.ftp).filter(stravaSummary.type.like('run')).statement, con=engine)
     rftp = int(rftp.loc[rftp.index.max()].fillna(0)['ftp']) if len(rftp) > 0 else 0
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
-    engine.dispose()
     session.close()
 
     run_power_zone_threshold_1 = athlete_info.run_power_zone_threshold_1
@@ -197,9 +196,8 @@ def generate_run_power_zone_card():
 
 
 def athlete_card():
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
     color = '' if athlete_info.name and athlete_info.birthday and athlete_info.sex and athlete_info.weight_lbs and athlete_info.resting_hr and athlete_info.run_ftp and athlete_info.ride_ftp else 'border-danger'
     peloton_class_types = get_class_types()
@@ -276,7 +274,7 @@ def athlete_card():
 
 
 def generate_hr_zone_card():
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     rhr = pd.read_sql(
         sql=session.query(ouraSleepSummary.hr_lowest).statement,
         con=engine)
@@ -284,7 +282,6 @@ def generate_hr_zone_card():
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
     birthday = athlete_info.birthday
 
-    engine.dispose()
     session.close()
 
     age = relativedelta(datetime.today(), birthday).years
@@ -333,9 +330,8 @@ def generate_db_setting(id, title, value, placeholder=None):
 
 
 def goal_parameters():
-    session, engine = db_connect()
+    session, engine = db_connect(read_only=True)
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
     use_readiness = True if athlete_info.weekly_workout_goal == 99 and athlete_info.weekly_yoga_goal == 99 else False
     use_hrv = True if athlete_info.weekly_workout_goal == 100 and athlete_info.weekly_yoga_goal == 100 else False
@@ -453,6 +449,7 @@ def generate_settings_dashboard():
                             html.Div(id='truncate-hrv-status'),
                         ])
                                                                     ]),
+                        html.Div(id='refresh-job-status', className='col-12 mb-2'),
                     ])
                 ])
             ]),
@@ -505,7 +502,6 @@ def update_athlete_db_value(value, value_name):
     except BaseException as e:
         success = False
         app.server.logger.error(str(e))
-    engine.dispose()
     session.close()
     return success
 
@@ -773,6 +769,8 @@ def save_athlete_settings(
         if success:
             output_styles[index1] = {'display': 'none'}
             output_styles[index2] = {'color': 'green', 'fontSize': '150%'}
+            # Apply the new value to activities already analyzed with the old one
+            reprocess_setting_change(latest_dict[latest])
         else:
             output_styles[index1] = {'display': 'inline-block', 'border': '0px'}
             output_styles[index2] = {'display': 'none'}
@@ -837,7 +835,6 @@ def set_fitness_goals(readiness_dummy, hrv_dummy, readiness_switch, hrv_switch):
             session.commit()
     except BaseException as e:
         app.server.logger.error(e)
-    engine.dispose()
     session.close()
 
     return style, style
@@ -860,11 +857,29 @@ def update_api_connection_status(n_clicks):
 def refresh(n_clicks):
     if n_clicks > 0:
         app.server.logger.info('Manually refreshing database tables...')
-        refresh_database(refresh_method='manual')
-        return html.H6('Refresh Complete')
+        enqueue_job('refresh', refresh_method='manual')
+        return html.H6('Refresh Queued')
     return ''
 
 
+# Progress of the latest refresh/reprocess job, run by the worker outside of the request
+@app.callback(Output('refresh-job-status', 'children'),
+              [Input('interval-component', 'n_intervals')])
+def refresh_job_status(n):
+    job = latest_job()
+    if job is None:
+        return ''
+    name = 'Refresh' if job['kind'] == 'refresh' else 'Reprocess'
+    if job['status'] == 'queued':
+        return html.H6('{} waiting to start'.format(name))
+    elif job['status'] == 'running':
+        progress = ' ({} of {})'.format(job['progress_done'], job['progress_total']) if job['progress_total'] else ''
+        return html.H6('{} running: {}{}'.format(name, job['stage'] or 'Starting', progress))
+    elif job['status'] == 'failed':
+        return html.H6('{} failed: {}'.format(name, job['message']))
+    return html.H6('{} complete {}'.format(name, job['finished_utc'].strftime('%Y-%m-%d %H:%M UTC')))
+
+
 # Truncate hrv_workout_step_log (reset HRV Plan)
 @app.callback(Output('truncate-hrv-status', 'children'),
               [Input('truncate-hrv-button', 'n_clicks')],
@@ -890,7 +905,6 @@ def reset_hrv_plan(n_clicks, hrv_date):
             session.rollback()
             app.server.logger.error('Error resetting hrv workout plan: {}'.format(e))
             return html.H6('Error Resetting HRV Plan')
-        engine.dispose()
         session.close()
     return ''
 
@@ -904,16 +918,16 @@ def truncate_and_refresh(n_clicks, n_clicks_date, truncateDate):
     if n_clicks > 0:
         app.server.logger.info('Manually truncating and refreshing database tables...')
         try:
-            refresh_database(refresh_method='manual', truncate=True)
-            return html.H6('Truncate and Load Complete')
+            enqueue_job('refresh', refresh_method='manual', truncate=True)
+            return html.H6('Truncate and Load Queued')
         except BaseException as e:
             return html.H6('Error with Truncate and Load')
     elif n_clicks_date > 0:
         app.server.logger.info(
             'Manually truncating and refreshing database tables after {}...'.format(truncateDate))
         try:
-            refresh_database(refresh_method='manual', truncateDate=truncateDate)
-            return html.H6('Truncate and Load Complete')
+            enqueue_job('refresh', refresh_method='manual', truncateDate=truncateDate)
+            return html.H6('Truncate and Load Queued')
         except:
             return html.H6('Error with Truncate and Load')
     return ''
@@ -1008,10 +1022,9 @@ def update_tokens(n_clicks, search):
 def query_peloton_bookmark_settings(fitness_discipline, effort):
     if fitness_discipline and effort:
         # Query athlete table for current peloton settings to show in value of dropdown
-        session, engine = db_connect()
+        session, engine = db_connect(read_only=True)
         athlete_bookmarks = json.loads(session.query(athlete.peloton_auto_bookmark_ids).filter(
             athlete.athlete_id == 1).first().peloton_auto_bookmark_ids)
-        engine.dispose()
         session.close()
         if athlete_bookmarks:
             try:
@@ -1073,7 +1086,6 @@ def save_peloton_bookmark_settings(n_clicks, fitness_discipline, effort, options
             # write back to database
             session.commit()
 
-            engine.dispose()
             session.close()
             return {'color': 'green', 'fontSize': '150%'}
         else:
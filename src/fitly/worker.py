@@ -0,0 +1,31 @@
+"""Standalone ingestion worker: runs queued refresh and reprocess jobs and the hourly refresh schedule."""
+
+import click
+
+
+@click.command()
+@click.option("--once", is_flag=True, help="Run the jobs already queued and exit instead of polling for new ones")
+def main(once):
+    """Run Fit.ly ingestion jobs outside of the web app."""
+    from .utils import config
+
+    if config.get("worker", "embedded", fallback="True").lower() == "true":
+        raise click.ClickException(
+            "Set embedded = False in the [worker] section of config.ini so the web app stops running jobs itself"
+        )
+
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from .app import app
+    from .api.jobQueue import schedule_jobs, run_queued_jobs
+
+    if once:
+        click.echo(f"Ran {run_queued_jobs()} jobs")
+        return
+
+    scheduler = BlockingScheduler()
+    schedule_jobs(scheduler)
+    app.server.logger.info("Starting fitly-worker")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
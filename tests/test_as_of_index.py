@@ -0,0 +1,75 @@
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fitly.api.asOfIndex import AsOfSeries
+
+
+def query_asof(timestamps, values, t, strict=False, hold_first=False):
+    # Per activity query AsOfSeries replaced: latest record at (or strictly before) t, else the first record
+    records = sorted(zip(timestamps, values), key=lambda x: x[0])
+    before = [value for timestamp, value in records if (timestamp < t if strict else timestamp <= t)]
+    if before:
+        return before[-1]
+    return records[0][1] if hold_first and records else None
+
+
+timestamps = [pd.Timestamp('2020-03-01'), pd.Timestamp('2020-01-01'), pd.Timestamp('2020-02-01 06:00')]
+values = [60, 50, 55]
+lookups = [pd.Timestamp(x) for x in ['2019-12-31', '2020-01-01', '2020-01-15', '2020-02-01 06:00', '2020-02-01 06:01',
+                                     '2020-03-01', '2021-01-01']]
+
+
+@pytest.mark.parametrize('strict', [False, True])
+@pytest.mark.parametrize('hold_first', [False, True])
+def test_matches_query(strict, hold_first):
+    series = AsOfSeries(timestamps, values, strict=strict, hold_first=hold_first)
+    expected = [query_asof(timestamps, values, t, strict, hold_first) for t in lookups]
+    assert series.asof(lookups).tolist() == expected
+
+
+def test_boundaries():
+    assert AsOfSeries(timestamps, values).asof(lookups).tolist() == [None, 50, 50, 55, 55, 60, 60]
+    assert AsOfSeries(timestamps, values, strict=True).asof(lookups).tolist() == [None, None, 50, 50, 55, 55, 60]
+    assert AsOfSeries(timestamps, values, hold_first=True).asof(lookups[:1]).tolist() == [50]
+
+
+def test_random_lookups_match_query():
+    rng = np.random.default_rng(0)
+    start = np.datetime64('2020-01-01')
+    record_times = [pd.Timestamp(start + np.timedelta64(int(x), 'h')) for x in rng.choice(5000, 200, replace=False)]
+    record_values = rng.integers(40, 60, 200).tolist()
+    lookup_times = [pd.Timestamp(start + np.timedelta64(int(x), 'h')) for x in rng.integers(-100, 5100, 500)]
+    for strict, hold_first in [(False, True), (True, False)]:
+        series = AsOfSeries(record_times, record_values, strict=strict, hold_first=hold_first)
+        expected = [query_asof(record_times, record_values, t, strict, hold_first) for t in lookup_times]
+        assert series.asof(lookup_times).tolist() == expected
+
+
+def test_missing_timestamps_are_ignored():
+    series = AsOfSeries([pd.NaT, pd.Timestamp('2020-01-01'), None], [1, 2, 3], hold_first=True)
+    assert len(series) == 1
+    assert series.asof([pd.Timestamp('2019-01-01'), pd.Timestamp('2020-06-01')]).tolist() == [2, 2]
+
+
+def test_dates_and_tz_aware_timestamps():
+    # report_date columns are dates, stravalib start_date is tz aware and compared in UTC
+    series = AsOfSeries([date(2020, 1, 1), date(2020, 1, 2)], [50, 51])
+    assert series.asof([pd.Timestamp('2020-01-01 23:00-05:00')]).tolist() == [51]
+    assert series.asof([datetime(2020, 1, 1, 23)]).tolist() == [50]
+
+
+def test_empty():
+    for hold_first in [False, True]:
+        series = AsOfSeries([], [], hold_first=hold_first)
+        assert series.asof([pd.Timestamp('2020-01-01')]).tolist() == [None]
+        assert pd.isnull(series.asof_timestamps([pd.Timestamp('2020-01-01')])).all()
+
+
+def test_asof_timestamps():
+    series = AsOfSeries(timestamps, values, strict=True)
+    result = series.asof_timestamps([pd.Timestamp('2020-01-01'), pd.Timestamp('2020-02-15')])
+    assert pd.isnull(result[0])
+    assert result[1] == np.datetime64('2020-02-01T06:00')
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sweat.metrics.core import mean_max
+
+from fitly.api.meanMaxPower import mean_max_power
+
+
+def test_matches_sweat_mean_max():
+    power = np.random.default_rng(0).integers(0, 900, 1800).astype(float)
+    mmp = mean_max_power(power)
+    assert mmp.index.name == 'interval' and mmp.name == 'mmp'
+    assert mmp.index.tolist() == list(range(1, 1800))
+    np.testing.assert_allclose(mmp.to_numpy(), mean_max(power))
+
+
+def test_hand_computed():
+    # The sample at time 0 is never part of an interval
+    mmp = mean_max_power([1000, 100, 300, 200])
+    np.testing.assert_allclose(mmp.to_numpy(), [300, 250, 200])
+
+
+def test_missing_samples_count_as_zero():
+    mmp = mean_max_power([100, np.nan, 300, None])
+    np.testing.assert_allclose(mmp.to_numpy(), [300, 150, 100])
+
+
+def test_all_missing():
+    mmp = mean_max_power([np.nan] * 4)
+    assert mmp.index.tolist() == [1, 2, 3]
+    assert mmp.isnull().all()
+
+
+def test_intervals_outside_the_activity_are_dropped():
+    power = np.random.default_rng(1).integers(0, 500, 60).astype(float)
+    mmp = mean_max_power(power, intervals=[0, 1, 30, 59, 60, 3600])
+    assert mmp.index.tolist() == [1, 30, 59]
+    pd.testing.assert_series_equal(mmp, mean_max_power(power).loc[[1, 30, 59]])
+
+
+@pytest.mark.parametrize('power', [[], [250]])
+def test_too_short_for_any_interval(power):
+    assert len(mean_max_power(power)) == 0
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from fitly.api.trainingZones import classify_zones, power_zone_thresholds, heartrate_zone_thresholds
+
+ride_zones = {1: .55, 2: .75, 3: .9, 4: 1.05, 5: 1.2, 6: 1.5}
+run_zones = {1: .8, 2: .9, 3: 1, 4: 1.15}
+
+
+def loop_zones(values, thresholds):
+    # Per sample comparison chain classify_zones() replaced, a missing value fails every comparison
+    zones = []
+    for value in values:
+        zone = len(thresholds) + 1
+        for i, threshold in enumerate(thresholds):
+            if value <= threshold:
+                zone = i + 1
+                break
+        zones.append(float(zone))
+    return np.array(zones)
+
+
+def test_boundaries_belong_to_the_lower_zone():
+    thresholds = [100, 200, 300]
+    values = [0, 99, 100, 100.5, 200, 201, 300, 301, 5000]
+    assert classify_zones(values, thresholds).tolist() == [1, 1, 1, 2, 2, 3, 3, 4, 4]
+
+
+def test_missing_values_are_in_the_top_zone():
+    zones = classify_zones([np.nan, None, 150, 'n/a'], [100, 200])
+    assert zones.tolist() == [3, 3, 2, 3]
+    assert zones.dtype == float
+
+
+def test_empty():
+    assert len(classify_zones([], [100, 200])) == 0
+
+
+@pytest.mark.parametrize('sport,power_zones,ftp', [('ride', ride_zones, 250), ('run', run_zones, 310)])
+def test_power_zones_match_loop(sport, power_zones, ftp):
+    rng = np.random.default_rng(0)
+    watts = rng.integers(0, 600, 2000).astype(float)
+    watts[rng.random(2000) < .05] = np.nan
+    thresholds = power_zone_thresholds(ftp, power_zones, sport)
+    # Exact threshold values are the boundary cases
+    watts[:len(thresholds)] = thresholds
+    np.testing.assert_array_equal(classify_zones(watts, thresholds), loop_zones(watts, thresholds))
+
+
+def test_run_power_tops_out_at_zone_5():
+    thresholds = power_zone_thresholds(300, run_zones, 'run')
+    assert thresholds[4:] == [29700, 29700]
+    assert classify_zones([2000], thresholds).tolist() == [5]
+
+
+def test_heartrate_zones_match_loop():
+    rng = np.random.default_rng(1)
+    heartrate = rng.integers(40, 200, 2000).astype(float)
+    heartrate[rng.random(2000) < .05] = np.nan
+    thresholds = heartrate_zone_thresholds(50, 140, {1: .6, 2: .7, 3: .8, 4: .9})
+    assert thresholds == [134, 148, 162, 176]
+    np.testing.assert_array_equal(classify_zones(heartrate, thresholds), loop_zones(heartrate, thresholds))
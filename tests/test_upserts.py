@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import mysql, postgresql
+
+from fitly.api.sqlalchemy_declarative import Base, db_upsert, upsert_statement
+
+table = Base.metadata.tables['strava_best_envelope']
+keys = ['sport', 'period', 'interval']
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    table.create(engine)
+    return engine
+
+
+def envelope(mmp, act_name):
+    return pd.DataFrame({'sport': ['ride', 'ride'], 'period': ['all', 'all'], 'interval': [1, 5], 'mmp': mmp,
+                         'act_name': act_name}).set_index(keys)
+
+
+def stored(engine):
+    return pd.read_sql('select interval, mmp, act_name from strava_best_envelope order by interval', engine)
+
+
+def test_sqlite_inserts_then_updates(engine):
+    with engine.begin() as con:
+        assert db_upsert(envelope([500., 400.], ['a', 'b']), 'strava_best_envelope', con=con) == 2
+    with engine.begin() as con:
+        df = envelope([550., np.nan], ['c', 'd'])
+        df.loc[('ride', 'all', 20), ['mmp', 'act_name']] = [300., 'e']
+        assert db_upsert(df, 'strava_best_envelope', con=con) == 3
+    df = stored(engine)
+    assert df['interval'].tolist() == [1, 5, 20]
+    assert df['act_name'].tolist() == ['c', 'd', 'e']
+    # nan is written as NULL
+    assert df['mmp'].iloc[0] == 550 and pd.isnull(df['mmp'].iloc[1]) and df['mmp'].iloc[2] == 300
+
+
+def test_sqlite_leaves_columns_not_in_the_df(engine):
+    with engine.begin() as con:
+        db_upsert(envelope([500., 400.], ['a', 'b']), 'strava_best_envelope', con=con)
+        db_upsert(envelope([600., 450.], ['x', 'y'])[['mmp']].assign(ftp=250), 'strava_best_envelope', con=con)
+    df = stored(engine)
+    assert df['mmp'].tolist() == [600, 450]
+    assert df['act_name'].tolist() == ['a', 'b']
+
+
+def test_sqlite_keys_only_does_nothing(engine):
+    with engine.begin() as con:
+        db_upsert(envelope([500., 400.], ['a', 'b']), 'strava_best_envelope', con=con)
+        assert db_upsert(envelope([1., 1.], ['z', 'z'])[[]].assign(unknown=1), 'strava_best_envelope', con=con) == 2
+    assert stored(engine)['mmp'].tolist() == [500, 400]
+
+
+def test_empty_df_is_not_written(engine):
+    with engine.begin() as con:
+        assert db_upsert(envelope([500., 400.], ['a', 'b']).iloc[:0], 'strava_best_envelope', con=con) == 0
+
+
+def test_postgresql_statement():
+    sql = str(upsert_statement(table, keys + ['mmp', 'act_name'], 'postgresql').compile(dialect=postgresql.dialect()))
+    assert 'ON CONFLICT (sport, period, interval) DO UPDATE SET mmp = excluded.mmp, act_name = excluded.act_name' in sql
+    sql = str(upsert_statement(table, keys, 'postgresql').compile(dialect=postgresql.dialect()))
+    assert sql.endswith('ON CONFLICT (sport, period, interval) DO NOTHING')
+
+
+def test_mysql_statement():
+    sql = str(upsert_statement(table, keys + ['mmp', 'act_name'], 'mysql').compile(dialect=mysql.dialect()))
+    assert sql.endswith('ON DUPLICATE KEY UPDATE mmp = VALUES(mmp), act_name = VALUES(act_name)')
+    # mysql has no 'do nothing', the first key is assigned to itself instead
+    sql = str(upsert_statement(table, keys, 'mysql').compile(dialect=mysql.dialect()))
+    assert sql.endswith('ON DUPLICATE KEY UPDATE sport = VALUES(sport)')
+
+
+def test_unsupported_dialect():
+    with pytest.raises(ValueError, match='oracle'):
+        upsert_statement(table, keys + ['mmp'], 'oracle')